@@ -0,0 +1,187 @@
+"""
+Dynamic micro-batching for the inference engines.
+"""
+
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from logging import getLogger
+from typing import Any, Callable
+
+from backend import tracing
+
+logger = getLogger(__name__)
+
+# Sentinel pushed on the queue to stop the worker thread
+_STOP = object()
+
+
+class MicroBatcher:
+    """
+    Gathers items submitted by concurrent callers into batches and runs them through
+    `process_batch` on a single worker thread.
+
+    A batch is closed as soon as it holds `max_batch_size` items or `max_wait_ms`
+    milliseconds have passed since its first item arrived, whichever comes first.
+    `process_batch` must return one result per item, in the same order.
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[list[Any]], list[Any]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 5.0,
+        name: str = "micro-batcher",
+    ):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1.")
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Any) -> Future:
+        """Queue a single item and return a future resolving to its result."""
+        if self._closed:
+            raise RuntimeError(f"{self.name} is closed.")
+        future = Future()
+        # the trace and profiler capture of the submitting request go along, so the batch can record into them
+        self._queue.put((item, future, tracing.current(), tracing.current_profile(), time.perf_counter()))
+        return future
+
+    def submit_many(self, items: list[Any]) -> list[Future]:
+        return [self.submit(item) for item in items]
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def close(self, timeout: float | None = None) -> None:
+        """Stop accepting items, finish the queued ones and stop the worker thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _collect(self, first) -> tuple[list, bool]:
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                return batch, True
+            batch.append(entry)
+        return batch, False
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            first = self._queue.get()
+            if first is _STOP:
+                break
+            batch, stop = self._collect(first)
+            self._process(batch)
+
+    def _process(self, batch: list) -> None:
+        items = [item for item, _, _, _, _ in batch]
+        futures = [future for _, future, _, _, _ in batch]
+        traces = [trace for _, _, trace, _, _ in batch]
+        now = time.perf_counter()
+        for _, _, trace, _, submitted_at in batch:
+            if trace is not None:
+                trace.record(self.name, "queue_wait", now - submitted_at)
+        # profile the batch when one of its requests is profiled
+        captures = [capture for _, _, _, capture, _ in batch if capture is not None]
+        profiler, profile_name = (captures[0][0], f"{captures[0][1]}-batch") if captures else (None, None)
+        try:
+            with tracing.use_traces(traces), tracing.profiled(profiler, profile_name):
+                results = self.process_batch(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"{self.name} returned {len(results)} results for {len(items)} items.")
+        except Exception as e:
+            logger.exception(f"{self.name} failed on a batch of {len(items)} items.")
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+
+def length_bucket_index(length: int, boundaries: list[int]) -> int:
+    """Index of the first bucket whose upper bound fits `length`, lengths above all bounds share the last bucket."""
+    for index, boundary in enumerate(boundaries):
+        if length <= boundary:
+            return index
+    return len(boundaries)
+
+
+class PaddingStats:
+    """Counts real and padding tokens of the batches run through a model."""
+
+    def __init__(self):
+        self.batches = 0
+        self.real_tokens = 0
+        self.padding_tokens = 0
+        self._lock = threading.Lock()
+
+    def record(self, lengths: list[int]) -> None:
+        padded = max(lengths) * len(lengths)
+        with self._lock:
+            self.batches += 1
+            self.real_tokens += sum(lengths)
+            self.padding_tokens += padded - sum(lengths)
+
+    def stats(self) -> dict:
+        total = self.real_tokens + self.padding_tokens
+        return {
+            "batches": self.batches,
+            "real_tokens": self.real_tokens,
+            "padding_tokens": self.padding_tokens,
+            # share of the computed positions that were padding
+            "padding_waste": self.padding_tokens / total if total else 0.0,
+        }
+
+
+def run_bucketed(
+    items: list[Any],
+    group_key: Callable[[Any], Any],
+    length: Callable[[Any], int],
+    process_group: Callable[[Any, list[Any]], list[Any]],
+    boundaries: list[int],
+    max_group_size: int,
+    padding_stats: PaddingStats | None = None,
+) -> list[Any]:
+    """
+    Split `items` by `group_key` and by length bucket, and run every group through `process_group(key, items)` in
+    chunks of at most `max_group_size` items of similar length, so each chunk is only padded to its own longest item.
+    Returns the results in the order of `items`.
+    """
+    groups = {}
+    for position, item in enumerate(items):
+        key = (group_key(item), length_bucket_index(length(item), boundaries))
+        groups.setdefault(key, []).append(position)
+
+    results = [None] * len(items)
+    for (key, _), positions in groups.items():
+        # sorting by length keeps the items of a chunk close in length when a bucket spans several chunks
+        positions.sort(key=lambda position: length(items[position]))
+        for start in range(0, len(positions), max_group_size):
+            chunk = positions[start : start + max_group_size]
+            chunk_items = [items[position] for position in chunk]
+            if padding_stats is not None:
+                padding_stats.record([length(item) for item in chunk_items])
+            for position, result in zip(chunk, process_group(key, chunk_items)):
+                results[position] = result
+    return results
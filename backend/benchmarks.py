@@ -0,0 +1,471 @@
+"""
+Microbenchmarks of the hot components of the engines.
+
+Every benchmark times one component in isolation on deterministic inputs (seeded synthetic texts and token ids), so
+numbers are comparable between runs and machines with the same settings:
+
+* preprocess: the preprocessing pipeline of every engine, with the preprocessing cache cleared before each call
+* tokenize: the tokenizer of every engine
+* prf: every PRF of alternative_prf_schemes.prf_lookup on one context, and its batched variant on PRF_BATCH contexts
+* greenlist: WatermarkDetector._get_greenlist_ids per seeding scheme
+* scoring: WatermarkDetector._score_ngrams_in_passage with a cold greenlist cache
+* detect: WatermarkDetector.detect on token ids with a cold greenlist cache, and its scan over every window size
+* forward: one forward pass of the classifier models at fixed sequence length buckets
+
+Components whose model or tokenizer cannot be loaded are reported as skipped. The report is written as JSON and can
+be compared against a stored baseline, slowdowns beyond the tolerance are reported as regressions:
+
+    python -m backend.benchmarks --output benchmarks.json --baseline baseline.json
+    python -m backend.benchmarks --groups prf,greenlist,detect --save-baseline baseline.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from logging import getLogger
+from typing import Callable
+
+import torch
+
+logger = getLogger(__name__)
+
+GROUPS = ["preprocess", "tokenize", "prf", "greenlist", "scoring", "detect", "forward"]
+
+# Lengths (in words) of the synthetic texts preprocessed and tokenized
+TEXT_LENGTHS = [64, 256, 1024, 4096]
+# Lengths (in tokens) of the passages scored by the watermark detector
+PASSAGE_LENGTHS = [128, 512, 2048]
+# Seeding schemes of the watermark detector, the configured one and the one the engine detects with
+SEEDING_SCHEMES = ["simple_1", "selfhash"]
+# Number of contexts the batched PRFs are timed on
+PRF_BATCH = 1024
+
+SEED = 0
+
+_WORDS = (
+    "the of and to in is was for that on as with by it at from his an were are which this be or has had not but "
+    "first one their its new after who they have her she two been other when there all during into school time "
+    "may years more most only over city some world would where later up such used many can state about national "
+    "out known university united then made however model language text detection system between both under "
+    "century team government several film well part including early game since against series number"
+).split()
+_PUNCTUATION = [".", ",", ",", ";", ":", "!", "?", "'s", " (see below)", " - "]
+
+
+def synthetic_text(num_words: int, seed: int = SEED) -> str:
+    """Deterministic English-looking text of `num_words` words with punctuation and line breaks."""
+    rng = random.Random(seed * 1_000_003 + num_words)
+    words = []
+    for i in range(num_words):
+        word = rng.choice(_WORDS)
+        if i == 0 or words[-1].endswith((".", "!", "?", "\n")):
+            word = word.capitalize()
+        if rng.random() < 0.12:
+            word += rng.choice(_PUNCTUATION)
+        if rng.random() < 0.01:
+            word += ".\n"
+        words.append(word)
+    return " ".join(words) + "."
+
+
+def synthetic_token_ids(length: int, vocab_size: int, seed: int = SEED, low: int = 0) -> torch.LongTensor:
+    generator = torch.Generator().manual_seed(seed * 1_000_003 + length)
+    return torch.randint(low, vocab_size, (length,), generator=generator)
+
+
+def measure(
+    fn: Callable[[], object],
+    setup: Callable[[], object] | None = None,
+    repeat: int = 20,
+    warmup: int = 2,
+    min_sample_seconds: float = 0.001,
+    max_seconds: float = 10.0,
+) -> dict:
+    """
+    Time `fn` and return per-call statistics in seconds. Without `setup`, fast calls are looped within a sample until
+    it lasts `min_sample_seconds`. With `setup`, every call is timed on its own right after an untimed `setup()`.
+    Stops sampling after `max_seconds`, but always takes at least three samples.
+    """
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        fn()
+
+    number = 1
+    if setup is None:
+        # calibrate the loop count like timeit's autorange
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            if time.perf_counter() - start >= min_sample_seconds:
+                break
+            number *= 2
+
+    samples = []
+    deadline = time.perf_counter() + max_seconds
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        while len(samples) < repeat and (len(samples) < 3 or time.perf_counter() < deadline):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            samples.append((time.perf_counter() - start) / number)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    samples.sort()
+    return {
+        "median": statistics.median(samples),
+        "mean": statistics.fmean(samples),
+        "min": samples[0],
+        "p90": samples[min(int(0.9 * len(samples)), len(samples) - 1)],
+        "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "samples": len(samples),
+        "calls_per_sample": number,
+    }
+
+
+class Suite:
+    """Collects the results and skipped components of one run."""
+
+    def __init__(self, repeat: int, max_seconds: float):
+        self.repeat = repeat
+        self.max_seconds = max_seconds
+        self.results = {}
+        self.skipped = {}
+
+    def run(self, name: str, fn: Callable[[], object], setup: Callable[[], object] | None = None, **extra) -> None:
+        result = measure(fn, setup, repeat=self.repeat, max_seconds=self.max_seconds)
+        result.update(extra)
+        self.results[name] = result
+        logger.info(f"{name}: {result['median'] * 1e3:.4f} ms")
+
+    def skip(self, name: str, reason: str) -> None:
+        self.skipped[name] = reason
+        logger.warning(f"Skipped {name}: {reason}")
+
+
+def _try_load(suite: Suite, name: str, load: Callable[[], object]):
+    try:
+        return load()
+    except Exception as e:
+        suite.skip(name, f"{type(e).__name__}: {str(e)}")
+        return None
+
+
+def _engine_model_dirs() -> dict:
+    from backend.finetuned.service import config as finetuned_config
+    from backend.longformer.service import config as longformer_config
+
+    return {"longformer": longformer_config['model_dir'], "finetuned": finetuned_config['model_dirs']['all']}
+
+
+def _watermark_tokenizer_dir() -> str:
+    from backend.watermark.service import config as watermark_config
+
+    return watermark_config['model_name_or_path']
+
+
+def bench_preprocess(suite: Suite) -> None:
+    from backend import preprocessing
+    from backend.finetuned.utils import preprocess as finetuned_preprocess
+    from backend.longformer.utils import preprocess as longformer_preprocess
+    from backend.watermark.utils import preprocess as watermark_preprocess
+
+    engines = {"longformer": longformer_preprocess, "finetuned": finetuned_preprocess, "watermark": watermark_preprocess}
+    for engine_name, preprocess in engines.items():
+        for num_words in TEXT_LENGTHS:
+            text = synthetic_text(num_words)
+            suite.run(
+                f"preprocess/{engine_name}/{num_words}w",
+                lambda: preprocess(text),
+                setup=preprocessing._cache.clear,
+                words=num_words,
+            )
+
+
+def bench_tokenize(suite: Suite) -> None:
+    from transformers import AutoTokenizer
+
+    from backend.longformer.utils import preprocess
+
+    tokenizer_dirs = {**_engine_model_dirs(), "watermark": _watermark_tokenizer_dir()}
+    for engine_name, tokenizer_dir in tokenizer_dirs.items():
+        tokenizer = _try_load(suite, f"tokenize/{engine_name}", lambda: AutoTokenizer.from_pretrained(tokenizer_dir))
+        if tokenizer is None:
+            continue
+        for num_words in TEXT_LENGTHS:
+            text = preprocess(synthetic_text(num_words))
+            tokens = len(tokenizer(text)["input_ids"])
+            suite.run(f"tokenize/{engine_name}/{num_words}w", lambda: tokenizer(text), words=num_words, tokens=tokens)
+
+
+def bench_prf(suite: Suite) -> None:
+    from backend.watermark.alternative_prf_schemes import prf_lookup, prf_lookup_batched
+
+    context = synthetic_token_ids(4, 50_000)
+    contexts = synthetic_token_ids(4 * PRF_BATCH, 50_000).view(PRF_BATCH, 4)
+    for prf_name, prf in prf_lookup.items():
+        suite.run(f"prf/{prf_name}", lambda: prf(context, 15485863), context_width=len(context))
+        batched_prf = prf_lookup_batched[prf_name]
+        suite.run(
+            f"prf/{prf_name}/batched-{PRF_BATCH}", lambda: batched_prf(contexts, 15485863), context_width=len(context), contexts=PRF_BATCH
+        )
+
+
+def _make_detectors(suite: Suite) -> dict:
+    from transformers import AutoTokenizer
+
+    from backend.watermark.extended_watermark_processor import WatermarkDetector
+
+    tokenizer = _try_load(suite, "watermark detector", lambda: AutoTokenizer.from_pretrained(_watermark_tokenizer_dir()))
+    if tokenizer is None:
+        return {}
+    vocab = list(tokenizer.get_vocab().values())
+    return {
+        seeding_scheme: WatermarkDetector(
+            vocab=vocab,
+            gamma=0.25,
+            seeding_scheme=seeding_scheme,
+            device="cpu",
+            tokenizer=tokenizer,
+            z_threshold=1.5,
+            normalizers=[],
+            ignore_repeated_ngrams=True,
+            greenlist_workers=1,
+        )
+        for seeding_scheme in SEEDING_SCHEMES
+    }
+
+
+def _cold_cache(detector) -> Callable[[], None]:
+    from backend.watermark.greenlist_cache import LRUGreenlistCache
+
+    def setup():
+        detector.greenlist_cache = LRUGreenlistCache()
+
+    return setup
+
+
+def _passage(detector, length: int) -> torch.LongTensor:
+    # token ids at or above the vocabulary size are never green, so stay within it
+    return synthetic_token_ids(length, detector.vocab_size, low=4)
+
+
+def bench_greenlist(suite: Suite, detectors: dict) -> None:
+    for seeding_scheme, detector in detectors.items():
+        context = _passage(detector, detector.context_width)
+        suite.run(
+            f"greenlist/{seeding_scheme}",
+            lambda: detector._get_greenlist_ids(context),
+            vocab_size=detector.vocab_size,
+        )
+
+
+def bench_scoring(suite: Suite, detectors: dict) -> None:
+    for seeding_scheme, detector in detectors.items():
+        for length in PASSAGE_LENGTHS:
+            input_ids = _passage(detector, length)
+            suite.run(
+                f"scoring/{seeding_scheme}/{length}t",
+                lambda: detector._score_ngrams_in_passage(input_ids),
+                setup=_cold_cache(detector),
+                tokens=length,
+            )
+
+
+def bench_detect(suite: Suite, detectors: dict) -> None:
+    for seeding_scheme, detector in detectors.items():
+        for length in PASSAGE_LENGTHS:
+            input_ids = _passage(detector, length)
+            suite.run(
+                f"detect/{seeding_scheme}/{length}t",
+                lambda: detector.detect(tokenized_text=input_ids),
+                setup=_cold_cache(detector),
+                tokens=length,
+            )
+            # the scan over every window size, on a warm cache so it is timed on its own
+            suite.run(
+                f"detect/{seeding_scheme}/{length}t/max-window",
+                lambda: detector.detect(tokenized_text=input_ids, window_size="max", return_z_at_T=False),
+                tokens=length,
+            )
+
+
+def bench_forward(suite: Suite, batch_size: int, execution_backend: str) -> None:
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    from backend.execution import make_backend
+    from backend.finetuned.service import config as finetuned_config
+    from backend.longformer.service import config as longformer_config
+
+    buckets = {"longformer": longformer_config['warmup_lengths'], "finetuned": finetuned_config['warmup_lengths']}
+    for engine_name, model_dir in _engine_model_dirs().items():
+
+        def load():
+            tokenizer = AutoTokenizer.from_pretrained(model_dir)
+            model = AutoModelForSequenceClassification.from_pretrained(model_dir)
+            model.eval()
+            return tokenizer, model
+
+        loaded = _try_load(suite, f"forward/{engine_name}", load)
+        if loaded is None:
+            continue
+        tokenizer, model = loaded
+        backend = make_backend(execution_backend, model, tokenizer.pad_token_id)
+        max_length = getattr(model.config, "max_position_embeddings", None)
+        for length in buckets[engine_name]:
+            if max_length is not None and length > max_length:
+                suite.skip(f"forward/{engine_name}/{length}t", f"longer than the model's {max_length} positions")
+                continue
+            input_ids = torch.stack([synthetic_token_ids(length, len(tokenizer), seed=SEED + i, low=4) for i in range(batch_size)])
+            attention_mask = torch.ones_like(input_ids)
+            suite.run(
+                f"forward/{engine_name}/{length}t",
+                lambda: backend(input_ids, attention_mask),
+                tokens=length,
+                batch_size=batch_size,
+                execution_backend=execution_backend,
+            )
+
+
+def run(groups: list[str], repeat: int = 20, max_seconds: float = 10.0, batch_size: int = 1, execution_backend: str = "eager") -> dict:
+    """Run the benchmarks of the given groups and return the report."""
+    suite = Suite(repeat, max_seconds)
+    if "preprocess" in groups:
+        bench_preprocess(suite)
+    if "tokenize" in groups:
+        bench_tokenize(suite)
+    if "prf" in groups:
+        bench_prf(suite)
+    if {"greenlist", "scoring", "detect"} & set(groups):
+        detectors = _make_detectors(suite)
+        if "greenlist" in groups:
+            bench_greenlist(suite, detectors)
+        if "scoring" in groups:
+            bench_scoring(suite, detectors)
+        if "detect" in groups:
+            bench_detect(suite, detectors)
+    if "forward" in groups:
+        bench_forward(suite, batch_size, execution_backend)
+    return {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+            "groups": groups,
+            "repeat": repeat,
+            "seed": SEED,
+        },
+        "results": suite.results,
+        "skipped": suite.skipped,
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float = 0.10) -> list[dict]:
+    """
+    Compare the median time of every benchmark with the baseline. A benchmark more than `tolerance` slower than the
+    baseline is a regression, one more than `tolerance` faster is an improvement.
+    """
+    rows = []
+    current = report["results"]
+    # benchmarks of groups left out of this run are not missing
+    previous = {name: result for name, result in baseline["results"].items() if name.split("/")[0] in report["meta"]["groups"]}
+    for name in sorted(set(current) | set(previous)):
+        if name not in previous:
+            rows.append({"name": name, "status": "new", "current": current[name]["median"]})
+            continue
+        if name not in current:
+            rows.append({"name": name, "status": "missing", "baseline": previous[name]["median"]})
+            continue
+        ratio = current[name]["median"] / previous[name]["median"] if previous[name]["median"] else float("inf")
+        if ratio > 1 + tolerance:
+            status = "regression"
+        elif ratio < 1 - tolerance:
+            status = "improvement"
+        else:
+            status = "unchanged"
+        rows.append({
+            "name": name,
+            "status": status,
+            "baseline": previous[name]["median"],
+            "current": current[name]["median"],
+            "ratio": ratio,
+        })
+    return rows
+
+
+def format_comparison(rows: list[dict]) -> str:
+    width = max([len(row["name"]) for row in rows] + [9])
+    lines = [f"{'benchmark':<{width}}  {'baseline ms':>12}  {'current ms':>12}  {'ratio':>7}  status"]
+    for row in rows:
+        baseline = f"{row['baseline'] * 1e3:.4f}" if "baseline" in row else "-"
+        current = f"{row['current'] * 1e3:.4f}" if "current" in row else "-"
+        ratio = f"{row['ratio']:.3f}" if "ratio" in row else "-"
+        lines.append(f"{row['name']:<{width}}  {baseline:>12}  {current:>12}  {ratio:>7}  {row['status']}")
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the engines' components.")
+    parser.add_argument("--groups", default=",".join(GROUPS), help=f"Comma separated groups out of {', '.join(GROUPS)}.")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of timed samples per benchmark.")
+    parser.add_argument("--max-seconds", type=float, default=10.0, help="Time budget per benchmark.")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads, fixes the numbers on shared machines.")
+    parser.add_argument("--batch-size", type=int, default=1, help="Batch size of the forward passes.")
+    parser.add_argument("--execution-backend", choices=["eager", "compile", "trace"], default="eager")
+    parser.add_argument("--output", default="benchmarks.json", help="Write the report as JSON to this file.")
+    parser.add_argument("--baseline", default=None, help="Compare against the report stored in this file.")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Relative slowdown reported as a regression.")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 when a benchmark regressed.")
+    parser.add_argument("--save-baseline", default=None, help="Also store the report as the baseline in this file.")
+    args = parser.parse_args(argv)
+    args.groups = [group.strip() for group in args.groups.split(",") if group.strip()]
+    unknown = set(args.groups) - set(GROUPS)
+    if unknown:
+        parser.error(f"Unknown groups: {', '.join(sorted(unknown))}.")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    report = run(args.groups, args.repeat, args.max_seconds, args.batch_size, args.execution_backend)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            rows = compare(report, json.load(file), args.tolerance)
+        report["comparison"] = {"baseline": args.baseline, "tolerance": args.tolerance, "rows": rows}
+        print(format_comparison(rows))
+    else:
+        print(json.dumps(report["results"], indent=2))
+
+    for path in filter(None, [args.output, args.save_baseline]):
+        with open(path, "w") as file:
+            json.dump(report, file, indent=2)
+        logger.info(f"Wrote the benchmark report to {path}.")
+
+    if args.fail_on_regression and any(row["status"] == "regression" for row in report.get("comparison", {}).get("rows", [])):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
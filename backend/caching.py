@@ -0,0 +1,85 @@
+"""
+Small in-process caches shared by the engines.
+"""
+
+from __future__ import annotations
+
+import collections
+import hashlib
+import threading
+import time
+from typing import Any, Callable, Hashable
+
+
+def text_digest(text: str) -> bytes:
+    """Stable digest of a text, used as cache key instead of the text itself."""
+    return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+
+class LRUCache:
+    """
+    Thread-safe mapping holding at most `max_entries` entries, evicting the least recently used one first.
+    With `ttl_seconds`, entries also expire that long after they were stored.
+    """
+
+    def __init__(self, max_entries: int = 4096, ttl_seconds: float | None = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = collections.OrderedDict()  # key -> (value, expiry time or None)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any) -> None:
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """Return the cached value of `key`, computing and storing it on a miss.
+        The computation runs outside the lock, so concurrent misses on the same key may compute it twice."""
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "size": len(self),
+            "capacity": self.max_entries,
+        }
@@ -0,0 +1,93 @@
+"""
+Token-window chunking of long documents, shared by the classifier engines.
+"""
+
+from __future__ import annotations
+
+from typing import Callable, NamedTuple
+
+import torch
+
+
+class Chunk(NamedTuple):
+    start: int  # offset of the first token of the chunk in the document (without special tokens)
+    end: int  # offset one past the last token of the chunk
+    input_ids: list[int]  # model input for the chunk, special tokens included
+
+
+def split_into_windows(num_tokens: int, window: int, overlap: int = 0) -> list[tuple[int, int]]:
+    """
+    Split `num_tokens` tokens into [start, end) windows of at most `window` tokens,
+    where consecutive windows share `overlap` tokens.
+    """
+    if window < 1:
+        raise ValueError("window must be at least 1 token.")
+    if not 0 <= overlap < window:
+        raise ValueError("overlap must be non-negative and smaller than the window.")
+    if num_tokens <= window:
+        return [(0, num_tokens)]
+    step = window - overlap
+    spans = []
+    start = 0
+    while True:
+        end = min(start + window, num_tokens)
+        spans.append((start, end))
+        if end == num_tokens:
+            return spans
+        start += step
+
+
+def chunk_text(text: str, tokenizer, max_tokens: int, overlap: int = 0) -> list[Chunk]:
+    """
+    Tokenize `text` and cut it into chunks that fit in `max_tokens` model positions,
+    special tokens included. A text that fits in one chunk gets exactly the input
+    ids the tokenizer would produce for it on its own.
+    """
+    encoding = tokenizer(text, return_special_tokens_mask=True)
+    input_ids, special_tokens_mask = encoding["input_ids"], encoding["special_tokens_mask"]
+    # Every chunk is wrapped in the same leading and trailing special tokens as the full text
+    head = 0
+    while head < len(input_ids) and special_tokens_mask[head]:
+        head += 1
+    tail = len(input_ids)
+    while tail > head and special_tokens_mask[tail - 1]:
+        tail -= 1
+    prefix, body, suffix = input_ids[:head], input_ids[head:tail], input_ids[tail:]
+    window = max_tokens - len(prefix) - len(suffix)
+    return [
+        Chunk(start, end, prefix + body[start:end] + suffix)
+        for start, end in split_into_windows(len(body), window, min(overlap, window - 1))
+    ]
+
+
+def score_chunks(
+    chunks: list[Chunk],
+    forward_batch: Callable[[list[list[int]]], torch.Tensor],
+    max_batch_size: int,
+) -> torch.Tensor:
+    """Run `forward_batch` over the chunks, at most `max_batch_size` at a time, and stack the logits."""
+    logits = []
+    for i in range(0, len(chunks), max_batch_size):
+        logits.append(forward_batch([chunk.input_ids for chunk in chunks[i : i + max_batch_size]]))
+    return torch.cat(logits, dim=0)
+
+
+def aggregate_logits(chunks: list[Chunk], logits: torch.Tensor) -> torch.Tensor:
+    """Combine per-chunk logits into document logits, weighting every chunk by its number of tokens."""
+    if len(chunks) == 1:
+        return logits[0]
+    weights = torch.tensor([max(chunk.end - chunk.start, 1) for chunk in chunks], dtype=logits.dtype, device=logits.device)
+    return (logits * weights[:, None]).sum(dim=0) / weights.sum()
+
+
+def chunk_scores(chunks: list[Chunk], decisions: list[dict]) -> list[dict]:
+    """Per-chunk label and confidence, located by token offsets."""
+    return [
+        {
+            "start": chunk.start,
+            "end": chunk.end,
+            "label": decision["label"],
+            "confidence": decision["confidence"],
+        }
+        for chunk, decision in zip(chunks, decisions)
+    ]
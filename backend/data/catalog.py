@@ -0,0 +1,89 @@
+"""
+In-memory catalog of the testbed files.
+
+The catalog walks the testbed tree once and keeps the listing until the mtime of one of its directories changes
+(a file was added, removed or renamed). Statistics of every file are computed from its record index and cached
+until the file itself changes, so the UI and the evaluation tools can query the shape of the data without
+rereading the files.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from logging import getLogger
+from typing import Callable
+
+from backend.data.index import get_index
+
+logger = getLogger(__name__)
+
+
+class TestbedCatalog:
+    """Testbed listing of one base directory, rebuilt when its directories change."""
+
+    def __init__(self, base_dir: str, find: Callable[[str], list[dict]]):
+        self.base_dir = base_dir
+        self._find = find
+        self._entries = None
+        self._dir_mtimes = {}
+        self._stats = {}  # file_path -> ((mtime_ns, size), stats)
+        self._lock = threading.Lock()
+
+    def _scan_dir_mtimes(self) -> dict:
+        dir_mtimes = {}
+        for root, _, _ in os.walk(self.base_dir):
+            dir_mtimes[root] = os.stat(root).st_mtime_ns
+        return dir_mtimes
+
+    def _is_stale(self) -> bool:
+        if self._entries is None:
+            return True
+        for directory, mtime_ns in self._dir_mtimes.items():
+            try:
+                if os.stat(directory).st_mtime_ns != mtime_ns:
+                    return True
+            except FileNotFoundError:
+                return True
+        return False
+
+    def entries(self) -> list[dict]:
+        """Entries of all testbed files, each with its statistics when they were computed already."""
+        with self._lock:
+            if self._is_stale():
+                self._dir_mtimes = self._scan_dir_mtimes()
+                self._entries = self._find(self.base_dir)
+                known = {entry["file_path"] for entry in self._entries}
+                self._stats = {file_path: stats for file_path, stats in self._stats.items() if file_path in known}
+                logger.info(f"Catalogued {len(self._entries)} testbed files under {self.base_dir}.")
+            entries = self._entries
+        return [{**entry, "stats": self.cached_stats(entry["file_path"])} for entry in entries]
+
+    def cached_stats(self, file_path: str) -> dict | None:
+        """Statistics of a file if they are computed and the file did not change since, without reading it."""
+        cached = self._stats.get(file_path)
+        if cached is None:
+            return None
+        try:
+            stat = os.stat(os.path.join(self.base_dir, file_path))
+        except FileNotFoundError:
+            return None
+        return cached[1] if cached[0] == (stat.st_mtime_ns, stat.st_size) else None
+
+    def stats(self, file_path: str) -> dict:
+        """Statistics of a file, computed from its record index when missing or stale."""
+        stats = self.cached_stats(file_path)
+        if stats is None:
+            index = get_index(os.path.join(self.base_dir, file_path))
+            stats = index.stats()
+            self._stats[file_path] = ((index.mtime_ns, index.size), stats)
+        return stats
+
+    def warm(self) -> None:
+        """Compute the statistics of every file, e.g. in a background thread at startup."""
+        for entry in self.entries():
+            if entry["stats"] is None:
+                try:
+                    self.stats(entry["file_path"])
+                except Exception as e:
+                    logger.warning(f"Could not compute statistics of {entry['file_path']}: {str(e)}")
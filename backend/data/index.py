@@ -0,0 +1,241 @@
+"""
+Record index of the testbed CSV files.
+
+The index of a file holds the byte range, label and length (in whitespace-separated tokens) of every record, so a
+record can be read with a single seek instead of scanning the file. Records are found with a quote-aware scan, so
+quoted fields spanning several lines are kept in one record. Indexes are written next to the testbeds under
+INDEX_DIR and rebuilt when the size or mtime of their CSV file changes.
+"""
+
+from __future__ import annotations
+
+import csv
+import hashlib
+import io
+import mmap
+import os
+import random
+import struct
+import sys
+import threading
+from array import array
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# Testbed texts can be longer than the default limit of 131072 characters per field. The limit is process wide, every
+# reader of the testbeds (the index, the catalog, evaluation and quantization checks) goes through this module.
+csv.field_size_limit(min(sys.maxsize, 2**31 - 1))
+
+INDEX_DIR = "./backend/data/mage/.index"
+
+INDEX_MAGIC = b"MACDETIX"
+INDEX_VERSION = 1
+_HEADER = struct.Struct("<IqqQ")  # version, mtime_ns, size, number of records
+
+# Upper bounds (in whitespace-separated tokens) of the text-length buckets, the last bucket is open-ended
+LENGTH_BUCKETS = [64, 128, 256, 512, 1024, 2048]
+
+
+def length_bucket(num_tokens: int) -> str:
+    lower = 0
+    for upper in LENGTH_BUCKETS:
+        if num_tokens < upper:
+            return f"{lower}-{upper}"
+        lower = upper
+    return f"{lower}+"
+
+
+def parse_record(raw: bytes) -> tuple[str, int] | None:
+    """Parse one CSV record into (text, label), None for the header and malformed records."""
+    rows = list(csv.reader(io.StringIO(raw.decode("utf-8", errors="replace"), newline="")))
+    if len(rows) != 1 or len(rows[0]) < 2:
+        return None
+    row = rows[0]
+    try:
+        label = int(row[-1])
+    except ValueError:
+        return None
+    # unquoted texts may contain commas, so join all fields but the label
+    return ",".join(row[:-1]), label
+
+
+def iter_raw_records(file):
+    """Yield the (start, end, raw bytes) of every record of a binary CSV file."""
+    start = offset = 0
+    quotes = 0
+    lines = []
+    for line in file:
+        offset += len(line)
+        lines.append(line)
+        # a record ends at a line break outside quotes, escaped quotes ("") keep the count even
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            yield start, offset, b"".join(lines)
+            start = offset
+            quotes = 0
+            lines = []
+    if lines:
+        yield start, offset, b"".join(lines)
+
+
+class RecordIndex:
+    """Byte ranges, labels and lengths of the records of one testbed file."""
+
+    def __init__(self, path: str, mtime_ns: int, size: int, starts=None, ends=None, labels=None, lengths=None):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.starts = starts if starts is not None else array("Q")
+        self.ends = ends if ends is not None else array("Q")
+        self.labels = labels if labels is not None else array("b")
+        self.lengths = lengths if lengths is not None else array("I")
+        self._strata = {}
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    @classmethod
+    def build(cls, path: str) -> "RecordIndex":
+        stat = os.stat(path)
+        index = cls(path, stat.st_mtime_ns, stat.st_size)
+        with open(path, "rb") as file:
+            for start, end, raw in iter_raw_records(file):
+                record = parse_record(raw)
+                if record is None:
+                    continue
+                text, label = record
+                index.starts.append(start)
+                index.ends.append(end)
+                index.labels.append(label)
+                index.lengths.append(len(text.split()))
+        return index
+
+    def is_stale(self) -> bool:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        return (stat.st_mtime_ns, stat.st_size) != (self.mtime_ns, self.size)
+
+    def save(self, index_path: str) -> None:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(INDEX_MAGIC + _HEADER.pack(INDEX_VERSION, self.mtime_ns, self.size, len(self)))
+            for values in (self.starts, self.ends, self.labels, self.lengths):
+                values.tofile(file)
+        os.replace(tmp_path, index_path)  # readers never see a half-written index
+
+    @classmethod
+    def load(cls, path: str, index_path: str) -> "RecordIndex":
+        with open(index_path, "rb") as file:
+            header = file.read(len(INDEX_MAGIC) + _HEADER.size)
+            if not header.startswith(INDEX_MAGIC):
+                raise ValueError(f"{index_path} is not a testbed index.")
+            version, mtime_ns, size, count = _HEADER.unpack(header[len(INDEX_MAGIC) :])
+            if version != INDEX_VERSION:
+                raise ValueError(f"Unsupported testbed index version {version} in {index_path}.")
+            values = [array(typecode) for typecode in "QQbI"]
+            for value in values:
+                value.fromfile(file, count)
+        return cls(path, mtime_ns, size, *values)
+
+    def stats(self) -> dict:
+        """Row count, label balance and text-length histogram of the file."""
+        labels, lengths = {}, {}
+        for label in self.labels:
+            labels[label] = labels.get(label, 0) + 1
+        for length in self.lengths:
+            bucket = length_bucket(length)
+            lengths[bucket] = lengths.get(bucket, 0) + 1
+        return {
+            "rows": len(self),
+            "labels": dict(sorted(labels.items())),
+            "length_histogram": {bucket: lengths[bucket] for bucket in sorted(lengths, key=lambda bucket: int(bucket.split("-")[0].rstrip("+")))},
+            "mean_length": sum(self.lengths) / len(self) if len(self) else 0.0,
+        }
+
+    def strata(self, stratify: str) -> dict:
+        """Record positions grouped by label or by length bucket."""
+        if stratify not in self._strata:
+            if stratify == "label":
+                keys = self.labels
+            elif stratify == "length":
+                keys = [length_bucket(length) for length in self.lengths]
+            else:
+                raise ValueError(f"Unknown stratification '{stratify}'. Try 'label' or 'length'.")
+            groups = {}
+            for position, key in enumerate(keys):
+                groups.setdefault(key, []).append(position)
+            self._strata[stratify] = groups
+        return self._strata[stratify]
+
+    def sample_position(self, label: int | None = None, stratify: str | None = None, rng=random) -> int:
+        """
+        Pick a random record. With `label`, only records of that label are considered. With `stratify`, a label or
+        length bucket is picked uniformly first and then a record within it, so rare strata are sampled as often as
+        common ones.
+        """
+        if label is None and stratify is None:
+            if not len(self):
+                raise ValueError(f"Testbed {self.path} is empty.")
+            return rng.randrange(len(self))
+        if stratify is not None:
+            groups = list(self.strata(stratify).values())
+            if label is not None:
+                labelled = set(self.strata("label").get(label, []))
+                groups = [[position for position in group if position in labelled] for group in groups]
+        else:
+            groups = [self.strata("label").get(label, [])]
+        groups = [group for group in groups if group]
+        if not groups:
+            raise ValueError(f"Testbed {self.path} has no records matching the request.")
+        return rng.choice(rng.choice(groups))
+
+    def read(self, position: int) -> tuple[str, int]:
+        """Read the (text, label) of the record at `position` with a single seek."""
+        with open(self.path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            record = parse_record(data[self.starts[position] : self.ends[position]])
+        if record is None:
+            raise ValueError(f"Record {position} of {self.path} is malformed, the file changed since it was indexed.")
+        return record
+
+
+def index_path_for(path: str, index_dir: str = INDEX_DIR) -> str:
+    name = hashlib.blake2b(os.path.abspath(path).encode(), digest_size=8).hexdigest()
+    return os.path.join(index_dir, f"{os.path.basename(path)}.{name}.idx")
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_index(path: str, index_dir: str = INDEX_DIR) -> RecordIndex:
+    """Index of a testbed file, loaded from disk or (re)built when missing or stale."""
+    with _lock:
+        index = _indexes.get(path)
+        if index is not None and not index.is_stale():
+            return index
+        index_path = index_path_for(path, index_dir)
+        index = None
+        if os.path.exists(index_path):
+            try:
+                index = RecordIndex.load(path, index_path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring index {index_path}: {str(e)}")
+        if index is None or index.is_stale():
+            index = RecordIndex.build(path)
+            logger.info(f"Indexed {len(index)} records of {path}.")
+            try:
+                index.save(index_path)
+            except OSError as e:
+                logger.warning(f"Could not write index {index_path}: {str(e)}")
+        _indexes[path] = index
+        return index
+
+
+def sample_record(path: str, label: int | None = None, stratify: str | None = None) -> tuple[str, int]:
+    """Sample one (text, label) record of a testbed file."""
+    index = get_index(path)
+    return index.read(index.sample_position(label=label, stratify=stratify))
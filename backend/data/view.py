@@ -1,8 +1,9 @@
 import os
-import random
 from fastapi import APIRouter, HTTPException
-from typing import List
+from typing import List, Optional
 from backend.data import router
+from backend.data.catalog import TestbedCatalog
+from backend.data.index import sample_record
 
 # Define the base directories for testbeds
 TESTBEDS_DIR = "./backend/data/mage/testbeds"
@@ -44,6 +45,10 @@ def find_testbeds(base_dir: str, is_wilder: bool = False):
     testbeds.sort(key=lambda x: x["file_path"])
     return testbeds
 
+testbed_catalog = TestbedCatalog(TESTBEDS_DIR, find_testbeds)
+wilder_catalog = TestbedCatalog(WILDER_DIR, lambda base_dir: find_testbeds(base_dir, is_wilder=True))
+
+
 @router.get("/mage/testbeds")
 def get_available_testbeds():
     """
@@ -67,23 +72,25 @@ def get_available_testbeds():
                     "subtype": subtype if testbed["type"] == "regular" else subtype + " (OOD)",
                     "file_name": testbed["file_name"],
                     "file_path": testbed["file_path"],
-                    "type": testbed["type"]
+                    "type": testbed["type"],
+                    "stats": testbed["stats"],
                 })
             else:
                 organized[name]["subtypes"].append({
                     "subtype": "General",
                     "file_name": testbed["file_name"],
                     "file_path": testbed["file_path"],
-                    "type": testbed["type"]
+                    "type": testbed["type"],
+                    "stats": testbed["stats"],
                 })
         organized = list(organized.values())
         # Sort by testbed name
         organized.sort(key=lambda x: x["testbed_name"])
         return organized
 
-    # Get testbeds and wilder testbeds
-    testbeds = find_testbeds(TESTBEDS_DIR)
-    # wilder_testbeds = find_testbeds(WILDER_DIR, is_wilder=True)
+    # Get testbeds and wilder testbeds from the catalog, which only rescans the tree when it changed
+    testbeds = testbed_catalog.entries()
+    # wilder_testbeds = wilder_catalog.entries()
 
     # Organize testbeds and wilder testbeds
     return {
@@ -93,30 +100,49 @@ def get_available_testbeds():
         }
     }
 
-def sample_data_from_testbed(testbed_path: str) -> str:
+@router.get("/mage/stats")
+def get_testbed_stats(file_path: Optional[str] = None):
+    """
+    Row count, label balance and text-length histogram of testbed files.
+
+    - `file_path`: The full relative path to the testbed file, all files when omitted.
+    """
+    catalog = wilder_catalog if file_path and file_path.startswith("wilder") else testbed_catalog
+    file_paths = [file_path] if file_path else [entry["file_path"] for entry in catalog.entries()]
+    stats = {}
+    for path in file_paths:
+        try:
+            stats[path] = catalog.stats(path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail=f"Testbed {path} not found.")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error reading the file: {str(e)}")
+    return {
+        "status": "success",
+        "data": stats,
+    }
+
+def sample_data_from_testbed(testbed_path: str, label: Optional[int] = None, stratify: Optional[str] = None) -> list:
     """Sample a single data point from a testbed file."""
     try:
-        with open(testbed_path, 'r') as file:
-            lines = file.readlines()
-            if not lines:
-                raise ValueError(f"Testbed {testbed_path} is empty.")
-            sampled_line = random.choice(lines)
-            # The text may contain a comma, so we need to join the remaining parts
-            text = ",".join(sampled_line.split(",")[:-1])
-            label = sampled_line.split(",")[-1]
-            return [text, label]
+        text, label = sample_record(testbed_path, label=label, stratify=stratify)
+        return [text, label]
 
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Testbed not found.")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 @router.get("/mage/sample")
-def sample_testbed_data(file_path: str):
+def sample_testbed_data(file_path: str, label: Optional[int] = None, stratify: Optional[str] = None):
     """
     Sample a single data point from a testbed file.
 
     - `file_path`: The full relative path to the testbed file.
+    - `label`: Only sample records with this label (0 for machine-generated, 1 for human-written).
+    - `stratify`: "label" or "length" to pick a label or length bucket uniformly before picking a record.
     """
     label2decisions = {
         0: "machine-generated",
@@ -133,9 +159,12 @@ def sample_testbed_data(file_path: str):
     # Construct the full file path
     testbed_path = os.path.join(base_dir, file_path)
 
+    if stratify not in (None, "label", "length"):
+        raise HTTPException(status_code=400, detail="stratify must be 'label' or 'length'.")
+
     # Sample data
     try:
-        text, label = sample_data_from_testbed(testbed_path)
+        text, label = sample_data_from_testbed(testbed_path, label=label, stratify=stratify)
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -0,0 +1,267 @@
+"""
+Offline evaluation of the engines on the MAGE testbeds.
+
+Streams every CSV under the testbeds directory, scores the texts in batches across a pool of worker
+processes and writes accuracy per testbed file and per text-length bucket, together with throughput
+and batch latency figures, to the output directory. Texts are scored in batches, so latencies are measured
+per batch rather than per text.
+
+    python -m backend.evaluation --engines longformer finetuned --workers 2 --output-dir evaluation
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import importlib
+import json
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from logging import getLogger
+
+from backend.data.index import length_bucket
+from backend.data.view import TESTBEDS_DIR
+
+logger = getLogger(__name__)
+
+# Engine name -> (module, class) loaded in each worker process
+ENGINES = {
+    "longformer": ("backend.longformer.service", "InferenceEngine"),
+    "finetuned": ("backend.finetuned.service", "InferenceEngine"),
+    "watermark": ("backend.watermark.service", "InferenceEngine"),
+}
+
+# Testbed labels
+LABEL2DECISIONS = {
+    0: "machine-generated",
+    1: "human-written",
+}
+
+def iter_testbed_files(base_dir: str):
+    """Relative paths of all testbed CSV files under `base_dir`, in a stable order."""
+    for root, dirs, files in os.walk(base_dir):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith(".csv"):
+                yield os.path.relpath(os.path.join(root, file), base_dir)
+
+
+def iter_records(path: str):
+    """Stream the (text, label) records of a testbed CSV, skipping the header and malformed rows."""
+    with open(path, newline="") as file:
+        for row in csv.reader(file):
+            if len(row) < 2:
+                continue
+            try:
+                label = int(row[-1])
+            except ValueError:
+                continue  # header
+            yield ",".join(row[:-1]), label
+
+
+def iter_batches(base_dir: str, batch_size: int, limit: int | None = None):
+    """Yield (file_path, texts, labels) batches over all testbed files, at most `limit` records per file."""
+    for file_path in iter_testbed_files(base_dir):
+        texts, labels = [], []
+        for count, (text, label) in enumerate(iter_records(os.path.join(base_dir, file_path))):
+            if limit is not None and count >= limit:
+                break
+            texts.append(text)
+            labels.append(label)
+            if len(texts) == batch_size:
+                yield file_path, texts, labels
+                texts, labels = [], []
+        if texts:
+            yield file_path, texts, labels
+
+
+# Engines loaded in the current worker process
+_worker_engines = {}
+
+
+def load_engine(module_name: str, class_name: str, **kwargs):
+    return getattr(importlib.import_module(module_name), class_name)(**kwargs)
+
+
+def _init_worker(engine_specs: list[tuple[str, str, str]], num_threads: int) -> None:
+    import torch
+
+    # Share the cores between the workers instead of letting every worker use all of them
+    torch.set_num_threads(num_threads)
+    for engine_name, module_name, class_name in engine_specs:
+        _worker_engines[engine_name] = load_engine(module_name, class_name)
+
+
+def _score_batch(file_path: str, texts: list[str], labels: list[int]) -> dict:
+    from backend.longformer.models import DetectionRequest
+
+    detection_requests = [DetectionRequest(text=text) for text in texts]
+    predictions, seconds = {}, {}
+    for engine_name, engine in _worker_engines.items():
+        start = time.perf_counter()
+        try:
+            responses = engine.predict_batch(detection_requests)
+            predictions[engine_name] = [response.label for response in responses]
+        except Exception as e:
+            logger.warning(f"{engine_name} failed on a batch of {file_path}: {str(e)}")
+            predictions[engine_name] = [None] * len(texts)
+        seconds[engine_name] = time.perf_counter() - start
+    return {
+        "file_path": file_path,
+        "labels": labels,
+        "num_tokens": [len(text.split()) for text in texts],
+        "predictions": predictions,
+        "seconds": seconds,
+    }
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+class EngineReport:
+    """Accumulates the results of one engine."""
+
+    def __init__(self):
+        self.per_testbed = defaultdict(lambda: [0, 0])  # file_path -> [correct, total]
+        self.per_length = defaultdict(lambda: [0, 0])  # bucket -> [correct, total]
+        self.failed = 0
+        self.texts = 0
+        self.tokens = 0
+        self.busy_seconds = 0.0
+        self.batch_latencies = []  # seconds per scored batch
+
+    def add(self, batch: dict, engine_name: str) -> None:
+        elapsed = batch["seconds"][engine_name]
+        size = len(batch["labels"])
+        self.texts += size
+        self.tokens += sum(batch["num_tokens"])
+        self.busy_seconds += elapsed
+        self.batch_latencies.append(elapsed)
+        for label, prediction, num_tokens in zip(batch["labels"], batch["predictions"][engine_name], batch["num_tokens"]):
+            if prediction is None:
+                self.failed += 1
+                continue
+            correct = int(prediction == LABEL2DECISIONS.get(label))
+            for counts in (self.per_testbed[batch["file_path"]], self.per_length[length_bucket(num_tokens)]):
+                counts[0] += correct
+                counts[1] += 1
+
+    def summary(self) -> dict:
+        def accuracy(counts):
+            return {"accuracy": counts[0] / counts[1] if counts[1] else None, "count": counts[1]}
+
+        correct = sum(counts[0] for counts in self.per_testbed.values())
+        total = sum(counts[1] for counts in self.per_testbed.values())
+        return {
+            "accuracy": correct / total if total else None,
+            "count": total,
+            "failed": self.failed,
+            "per_testbed": {file_path: accuracy(counts) for file_path, counts in sorted(self.per_testbed.items())},
+            "per_length": {bucket: accuracy(counts) for bucket, counts in self.per_length.items()},
+            "throughput": {
+                # per worker, measured over the time the engine was busy
+                "texts_per_s": self.texts / self.busy_seconds if self.busy_seconds else None,
+                "tokens_per_s": self.tokens / self.busy_seconds if self.busy_seconds else None,
+            },
+            # time to score a whole batch, every text of a batch waits for the batch to finish
+            "batch_latency_ms": {
+                f"p{q}": percentile(self.batch_latencies, q) * 1000 if self.batch_latencies else None
+                for q in (50, 90, 95, 99)
+            },
+        }
+
+
+def write_reports(output_dir: str, summary: dict) -> None:
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "summary.json"), "w") as file:
+        json.dump(summary, file, indent=2)
+    with open(os.path.join(output_dir, "accuracy_by_testbed.csv"), "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["engine", "testbed", "accuracy", "count"])
+        for engine_name, report in summary["engines"].items():
+            for file_path, row in report["per_testbed"].items():
+                writer.writerow([engine_name, file_path, row["accuracy"], row["count"]])
+    with open(os.path.join(output_dir, "accuracy_by_length.csv"), "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["engine", "length_bucket", "accuracy", "count"])
+        for engine_name, report in summary["engines"].items():
+            for bucket, row in report["per_length"].items():
+                writer.writerow([engine_name, bucket, row["accuracy"], row["count"]])
+
+
+def evaluate(
+    engine_names: list[str],
+    testbeds_dir: str = TESTBEDS_DIR,
+    workers: int = 1,
+    batch_size: int = 16,
+    limit: int | None = None,
+) -> dict:
+    """Score the testbeds with the given engines and return the summary."""
+    reports = {engine_name: EngineReport() for engine_name in engine_names}
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    # spawn, so that workers do not inherit torch thread pools from the parent
+    context = multiprocessing.get_context("spawn")
+    start = time.perf_counter()
+    engine_specs = [(engine_name, *ENGINES[engine_name]) for engine_name in engine_names]
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(engine_specs, num_threads)) as pool:
+        batches = iter_batches(testbeds_dir, batch_size, limit)
+        pending = set()
+        # keep a bounded number of batches in flight, so testbeds are streamed instead of read up front
+        while True:
+            for file_path, texts, labels in batches:
+                pending.add(pool.submit(_score_batch, file_path, texts, labels))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = future.result()
+                for engine_name, report in reports.items():
+                    report.add(batch, engine_name)
+    wall_seconds = time.perf_counter() - start
+
+    texts = max((report.texts for report in reports.values()), default=0)
+    return {
+        "testbeds_dir": testbeds_dir,
+        "workers": workers,
+        "batch_size": batch_size,
+        "limit_per_file": limit,
+        "wall_seconds": wall_seconds,
+        "texts": texts,
+        "texts_per_s": texts / wall_seconds if wall_seconds else None,
+        "engines": {engine_name: report.summary() for engine_name, report in reports.items()},
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate the MACDET engines on the MAGE testbeds.")
+    parser.add_argument("--engines", nargs="+", choices=list(ENGINES), default=["longformer", "finetuned"])
+    parser.add_argument("--testbeds-dir", default=TESTBEDS_DIR)
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes, each loads every engine.")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of records per testbed file.")
+    parser.add_argument("--output-dir", default="evaluation")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    summary = evaluate(args.engines, args.testbeds_dir, args.workers, args.batch_size, args.limit)
+    write_reports(args.output_dir, summary)
+    for engine_name, report in summary["engines"].items():
+        print(f"{engine_name}: accuracy={report['accuracy']} texts/s={report['throughput']['texts_per_s']} "
+              f"batch p50={report['batch_latency_ms']['p50']}ms p99={report['batch_latency_ms']['p99']}ms")
+    print(f"Wrote reports to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
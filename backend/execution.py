@@ -0,0 +1,149 @@
+"""
+Execution backends of the classifier engines.
+
+A backend runs a sequence classification model on padded input ids and returns its logits, always in eval and
+inference mode:
+
+* eager runs the HuggingFace module as is.
+* compile runs it through torch.compile with dynamic shapes.
+* trace pads every batch to the next warmup length and runs a TorchScript trace of the model per (batch size,
+  length), so inputs longer than the largest warmup length run eagerly.
+
+The compile and trace backends are warmed up over representative sequence lengths when the engine loads, so
+compilation and tracing do not hit the first requests. Eager execution has nothing to prepare per length, so it only
+runs one pass at the shortest length. A backend that fails to compile or trace falls back to eager and stays there.
+"""
+
+from __future__ import annotations
+
+import threading
+from logging import getLogger
+
+import torch
+
+logger = getLogger(__name__)
+
+
+class EagerBackend:
+    name = "eager"
+
+    def __init__(self, model, pad_token_id: int = 0):
+        self.model = model.eval()
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        with torch.inference_mode():
+            return self._forward(input_ids, attention_mask)
+
+    def _forward(self, input_ids, attention_mask):
+        return self._eager(input_ids, attention_mask)
+
+    def _eager(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+
+    def warmup(self, lengths: list[int], token_id: int, batch_size: int = 1) -> None:
+        """Run the model once at the shortest length, which loads its kernels without a full pass per length."""
+        self._warmup(sorted(lengths)[:1], token_id, batch_size)
+
+    def _warmup(self, lengths: list[int], token_id: int, batch_size: int) -> None:
+        """Run the model once per sequence length, so later requests of these lengths do not pay any setup cost."""
+        parameter = next(self.model.parameters(), None)
+        device = parameter.device if parameter is not None else torch.device("cpu")
+        for length in sorted(lengths):
+            input_ids = torch.full((batch_size, length), token_id, dtype=torch.long, device=device)
+            self(input_ids, torch.ones_like(input_ids))
+
+
+class CompiledBackend(EagerBackend):
+    name = "compile"
+
+    def __init__(self, model, pad_token_id: int = 0):
+        super().__init__(model, pad_token_id)
+        try:
+            self._compiled = torch.compile(self.model, dynamic=True)
+        except Exception as e:
+            self._fall_back(e)
+
+    def warmup(self, lengths: list[int], token_id: int, batch_size: int = 1) -> None:
+        self._warmup(lengths, token_id, batch_size)
+
+    def _fall_back(self, e: Exception) -> None:
+        logger.warning(f"torch.compile failed, falling back to eager execution: {str(e)}")
+        self._compiled = None
+        self.name = "eager"
+
+    def _forward(self, input_ids, attention_mask):
+        if self._compiled is not None:
+            try:
+                return self._compiled(input_ids=input_ids, attention_mask=attention_mask).logits
+            except Exception as e:
+                self._fall_back(e)
+        return self._eager(input_ids, attention_mask)
+
+
+class _LogitsOnly(torch.nn.Module):
+    """Wraps a HuggingFace model so that it returns a plain logits tensor, which TorchScript can trace."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+
+class TracedBackend(EagerBackend):
+    name = "trace"
+
+    def __init__(self, model, pad_token_id: int = 0):
+        super().__init__(model, pad_token_id)
+        self.lengths = []
+        self._traces = {}  # (batch size, length) -> traced module
+        self._lock = threading.Lock()
+        self._failed = False
+
+    def warmup(self, lengths: list[int], token_id: int, batch_size: int = 1) -> None:
+        self.lengths = sorted(set(self.lengths) | set(lengths))
+        self._warmup(lengths, token_id, batch_size)
+
+    def _trace(self, input_ids, attention_mask):
+        key = tuple(input_ids.shape)
+        with self._lock:
+            if key not in self._traces:
+                # tracing records autograd-free ops under no_grad, inference tensors cannot be traced
+                with torch.inference_mode(False), torch.no_grad():
+                    self._traces[key] = torch.jit.trace(
+                        _LogitsOnly(self.model), (input_ids.clone(), attention_mask.clone()), check_trace=False
+                    )
+                logger.info(f"Traced the model for inputs of shape {key}.")
+            return self._traces[key]
+
+    def _forward(self, input_ids, attention_mask):
+        length = input_ids.shape[1]
+        target = next((bucket for bucket in self.lengths if bucket >= length), None)
+        if self._failed or target is None:
+            return self._eager(input_ids, attention_mask)
+        if target > length:
+            padding = target - length
+            input_ids = torch.nn.functional.pad(input_ids, (0, padding), value=self.pad_token_id)
+            attention_mask = torch.nn.functional.pad(attention_mask, (0, padding), value=0)
+        try:
+            return self._trace(input_ids, attention_mask)(input_ids, attention_mask)
+        except Exception as e:
+            logger.warning(f"Tracing failed, falling back to eager execution: {str(e)}")
+            self._failed = True
+            self.name = "eager"
+            return self._eager(input_ids[:, :length], attention_mask[:, :length])
+
+
+BACKENDS = {
+    "eager": EagerBackend,
+    "compile": CompiledBackend,
+    "trace": TracedBackend,
+}
+
+
+def make_backend(name: str, model, pad_token_id: int = 0) -> EagerBackend:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown execution backend '{name}'. Try one of {', '.join(BACKENDS)}.")
+    return BACKENDS[name](model, pad_token_id)
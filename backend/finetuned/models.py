@@ -3,10 +3,18 @@ from pydantic import BaseModel
 class DetectionRequest(BaseModel):
     text: str
 
+class ChunkScore(BaseModel):
+    start: int
+    end: int
+    label: str
+    confidence: float
+
 class DetectionResponse(BaseModel):
     label: str
     confidence: float
     logprobs: list
+    # Per-chunk scores, only set when the text was too long for a single forward pass
+    chunks: list[ChunkScore] | None = None
 
 class Error(BaseModel):
     message: str
@@ -0,0 +1,176 @@
+"""
+Lazily loaded, deduplicated models of the finetuned engine.
+
+Languages are mapped to model directories. Directories that resolve to the same path share a single model and
+tokenizer, and a model is only loaded when a text of one of its languages is first seen. With a memory budget,
+the least recently used models are evicted once the loaded models exceed it, and models that were not used for
+`idle_seconds` are evicted as well. Pinned languages are never evicted.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from logging import getLogger
+
+import torch
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+from backend.execution import make_backend
+from backend.quantization import quantize_dynamic_int8
+
+logger = getLogger(__name__)
+
+
+def model_key(model_dir: str) -> str:
+    """Identity of a model directory, so that aliases and symlinks of one directory share a model."""
+    if os.path.exists(model_dir):
+        return os.path.realpath(model_dir)
+    return model_dir  # a hub model id
+
+
+def _state_tensors(value):
+    # quantized layers keep their packed weight and bias as a tuple in the state dict
+    if isinstance(value, torch.Tensor):
+        yield value
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            yield from _state_tensors(item)
+
+
+def model_size(model) -> int:
+    """Memory held by the tensors of a model's state dict in bytes, including the int8 weights of quantized layers."""
+    sizes = {}
+    for value in model.state_dict(keep_vars=True).values():
+        for tensor in _state_tensors(value):
+            # tied weights appear under several names
+            sizes[tensor.data_ptr()] = tensor.numel() * tensor.element_size()
+    return sum(sizes.values())
+
+
+class LoadedModel:
+    def __init__(self, model, backend, tokenizer, size: int):
+        self.model = model
+        self.backend = backend
+        self.tokenizer = tokenizer
+        self.size = size
+        self.last_used = time.monotonic()
+
+
+class ModelRegistry:
+    def __init__(
+        self,
+        model_dirs: dict[str, str],
+        device: str = "cpu",
+        memory_budget_mb: float | None = None,
+        idle_seconds: float | None = None,
+        pinned: list[str] | tuple = (),
+        quantize: bool = False,
+        execution_backend: str = "eager",
+        warmup_lengths: list[int] | tuple = (),
+        load_model=None,
+    ):
+        self.model_dirs = dict(model_dirs)
+        self.device = device
+        self.memory_budget = memory_budget_mb * 2**20 if memory_budget_mb is not None else None
+        self.idle_seconds = idle_seconds
+        self.pinned = {model_key(self.model_dirs[lang]) for lang in pinned}
+        self.quantize = quantize
+        self.execution_backend = execution_backend
+        self.warmup_lengths = list(warmup_lengths)
+        self._load_model = load_model or self._from_pretrained
+        self._loaded = {}  # model key -> LoadedModel
+        self._key_locks = {}  # model key -> lock held while the model loads
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+
+    def __contains__(self, lang: str) -> bool:
+        return lang in self.model_dirs
+
+    def _from_pretrained(self, model_dir: str):
+        model = AutoModelForSequenceClassification.from_pretrained(model_dir).to(self.device)
+        model.eval()
+        if self.quantize:
+            model = quantize_dynamic_int8(model, self.device)
+        return model, AutoTokenizer.from_pretrained(model_dir)
+
+    def get(self, lang: str):
+        """Return the (execution backend, tokenizer) of a language, loading it on first use."""
+        key = model_key(self.model_dirs[lang])
+        with self._lock:
+            loaded = self._loaded.get(key)
+            if loaded is not None:
+                loaded.last_used = time.monotonic()
+                self._evict_idle()
+                return loaded.backend, loaded.tokenizer
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Load outside the registry lock, so other languages are served meanwhile
+        with key_lock:
+            with self._lock:
+                loaded = self._loaded.get(key)
+            if loaded is None:
+                start = time.perf_counter()
+                model, tokenizer = self._load_model(self.model_dirs[lang])
+                backend = make_backend(self.execution_backend, model, tokenizer.pad_token_id)
+                backend.warmup(self.warmup_lengths, tokenizer.unk_token_id or 0)
+                loaded = LoadedModel(model, backend, tokenizer, model_size(model))
+                logger.info(f"Loaded {key} for '{lang}' ({loaded.size / 2**20:.0f} MiB) in {time.perf_counter() - start:.1f}s.")
+                with self._lock:
+                    self._loaded[key] = loaded
+                    self.loads += 1
+                    self._evict_over_budget(keep=key)
+                    self._evict_idle()
+        loaded.last_used = time.monotonic()
+        return loaded.backend, loaded.tokenizer
+
+    def preload(self, langs) -> None:
+        for lang in langs:
+            self.get(lang)
+
+    def loaded_models(self) -> list:
+        with self._lock:
+            return [loaded.model for loaded in self._loaded.values()]
+
+    @property
+    def memory(self) -> int:
+        return sum(loaded.size for loaded in self._loaded.values())
+
+    def _evict(self, key: str, reason: str) -> None:
+        # Requests that are running on the model keep their own reference, so it is freed once they are done
+        del self._loaded[key]
+        self.evictions += 1
+        logger.info(f"Evicted {key} ({reason}).")
+
+    def _evict_over_budget(self, keep: str) -> None:
+        if self.memory_budget is None:
+            return
+        candidates = sorted(
+            (key for key in self._loaded if key != keep and key not in self.pinned),
+            key=lambda key: self._loaded[key].last_used,
+        )
+        for key in candidates:
+            if self.memory <= self.memory_budget:
+                break
+            self._evict(key, "over memory budget")
+
+    def _evict_idle(self) -> None:
+        if self.idle_seconds is None:
+            return
+        now = time.monotonic()
+        for key in list(self._loaded):
+            if key not in self.pinned and now - self._loaded[key].last_used > self.idle_seconds:
+                self._evict(key, "idle")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "languages": {lang: model_key(model_dir) for lang, model_dir in self.model_dirs.items()},
+                "loaded": {key: loaded.size for key, loaded in self._loaded.items()},
+                "memory_bytes": self.memory,
+                "memory_budget_bytes": self.memory_budget,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
@@ -1,7 +1,10 @@
-from backend.finetuned.utils import preprocess, detect
-from transformers import AutoModelForSequenceClassification, AutoTokenizer
+from backend.finetuned.utils import preprocess, forward_batch, decide
+from backend import metrics
+from backend.batching import MicroBatcher, PaddingStats, run_bucketed
+from backend.chunking import chunk_text, aggregate_logits, chunk_scores
+from backend.finetuned.registry import ModelRegistry
 from backend.finetuned.models import DetectionRequest, DetectionResponse, Error
-from langdetect import detect as lang_detect, DetectorFactory, LangDetectException
+from backend.langid import detect_language, load_profiles
 from logging import getLogger
 import json
 # Conditionally import torch if available in the environment
@@ -13,64 +16,161 @@ except ImportError:
 
 logger = getLogger(__name__)
 
+config = {
+    # Longer texts are scored in overlapping windows of at most this many tokens
+    'max_tokens': 512,
+    'chunk_overlap': 64,
+    # Maximum number of inputs (texts or chunks of texts) scored in one forward pass
+    'max_chunk_batch_size': 8,
+    # Concurrent requests are gathered into batches of at most this many inputs, which are then split by
+    # language and by length bucket, so every forward pass is only padded to the longest input of its bucket
+    'max_batch_size': 32,
+    'max_wait_ms': 10,
+    'length_buckets': [32, 64, 128, 256, 512],
+    # Model directory of each language, languages sharing a directory share the loaded model
+    'model_dirs': {
+        "en": "models/bert-base-multilingual-cased-finetuned-en-text-davinci-003",
+        "es": "models/bert-base-multilingual-cased-finetuned-es-text-davinci-003",
+        "all": "models/bert-base-multilingual-cased-finetuned-en-text-davinci-003",
+        # "all": "models/roberta-large-openai-detector-finetuned-all-all"
+        # Add paths for more languages as needed
+    },
+    # Languages loaded at startup and never evicted, the others are loaded on first use
+    'preload': ["all"],
+    # Evict the least recently used language models once the loaded models exceed this size (None for no limit)
+    'memory_budget_mb': None,
+    # Evict language models that were not used for this long (None to keep them)
+    'idle_evict_seconds': None,
+    # Quantize the linear layers to int8 for faster CPU inference, see backend/quantization.py
+    'quantize': False,
+    # How the models are run: "eager", "compile" (torch.compile) or "trace" (TorchScript), see backend/execution.py
+    'execution_backend': 'eager',
+    # Sequence lengths a model's compile or trace backend is warmed up on when it loads (eager only runs the shortest),
+    # also the lengths inputs are padded to when traced
+    'warmup_lengths': [128, 256, 512],
+}
+
 class InferenceEngine:
-    def __init__(self):
+    def __init__(self, quantize: bool | None = None):
         """
         Initialize the inference engine with models for different languages.
+        `quantize` overrides config['quantize'].
         """
         self.device = "cuda" if torch_available and torch.cuda.is_available() else "cpu"
-        # Define model paths for each language
-        self.model_dirs = {
-            "en": "models/bert-base-multilingual-cased-finetuned-en-text-davinci-003",
-            "es": "models/bert-base-multilingual-cased-finetuned-es-text-davinci-003",
-            "all": "models/bert-base-multilingual-cased-finetuned-en-text-davinci-003"
-            # "all": "models/roberta-large-openai-detector-finetuned-all-all"
-            # Add paths for more languages as needed
-        }
-
-        # Load models and tokenizers for each language
-        logger.info(f"Loading {json.dumps(self.model_dirs)}")
-        self.models = {
-            lang: AutoModelForSequenceClassification.from_pretrained(model_dir).to(self.device)
-            for lang, model_dir in self.model_dirs.items()
-        }
-        self.tokenizers = {
-            lang: AutoTokenizer.from_pretrained(model_dir)
-            for lang, model_dir in self.model_dirs.items()
-        }
+        self.model_dirs = config['model_dirs']
 
         # Set the fallback language (all)
         self.default_lang = "all"
 
+        # Load the language profiles now rather than on the first request
+        load_profiles()
+
+        # Models are loaded on first use, only the preloaded ones are loaded here
+        logger.info(f"Model directories: {json.dumps(self.model_dirs)}")
+        self.registry = ModelRegistry(
+            self.model_dirs,
+            device=self.device,
+            memory_budget_mb=config['memory_budget_mb'],
+            idle_seconds=config['idle_evict_seconds'],
+            pinned=config['preload'],
+            quantize=config['quantize'] if quantize is None else quantize,
+            execution_backend=config['execution_backend'],
+            warmup_lengths=config['warmup_lengths'],
+        )
+        self.registry.preload(config['preload'])
+
+        self.padding_stats = PaddingStats()
+        self.batcher = MicroBatcher(
+            self._predict_inputs,
+            max_batch_size=config['max_batch_size'],
+            max_wait_ms=config['max_wait_ms'],
+            name="finetuned-batcher",
+        )
+
+    def _detect_language(self, inputs: str) -> str:
+        detected_lang = detect_language(inputs)
+        if detected_lang is None:
+            logger.debug("Language detection failed. Falling back to the default language.")
+            return self.default_lang
+
+        # Use default language model if the detected language is unsupported
+        if detected_lang not in self.registry:
+            logger.debug(f"Unsupported language '{detected_lang}'. Falling back to the default language.")
+            return self.default_lang
+        return detected_lang
+
+    def _predict_inputs(self, items: list[tuple[str, list[int]]]) -> list:
+        """
+        Return the logits of a batch of (language, input_ids) items. Items are grouped by language and length bucket,
+        and each group is padded only to its own longest input.
+        """
+        def process_group(lang, group):
+            backend, tokenizer = self.registry.get(lang)
+            metrics.batch_size.observe("finetuned", value=len(group))
+            metrics.tokens_total.inc("finetuned", amount=sum(len(input_ids) for _, input_ids in group))
+            with metrics.time_stage("finetuned", "forward"):
+                return list(forward_batch([input_ids for _, input_ids in group], tokenizer, backend, self.device))
+
+        return run_bucketed(
+            items,
+            group_key=lambda item: item[0],
+            length=lambda item: len(item[1]),
+            process_group=process_group,
+            boundaries=config['length_buckets'],
+            max_group_size=config['max_chunk_batch_size'],
+            padding_stats=self.padding_stats,
+        )
+
+    def normalize_text(self, text: str) -> str:
+        """The text as the model sees it, used to key cached results."""
+        return preprocess(text)
+
     def predict(self, detection_request: DetectionRequest) -> DetectionResponse:
         """
         Run inference on the input text and return a DetectionResponse.
         """
+        return self.predict_batch([detection_request])[0]
+
+    def predict_batch(self, detection_requests: list[DetectionRequest]) -> list[DetectionResponse]:
+        """
+        Run inference on several texts. All their chunks are queued at once, so they are batched together
+        with each other and with concurrent requests.
+        """
         if not torch_available:
             raise ImportError("torch is not available in the environment.")
-        
-        # Preprocess the text
-        inputs = preprocess(detection_request.text)
-
-        # Detect the language of the text
-        try:
-            detected_lang = lang_detect(inputs)
-            print(f"Detected language: {detected_lang}")
-        except LangDetectException:
-            print("Language detection failed. Falling back to default language: English.")
-            detected_lang = self.default_lang
+        documents = []
+        for detection_request in detection_requests:
+            # Preprocess the text
+            with metrics.time_stage("finetuned", "preprocess"):
+                inputs = preprocess(detection_request.text)
 
-        # Use default language model if the detected language is unsupported
-        if detected_lang not in self.models:
-            print(f"Unsupported language '{detected_lang}'. Falling back to default language: English.")
-            detected_lang = self.default_lang
+            # Route the input to the model and tokenizer of its language
+            with metrics.time_stage("finetuned", "langid"):
+                detected_lang = self._detect_language(inputs)
+            _, tokenizer = self.registry.get(detected_lang)
 
-        # Route the input to the appropriate model and tokenizer
-        model = self.models[detected_lang]
-        tokenizer = self.tokenizers[detected_lang]
+            # Perform inference over the chunks of the text
+            with metrics.time_stage("finetuned", "tokenize"):
+                chunks = chunk_text(inputs, tokenizer, config['max_tokens'], config['chunk_overlap'])
+            futures = self.batcher.submit_many([(detected_lang, chunk.input_ids) for chunk in chunks])
+            documents.append((chunks, futures))
+        metrics.texts_total.inc("finetuned", amount=len(detection_requests))
+        return [self._document_response(chunks, futures) for chunks, futures in documents]
 
-        # Perform inference
-        outputs = detect(inputs, tokenizer, model, self.device)
+    def _document_response(self, chunks, futures) -> DetectionResponse:
+        logits = torch.stack([future.result() for future in futures])
+        outputs = decide(aggregate_logits(chunks, logits))
+        if len(chunks) > 1:
+            outputs["chunks"] = chunk_scores(chunks, [decide(row) for row in logits])
         return DetectionResponse(
             **outputs
         )
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.batcher.queue_depth,
+            "padding": self.padding_stats.stats(),
+        }
+
+    def close(self):
+        self.batcher.close()
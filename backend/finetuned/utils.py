@@ -1,31 +1,13 @@
 import torch
-from cleantext import clean
+from backend.execution import EagerBackend
+from backend.preprocessing import preprocess as shared_preprocess
 from transformers import AutoTokenizer, AutoModelForSequenceClassification
 
 def preprocess(text):
     """
     Preprocess input text: removes unnecessary line breaks, normalizes punctuation, and cleans text.
     """
-    # Normalize line breaks
-    text = text.replace("\n", " ").replace("\\n", " ").strip()
-    
-    # Normalize text using cleantext library
-    text = clean(
-        text,
-        fix_unicode=True,
-        to_ascii=True,
-        lower=False,
-        no_line_breaks=True,
-        no_urls=True,
-        no_emails=True,
-        no_phone_numbers=True,
-        no_numbers=False,
-        no_digits=False,
-        no_currency_symbols=False,
-        no_punct=False,
-        lang="en"
-    )
-    return text
+    return shared_preprocess(text, "basic")
 
 def detect(input_text, tokenizer, model, device="cpu", th=-3.08583984375):
     """
@@ -33,23 +15,35 @@ def detect(input_text, tokenizer, model, device="cpu", th=-3.08583984375):
     """
     try:
         # Tokenize and prepare the input
-        inputs = tokenizer(input_text, return_tensors="pt", truncation=True, padding=True, max_length=512).to(device)
+        inputs = tokenizer(input_text, truncation=True, max_length=512)
+        logits = forward_batch([inputs["input_ids"]], tokenizer, EagerBackend(model, tokenizer.pad_token_id), device)
+        return decide(logits[0])
 
-        # Perform inference
-        outputs = model(**inputs)
-        logits = outputs.logits
+    except Exception as e:
+        return {"error": f"An error occurred during detection: {str(e)}"}
 
-        # Compute probabilities and determine the predicted class
-        probabilities = torch.softmax(logits, dim=1).squeeze()
-        predicted_class = torch.argmax(probabilities).item()
-        confidence = probabilities[predicted_class].item()
+def forward_batch(batch_input_ids, tokenizer, backend, device="cpu"):
+    """
+    Return the logits for a batch of tokenized inputs, padded to the longest one and masked out,
+    computed by an execution backend.
+    """
+    inputs = tokenizer.pad({"input_ids": batch_input_ids}, return_tensors="pt").to(device)
 
-        # Map the predicted class to the label
-        label_map = {1: "machine-generated", 0: "human-written"}
-        label = label_map.get(predicted_class, "unknown")
-        logprobs = probabilities.tolist()
-        logprobs.reverse()
-        return {"label": label, "confidence": confidence, "logprobs": logprobs}
+    # Perform inference
+    return backend(inputs["input_ids"], inputs["attention_mask"])
 
-    except Exception as e:
-        return {"error": f"An error occurred during detection: {str(e)}"}
+def decide(logits):
+    """
+    Turn the logits of a single input into a label, confidence and class probabilities.
+    """
+    # Compute probabilities and determine the predicted class
+    probabilities = torch.softmax(logits, dim=0)
+    predicted_class = torch.argmax(probabilities).item()
+    confidence = probabilities[predicted_class].item()
+
+    # Map the predicted class to the label
+    label_map = {1: "machine-generated", 0: "human-written"}
+    label = label_map.get(predicted_class, "unknown")
+    logprobs = probabilities.tolist()
+    logprobs.reverse()
+    return {"label": label, "confidence": confidence, "logprobs": logprobs}
@@ -1,10 +1,47 @@
 from backend.finetuned import router
 from backend.finetuned.models import DetectionRequest, DetectionResponse, Error
 from backend.models import EngineHub
+from backend.gateway import parse_batch_texts, stream_engine_batch, unavailable
+from fastapi.requests import Request
+from fastapi.responses import StreamingResponse
+import asyncio
 
 @router.post("/infer")
 async def infer(request: DetectionRequest) -> DetectionResponse | Error:
     engine = EngineHub.get("finetuned", None)
     if engine is None:
-        return Error(message="Engine not found.")
-    return engine.predict(request)
+        return Error(message=str(unavailable("finetuned")))
+    # predict waits on the micro-batcher, so it runs in a worker thread to let concurrent requests join a batch
+    return await asyncio.to_thread(engine.predict, request)
+
+@router.post("/infer/batch")
+async def infer_batch(request: Request):
+    """
+    Batch inference over a JSON {"texts": [...]} body or an NDJSON body of {"text": ...} lines.
+    Results are streamed back as NDJSON, one line per text in input order.
+    """
+    engine = EngineHub.get("finetuned", None)
+    if engine is None:
+        return Error(message=str(unavailable("finetuned")))
+    texts = await parse_batch_texts(request)
+    return StreamingResponse(stream_engine_batch("finetuned", texts), media_type="application/x-ndjson")
+
+@router.get("/models")
+async def model_stats():
+    """
+    Languages, loaded models and memory use of the model registry.
+    """
+    engine = EngineHub.get("finetuned", None)
+    if engine is None:
+        return Error(message=str(unavailable("finetuned")))
+    return engine.registry.stats()
+
+@router.get("/batching")
+async def batching_stats():
+    """
+    Queue depth and padding waste of the length-bucketed batches.
+    """
+    engine = EngineHub.get("finetuned", None)
+    if engine is None:
+        return Error(message=str(unavailable("finetuned")))
+    return engine.stats()
@@ -0,0 +1,350 @@
+"""
+In-process dispatch of detection requests to the engines registered in EngineHub.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import collections
+import json
+import time
+from logging import getLogger
+from typing import AsyncIterator
+
+from fastapi import HTTPException
+from fastapi.requests import Request
+from pydantic import ValidationError
+
+from backend import metrics, tracing
+from backend.longformer.models import DetectionRequest
+from backend.models import BatchDetectionRequest, EngineHub, EngineStates
+from backend.result_cache import get_result_cache, result_key
+
+logger = getLogger(__name__)
+
+# Engines queried by /inferAll, in the order they appear in the response
+ENGINE_NAMES = ["longformer", "finetuned", "watermark"]
+
+# Maximum time (in seconds) a single engine may take to answer one request
+ENGINE_TIMEOUTS = {
+    "longformer": 60.0,
+    "finetuned": 30.0,
+    "watermark": 60.0,
+}
+
+# Batch endpoints hand texts to the engines in groups of this size,
+# with at most this many groups being scored at the same time
+BATCH_GROUP_SIZE = 16
+MAX_GROUPS_IN_FLIGHT = 4
+
+# Weight of each engine in the fused /inferAll decision
+BASE_WEIGHTS = {
+    "longformer": 1.2,
+    "finetuned": 1.0,
+    "watermark": 0.8,
+}
+
+
+class EngineUnavailable(Exception):
+    """Raised when the requested engine is not loaded in EngineHub."""
+
+
+def unavailable(engine_name: str) -> EngineUnavailable:
+    status = EngineStates.get(engine_name)
+    if status is not None and status.state in ("pending", "loading"):
+        return EngineUnavailable(f"Engine '{engine_name}' is still loading.")
+    if status is not None and status.state == "failed":
+        return EngineUnavailable(f"Engine '{engine_name}' failed to load: {status.error}")
+    return EngineUnavailable(f"Engine '{engine_name}' is not available.")
+
+
+def _lookup(engine_name: str, engine, texts: list[str]) -> tuple[list, list]:
+    """Cache keys of the texts and their cached results (None on a miss or when the cache is disabled)."""
+    cache = get_result_cache()
+    if cache is None:
+        return [None] * len(texts), [None] * len(texts)
+    keys = [result_key(engine_name, engine, text) for text in texts]
+    return keys, [cache.get(key) for key in keys]
+
+
+def _store(keys: list, results: list) -> None:
+    cache = get_result_cache()
+    if cache is None:
+        return
+    for key, result in zip(keys, results):
+        if key is not None and not isinstance(result, BaseException):
+            cache.put(key, result)
+
+
+async def run_engine(engine_name: str, detection_request, timeout: float | None = None) -> dict:
+    """
+    Run a single engine on the request in a worker thread, so that engines
+    can be queried concurrently without blocking the event loop.
+    Returns the JSON-ready response, from the result cache when the text was scored before.
+    """
+    start = time.perf_counter()
+    try:
+        result, outcome = await _run_engine(engine_name, detection_request, timeout)
+    except BaseException as e:
+        metrics.requests_total.inc(engine_name, _outcome(e))
+        raise
+    metrics.requests_total.inc(engine_name, outcome)
+    metrics.request_seconds.observe(engine_name, value=time.perf_counter() - start)
+    return result
+
+
+def _outcome(exc: BaseException) -> str:
+    if isinstance(exc, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(exc, EngineUnavailable):
+        return "unavailable"
+    return "error"
+
+
+async def _run_engine(engine_name: str, detection_request, timeout: float | None) -> tuple[dict, str]:
+    engine = EngineHub.get(engine_name, None)
+    if engine is None:
+        raise unavailable(engine_name)
+    if timeout is None:
+        timeout = ENGINE_TIMEOUTS.get(engine_name)
+    with metrics.time_stage(engine_name, "cache_lookup"):
+        keys, cached = await asyncio.to_thread(_lookup, engine_name, engine, [detection_request.text])
+    # requests claimed by an armed profiler capture skip the cache, so the engine actually runs
+    capture = tracing.captures.claim(engine_name)
+    if cached[0] is not None and capture is None:
+        return cached[0], "cache_hit"
+    # NOTE: on timeout the worker thread keeps running until the engine returns,
+    # only the caller stops waiting for it.
+    response = await asyncio.wait_for(asyncio.to_thread(_predict, engine, detection_request, capture), timeout)
+    result = response.model_dump(mode="json")
+    await asyncio.to_thread(_store, keys, [result])
+    return result, "ok"
+
+
+def _predict(engine, detection_request, capture: tuple[str, str] | None):
+    with tracing.profiling(capture, batched=hasattr(engine, "batcher")):
+        return engine.predict(detection_request)
+
+
+async def run_engine_batch(engine_name: str, detection_requests: list) -> list:
+    """
+    Run a single engine on a group of requests in a worker thread, only scoring the texts without a cached result.
+    If the group fails as a whole, the requests are retried one by one so that a single bad text only fails its own
+    entry. Returns JSON-ready responses, failed entries are returned as exceptions.
+    """
+    engine = EngineHub.get(engine_name, None)
+    if engine is None:
+        metrics.requests_total.inc(engine_name, "unavailable", amount=len(detection_requests))
+        raise unavailable(engine_name)
+    start = time.perf_counter()
+    keys, results = await asyncio.to_thread(
+        _lookup, engine_name, engine, [detection_request.text for detection_request in detection_requests]
+    )
+    misses = [i for i, result in enumerate(results) if result is None]
+    metrics.requests_total.inc(engine_name, "cache_hit", amount=len(results) - len(misses))
+    if not misses:
+        return results
+    missed_requests = [detection_requests[i] for i in misses]
+    timeout = ENGINE_TIMEOUTS.get(engine_name) * len(missed_requests)
+    try:
+        responses = await asyncio.wait_for(asyncio.to_thread(engine.predict_batch, missed_requests), timeout)
+        computed = [response.model_dump(mode="json") for response in responses]
+        metrics.requests_total.inc(engine_name, "ok", amount=len(computed))
+        metrics.request_seconds.observe(engine_name, value=time.perf_counter() - start)
+    except asyncio.TimeoutError:
+        metrics.requests_total.inc(engine_name, "timeout", amount=len(missed_requests))
+        raise
+    except Exception:
+        if len(missed_requests) == 1:
+            metrics.requests_total.inc(engine_name, "error")
+            raise
+        computed = await asyncio.gather(
+            *(run_engine(engine_name, detection_request) for detection_request in missed_requests),
+            return_exceptions=True,
+        )
+    for i, result in zip(misses, computed):
+        results[i] = result
+    await asyncio.to_thread(_store, [keys[i] for i in misses], computed)
+    return results
+
+
+def describe_error(engine_name: str, exc: BaseException) -> str:
+    """Turn an engine failure into a short message for the response."""
+    if isinstance(exc, asyncio.TimeoutError):
+        return f"Engine '{engine_name}' timed out after {ENGINE_TIMEOUTS.get(engine_name)}s."
+    if isinstance(exc, EngineUnavailable):
+        return str(exc)
+    return f"Engine '{engine_name}' failed: {str(exc)}"
+
+
+async def run_engines(engine_names: list[str], detection_request) -> tuple[dict, dict]:
+    """
+    Run several engines on the same request at the same time.
+
+    Returns the JSON-ready responses of all engines (None for the ones that failed)
+    and the error messages of the failed engines.
+    """
+    results = await asyncio.gather(
+        *(run_engine(engine_name, detection_request) for engine_name in engine_names),
+        return_exceptions=True,
+    )
+    responses, errors = {}, {}
+    for engine_name, result in zip(engine_names, results):
+        if isinstance(result, BaseException):
+            errors[engine_name] = describe_error(engine_name, result)
+            logger.warning(errors[engine_name])
+            responses[engine_name] = None
+        else:
+            responses[engine_name] = result
+    return responses, errors
+
+
+def _safe_normalize(prob_list):
+    total = sum(prob_list)
+    return [p / total for p in prob_list] if total > 0 else prob_list
+
+
+def get_distribution(data: dict) -> list[float]:
+    """Extract [p_machine, p_human] from an engine response."""
+    # If the model provides logprobs, we assume they're [p_machine, p_human]
+    # or near-probabilities that just need normalization.
+    if "logprobs" in data and isinstance(data["logprobs"], list):
+        return _safe_normalize(data["logprobs"])
+
+    # Otherwise, fall back to label+confidence
+    # We'll interpret "confidence" as belonging to the reported label.
+    # For example, if label="machine-generated" and confidence=0.9,
+    # then p_machine=0.9, p_human=0.1.
+    if "label" in data and "confidence" in data:
+        conf = data["confidence"]
+        if data["label"] == "machine-generated":
+            return [conf, 1 - conf]
+        return [1 - conf, conf]
+
+    # If nothing is valid, return a uniform guess
+    return [0.5, 0.5]
+
+
+def fuse(responses: dict) -> dict:
+    """
+    Combine the engine responses into a single weighted decision.
+    Engines without a response are left out of the fusion.
+    """
+    index_to_label = {0: "machine-generated", 1: "human-written"}
+
+    # Initialize combined distribution
+    fused_scores = [0.0, 0.0]  # [machine, human]
+    for engine_name, data in responses.items():
+        if data is None:
+            continue
+        w = BASE_WEIGHTS.get(engine_name, 1.0)
+        dist = get_distribution(data)
+        # Scale by the model's weight, then add to fused_scores
+        fused_scores[0] += dist[0] * w
+        fused_scores[1] += dist[1] * w
+
+    if fused_scores == [0.0, 0.0]:
+        # No engine answered, fall back to a uniform guess
+        fused_scores = [0.5, 0.5]
+    fused_scores = _safe_normalize(fused_scores)
+
+    # Pick the final label and confidence
+    final_index = 0 if fused_scores[0] > fused_scores[1] else 1
+    return {
+        "label": index_to_label[final_index],
+        "confidence": fused_scores[final_index],
+        "logprobs": fused_scores,
+    }
+
+
+async def parse_batch_texts(request: Request) -> list[str]:
+    """
+    Read the texts of a batch request, sent either as {"texts": [...]} or as
+    NDJSON with one {"text": ...} object per line.
+    """
+    body = await request.body()
+    content_type = request.headers.get("content-type", "")
+    try:
+        if "ndjson" in content_type or "jsonl" in content_type:
+            return [DetectionRequest.model_validate_json(line).text for line in body.splitlines() if line.strip()]
+        return BatchDetectionRequest.model_validate_json(body).texts
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid batch request: {str(e)}")
+
+
+async def _stream_groups(texts: list[str], score_group) -> AsyncIterator[str]:
+    """
+    Score the texts in groups, several groups at a time, and yield one NDJSON line per text
+    in input order. A group's lines are sent as soon as it and all groups before it are done.
+    """
+    groups = (
+        (start, texts[start : start + BATCH_GROUP_SIZE])
+        for start in range(0, len(texts), BATCH_GROUP_SIZE)
+    )
+    in_flight = collections.deque()
+
+    def schedule_next():
+        group = next(groups, None)
+        if group is not None:
+            in_flight.append(asyncio.create_task(score_group(*group)))
+
+    for _ in range(MAX_GROUPS_IN_FLIGHT):
+        schedule_next()
+    try:
+        while in_flight:
+            lines = await in_flight.popleft()
+            schedule_next()
+            for line in lines:
+                yield json.dumps(line) + "\n"
+    finally:
+        # the client went away, stop the groups that are still running
+        for task in in_flight:
+            task.cancel()
+
+
+def stream_engine_batch(engine_name: str, texts: list[str]) -> AsyncIterator[str]:
+    """NDJSON lines with one engine's response (or error) per text."""
+
+    async def score_group(start: int, group: list[str]) -> list[dict]:
+        try:
+            results = await run_engine_batch(engine_name, [DetectionRequest(text=text) for text in group])
+        except Exception as e:
+            results = [e] * len(group)
+        return [
+            {"index": start + i, "error": describe_error(engine_name, result)}
+            if isinstance(result, BaseException)
+            else {"index": start + i, **result}
+            for i, result in enumerate(results)
+        ]
+
+    return _stream_groups(texts, score_group)
+
+
+def stream_fused_batch(engine_names: list[str], texts: list[str]) -> AsyncIterator[str]:
+    """NDJSON lines with the responses of all engines and the fused decision per text, like /inferAll."""
+
+    async def score_group(start: int, group: list[str]) -> list[dict]:
+        detection_requests = [DetectionRequest(text=text) for text in group]
+        engine_results = await asyncio.gather(
+            *(run_engine_batch(engine_name, detection_requests) for engine_name in engine_names),
+            return_exceptions=True,
+        )
+        lines = []
+        for i in range(len(group)):
+            responses, errors = {}, {}
+            for engine_name, results in zip(engine_names, engine_results):
+                result = results if isinstance(results, BaseException) else results[i]
+                if isinstance(result, BaseException):
+                    errors[engine_name] = describe_error(engine_name, result)
+                    responses[engine_name] = None
+                else:
+                    responses[engine_name] = result
+            with metrics.time_stage("macdet", "fusion"):
+                fused = fuse(responses)
+            line = {"index": start + i, **responses, "macdet": fused}
+            if errors:
+                line["errors"] = errors
+            lines.append(line)
+        return lines
+
+    return _stream_groups(texts, score_group)
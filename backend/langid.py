@@ -0,0 +1,72 @@
+"""
+Language identification used to route texts to language-specific models.
+
+The langdetect profiles are loaded once, the detector is seeded so the same text is always assigned the same
+language, and only a bounded prefix of the text is looked at. Results are cached by the digest of that prefix,
+so every engine that routes by language shares the detection of a text.
+"""
+
+from __future__ import annotations
+
+import threading
+from logging import getLogger
+
+from langdetect.detector_factory import PROFILES_DIRECTORY, DetectorFactory
+from langdetect.lang_detect_exception import LangDetectException
+
+from backend.caching import LRUCache, text_digest
+
+logger = getLogger(__name__)
+
+config = {
+    # Number of leading characters the language is detected on
+    'max_chars': 1000,
+    # Seed of langdetect's sampling, which makes detection deterministic
+    'seed': 0,
+    'cache_size': 16384,
+}
+
+_factory = None
+_factory_lock = threading.Lock()
+_cache = LRUCache(max_entries=config['cache_size'])
+
+
+def load_profiles() -> DetectorFactory:
+    """Load the language profiles, only the first call does any work."""
+    global _factory
+    with _factory_lock:
+        if _factory is None:
+            factory = DetectorFactory()
+            factory.load_profile(PROFILES_DIRECTORY)
+            factory.set_seed(config['seed'])
+            _factory = factory
+            logger.info(f"Loaded {len(factory.get_lang_list())} language profiles.")
+        return _factory
+
+
+def text_prefix(text: str, max_chars: int) -> str:
+    """The first `max_chars` characters of the text, cut back to the last whitespace so no word is split."""
+    if len(text) <= max_chars:
+        return text
+    prefix = text[:max_chars]
+    cut = prefix.rfind(" ")
+    return prefix[:cut] if cut > 0 else prefix
+
+
+def _detect(prefix: str) -> str | None:
+    detector = load_profiles().create()
+    detector.append(prefix)
+    try:
+        return detector.detect()
+    except LangDetectException:
+        return None
+
+
+def detect_language(text: str) -> str | None:
+    """ISO 639-1 code of the text's language, None when it cannot be detected (e.g. no letters)."""
+    prefix = text_prefix(text, config['max_chars'])
+    return _cache.get_or_compute(text_digest(prefix), lambda: _detect(prefix))
+
+
+def cache_stats() -> dict:
+    return _cache.stats()
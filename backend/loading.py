@@ -0,0 +1,83 @@
+"""
+Concurrent loading of the engines at startup.
+
+Every engine is constructed in its own thread, and is added to EngineHub as soon as it is ready, so its routes
+serve traffic while the other engines are still loading. Load state and time of each engine are kept in
+EngineStates for the liveness and readiness endpoints.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from logging import getLogger
+from typing import Callable
+
+from backend.models import EngineHub, EngineStates, EngineStatus
+from backend.result_cache import engine_fingerprint
+
+logger = getLogger(__name__)
+
+# Set when the app shuts down, engines that finish loading afterwards are closed right away
+_shutting_down = threading.Event()
+_hub_lock = threading.Lock()
+
+
+def load_engine(engine_name: str, factory: Callable[[], object]) -> None:
+    status = EngineStates[engine_name]
+    status.state = "loading"
+    logger.info(f"Loading {engine_name}.")
+    start = time.perf_counter()
+    try:
+        engine = factory()
+        # fingerprinted once here rather than on every cache lookup
+        engine_fingerprint(engine)
+    except Exception as e:
+        status.state = "failed"
+        status.error = str(e)
+        status.load_seconds = time.perf_counter() - start
+        logger.exception(f"Failed to load {engine_name}.")
+        return
+    status.load_seconds = time.perf_counter() - start
+    with _hub_lock:
+        shutting_down = _shutting_down.is_set()
+        if not shutting_down:
+            EngineHub[engine_name] = engine
+            status.state = "ready"
+    if shutting_down:
+        if hasattr(engine, "close"):
+            engine.close()
+        return
+    logger.info(f"Loaded {engine_name} in {status.load_seconds:.1f}s.")
+
+
+def start_loading(factories: dict[str, Callable[[], object]]) -> list[asyncio.Task]:
+    """Start loading all engines in worker threads and return without waiting for them."""
+    _shutting_down.clear()
+    for engine_name in factories:
+        EngineStates[engine_name] = EngineStatus()
+    return [
+        asyncio.create_task(asyncio.to_thread(load_engine, engine_name, factory), name=f"load-{engine_name}")
+        for engine_name, factory in factories.items()
+    ]
+
+
+def close_engines() -> None:
+    """Close the loaded engines, and the ones still loading once they are done."""
+    with _hub_lock:
+        _shutting_down.set()
+        engines = list(EngineHub.values())
+        EngineHub.clear()
+    for engine in engines:
+        if hasattr(engine, "close"):
+            engine.close()
+
+
+def engine_statuses() -> dict:
+    return {engine_name: status.model_dump() for engine_name, status in EngineStates.items()}
+
+
+def is_ready(engine_names: list[str] | None = None) -> bool:
+    engine_names = list(EngineStates) if engine_names is None else engine_names
+    return all(engine_name in EngineHub for engine_name in engine_names)
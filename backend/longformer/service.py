@@ -1,4 +1,9 @@
-from backend.longformer.utils import preprocess, detect
+from backend.longformer.utils import preprocess, forward_batch, decide
+from backend import metrics
+from backend.batching import MicroBatcher
+from backend.chunking import chunk_text, aggregate_logits, chunk_scores
+from backend.execution import make_backend
+from backend.quantization import quantize_dynamic_int8
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
 import os
 from backend.longformer.models import DetectionRequest, DetectionResponse, Error
@@ -9,20 +14,85 @@ try:
 except ImportError:
     torch_available = False
 
+config = {
+    'model_dir': 'yaful/MAGE',
+    # Concurrent requests are gathered into batches of at most this many texts
+    'max_batch_size': 8,
+    # How long the first request of a batch waits for others to join it
+    'max_wait_ms': 10,
+    # Longer texts are scored in overlapping windows of at most this many tokens
+    'max_tokens': 4096,
+    'chunk_overlap': 256,
+    # Quantize the linear layers to int8 for faster CPU inference, see backend/quantization.py
+    'quantize': False,
+    # How the model is run: "eager", "compile" (torch.compile) or "trace" (TorchScript), see backend/execution.py
+    'execution_backend': 'eager',
+    # Sequence lengths the compile and trace backends are warmed up on at startup (eager only runs the shortest),
+    # also the lengths inputs are padded to when traced
+    'warmup_lengths': [512, 1024, 2048, 4096],
+}
 
 
 class InferenceEngine:
-    def __init__(self):
+    def __init__(self, quantize: bool | None = None):
+        """
+        `quantize` overrides config['quantize'].
+        """
         self.device = "cuda" if torch_available and torch.cuda.is_available() else "cpu"
-        self.model_dir = "yaful/MAGE"
+        self.model_dir = config['model_dir']
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_dir)
         self.model = AutoModelForSequenceClassification.from_pretrained(self.model_dir).to(self.device)
+        self.model.eval()
+        self.quantized = config['quantize'] if quantize is None else quantize
+        if self.quantized:
+            self.model = quantize_dynamic_int8(self.model, self.device)
+        self.backend = make_backend(config['execution_backend'], self.model, self.tokenizer.pad_token_id)
+        self.backend.warmup(config['warmup_lengths'], self.tokenizer.unk_token_id or 0)
+        self.batcher = MicroBatcher(
+            self._predict_batch,
+            max_batch_size=config['max_batch_size'],
+            max_wait_ms=config['max_wait_ms'],
+            name="longformer-batcher",
+        )
+
+    def _predict_batch(self, batch_input_ids: list[list[int]]) -> list:
+        metrics.batch_size.observe("longformer", value=len(batch_input_ids))
+        metrics.tokens_total.inc("longformer", amount=sum(len(input_ids) for input_ids in batch_input_ids))
+        with metrics.time_stage("longformer", "forward"):
+            return list(forward_batch(batch_input_ids, self.tokenizer, self.backend, self.device))
+
+    def normalize_text(self, text: str) -> str:
+        """The text as the model sees it, used to key cached results."""
+        return preprocess(text)
 
     def predict(self, detection_request: DetectionRequest) -> DetectionResponse:
+        return self.predict_batch([detection_request])[0]
+
+    def predict_batch(self, detection_requests: list[DetectionRequest]) -> list[DetectionResponse]:
+        """
+        Run inference on several texts. All their chunks are queued at once, so they are batched together.
+        """
         if not torch_available:
             raise ImportError("torch is not available in the environment.")
-        inputs = preprocess(detection_request.text)
-        outputs = detect(inputs, self.tokenizer, self.model, self.device)
+        documents = []
+        for detection_request in detection_requests:
+            with metrics.time_stage("longformer", "preprocess"):
+                inputs = preprocess(detection_request.text)
+            with metrics.time_stage("longformer", "tokenize"):
+                chunks = chunk_text(inputs, self.tokenizer, config['max_tokens'], config['chunk_overlap'])
+            # Chunks go through the batcher one by one, so they share batches with other requests
+            documents.append((chunks, self.batcher.submit_many([chunk.input_ids for chunk in chunks])))
+        metrics.texts_total.inc("longformer", amount=len(detection_requests))
+        return [self._document_response(chunks, futures) for chunks, futures in documents]
+
+    def _document_response(self, chunks, futures) -> DetectionResponse:
+        logits = torch.stack([future.result() for future in futures])
+        outputs = decide(aggregate_logits(chunks, logits))
+        if len(chunks) > 1:
+            outputs["chunks"] = chunk_scores(chunks, [decide(row) for row in logits])
         return DetectionResponse(
             **outputs
-        )
\ No newline at end of file
+        )
+
+    def close(self):
+        self.batcher.close()
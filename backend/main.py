@@ -1,6 +1,6 @@
 from __future__ import annotations
 from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi import HTTPException
@@ -9,37 +9,54 @@ from backend.data.view import router as data_router
 from backend.longformer.view import router as longformer_router
 from backend.finetuned.view import router as finetuned_router
 from backend.watermark.view import router as watermark_router
-from backend.data.view import get_available_testbeds
+from backend.data.view import get_available_testbeds, testbed_catalog
 from backend.longformer.models import DetectionRequest
 from backend.longformer.service import InferenceEngine as LongformerEngine
 from backend.finetuned.service import InferenceEngine as FinetunedEngine
-from backend.watermark.service import InferenceEngine as WatermarkEngine
-from langdetect import detect
 from contextlib import asynccontextmanager
+from backend import metrics, tracing
 from backend.models import EngineHub
+from backend.preprocessing import cache_stats as preprocessing_cache_stats
+from backend.result_cache import get_result_cache
+from backend.langid import cache_stats as langid_cache_stats
+from backend.loading import close_engines, engine_statuses, is_ready, start_loading
+from backend.gateway import ENGINE_NAMES, EngineUnavailable, describe_error, fuse, run_engine, run_engines
+from backend.gateway import parse_batch_texts, stream_fused_batch
 from logging import getLogger
 import ranx
-from ranx import Qrels, Run, fuse
+from ranx import Qrels, Run
 import os
 import json
-import httpx
+import asyncio
+import threading
 
 # Set up logging
 logger = getLogger(__name__)
 
+def WatermarkEngine():
+    # the watermark stack (scipy, the PRF table, the homoglyph data) is only imported by the process that loads it
+    from backend.watermark.service import InferenceEngine
+
+    return InferenceEngine()
+
+
+# Engines loaded at startup, in the order of ENGINE_NAMES
+ENGINE_FACTORIES = {
+    "longformer": LongformerEngine,
+    "finetuned": FinetunedEngine,
+    "watermark": WatermarkEngine,
+}
+
 # When the app starts, load the models
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Load the ML model
-    logger.info("Loading Longformer.")
-    EngineHub["longformer"] = LongformerEngine()
-    logger.info("Loading Bert.")
-    EngineHub["finetuned"] = FinetunedEngine()
-    logger.info("Loading Watermark.")
-    EngineHub["watermark"] = WatermarkEngine()
+    # Load the ML models concurrently, each engine serves requests as soon as it is loaded
+    app.state.loading_tasks = start_loading(ENGINE_FACTORIES)
+    # Precompute the testbed statistics without holding up startup
+    threading.Thread(target=testbed_catalog.warm, name="testbed-catalog", daemon=True).start()
     yield
     # Clean up the ML models and release the resources
-    EngineHub.clear()
+    close_engines()
 
 app = FastAPI(
     title="MACDET API",
@@ -61,6 +78,117 @@ app.mount("/static", StaticFiles(directory=os.path.join(os.path.dirname(__file__
 # Set up Jinja2 templates
 templates = Jinja2Templates(directory=os.path.join(os.path.dirname(__file__), "templates"))
 
+@app.get("/health/live")
+async def liveness():
+    """
+    The process is up and serving requests, whatever the state of the engines.
+    """
+    return {"status": "alive", "engines": engine_statuses()}
+
+
+@app.get("/health/ready")
+async def readiness(engine: str | None = None):
+    """
+    All engines (or only `engine`) are loaded. Answers 503 while they are still loading or failed to load.
+    """
+    engine_names = [engine] if engine else None
+    if engine and engine not in ENGINE_FACTORIES:
+        raise HTTPException(status_code=404, detail=f"Unknown engine '{engine}'.")
+    ready = is_ready(engine_names)
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "not ready", "engines": engine_statuses()},
+    )
+
+
+def collect_runtime_metrics():
+    """Queue depths, cache statistics, padding waste and engine states, read at scrape time."""
+    caches = {
+        "results": get_result_cache().stats() if get_result_cache() is not None else None,
+        "preprocessing": preprocessing_cache_stats(),
+        "langid": langid_cache_stats(),
+    }
+    greenlist_cache = getattr(EngineHub.get("watermark"), "greenlist_cache", None)
+    if greenlist_cache is not None:
+        caches["greenlist"] = greenlist_cache.stats()
+    caches = {name: stats for name, stats in caches.items() if stats is not None}
+    yield metrics.Gauge("macdet_cache_hit_ratio", "Hit ratio of a cache.", [({"cache": name}, stats["hit_ratio"]) for name, stats in caches.items()])
+    yield metrics.Gauge("macdet_cache_size", "Number of entries in a cache.", [({"cache": name}, stats["size"]) for name, stats in caches.items()])
+
+    queue_depths = [
+        ({"engine": engine_name}, engine.batcher.queue_depth)
+        for engine_name, engine in list(EngineHub.items())
+        if hasattr(engine, "batcher")
+    ]
+    yield metrics.Gauge("macdet_queue_depth", "Inputs waiting in an engine's batching queue.", queue_depths)
+
+    padding_stats = getattr(EngineHub.get("finetuned"), "padding_stats", None)
+    if padding_stats is not None:
+        yield metrics.Gauge(
+            "macdet_padding_waste", "Share of padding in the positions run through the model.",
+            [({"engine": "finetuned"}, padding_stats.stats()["padding_waste"])],
+        )
+
+    states = engine_statuses()
+    yield metrics.Gauge("macdet_engine_ready", "Whether an engine is loaded and serving.", [({"engine": name}, float(status["state"] == "ready")) for name, status in states.items()])
+    yield metrics.Gauge("macdet_engine_load_seconds", "Time it took to load an engine.", [({"engine": name}, status["load_seconds"]) for name, status in states.items()])
+
+
+metrics.register_collector(collect_runtime_metrics)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """
+    Stage latencies, request outcomes, batch sizes, token counters, queue depths and cache hit ratios
+    in the Prometheus text format.
+    """
+    # collectors read cache and queue statistics, which must not hold up the event loop
+    return PlainTextResponse(await asyncio.to_thread(metrics.render), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/cache")
+async def cache_stats():
+    """
+    Hit ratio and size of the detection result, preprocessing and language identification caches.
+    """
+    result_cache = get_result_cache()
+    return {
+        "results": result_cache.stats() if result_cache is not None else None,
+        "preprocessing": preprocessing_cache_stats(),
+        "langid": langid_cache_stats(),
+    }
+
+
+@app.post("/admin/profile")
+async def arm_profiler(request: Request):
+    """
+    Profile the next `requests` requests of `engine` with `profiler` ("torch" or "cprofile"), the traces are
+    written to the profile directory. `requests: 0` cancels a pending capture.
+    """
+    payload = await request.json()
+    engine = payload.get("engine")
+    if engine not in ENGINE_FACTORIES:
+        raise HTTPException(status_code=404, detail=f"Unknown engine '{engine}'.")
+    requests = int(payload.get("requests", 1))
+    if requests <= 0:
+        tracing.captures.disarm(engine)
+    else:
+        try:
+            tracing.captures.arm(engine, requests, payload.get("profiler", "torch"))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return {"armed": tracing.captures.status(), "profile_dir": tracing.config['profile_dir']}
+
+
+@app.get("/admin/profile")
+async def profiler_status():
+    """
+    Pending profiler captures per engine and the profile directory their traces are written to.
+    """
+    return {"armed": tracing.captures.status(), "profile_dir": tracing.config['profile_dir']}
+
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     """
@@ -105,10 +233,15 @@ async def read_root(request: Request):
         # print(f"Unexpected error occurred: {exc}")
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(exc)}")
 
+def wants_trace(request: Request, payload: dict) -> bool:
+    """Whether the client asked for the stage timings, with `"trace": true` or the X-MACDET-Trace header."""
+    return bool(payload.get("trace")) or request.headers.get("x-macdet-trace", "").lower() in ("1", "true")
+
+
 @app.post("/infer")
 async def model_infer(request: Request):
     """
-    General inference endpoint that forwards the request to the appropriate model's inference endpoint.
+    General inference endpoint that dispatches the request to the selected model's engine.
     """
     try:
         # Parse the request body to extract model and data
@@ -116,28 +249,24 @@ async def model_infer(request: Request):
         model_name = payload.get("model")
         if not model_name:
             raise HTTPException(status_code=400, detail="Model name is required in the request payload.")
-        
-        # Build the target URL for the model's inference endpoint
-        target_url = f"http://127.0.0.1:8000/{model_name}/infer"
-
-        print(target_url)
-        print(payload)
+        if model_name not in ENGINE_NAMES:
+            raise HTTPException(status_code=404, detail=f"Unknown model '{model_name}'.")
 
         # Compile the detectionRequest
         detection_request = DetectionRequest(text=payload.get("text"))
 
-        # Forward the request to the selected model's endpoint
-        async with httpx.AsyncClient() as client:
-            response = await client.post(target_url, json=detection_request.model_dump(mode="json"))
-
-        print(response.status_code)
-        # Handle the response from the model's endpoint
-        if response.status_code == 200:
-            return response.json()
-        elif response.status_code == 307:
-            raise HTTPException(status_code=307, detail="The model is not available.")
-        else:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
+        # Run the selected engine in-process
+        trace = tracing.start_trace() if wants_trace(request, payload) else None
+        response = await run_engine(model_name, detection_request)
+        if trace is not None:
+            response = {**response, "trace": trace.summary()}
+        return response
+    except HTTPException as http_exc:
+        raise http_exc
+    except EngineUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except asyncio.TimeoutError as e:
+        raise HTTPException(status_code=504, detail=describe_error(model_name, e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
@@ -145,7 +274,8 @@ async def model_infer(request: Request):
 @app.post("/inferAll")
 async def general_infer(request: Request):
     """
-    General inference endpoint that forwards the request to all models' inference endpoints.
+    General inference endpoint that runs all models' engines concurrently and fuses their decisions.
+    Engines that fail or time out are reported under "errors" and left out of the fusion.
     """
     try:
         # Parse the request body to extract the text
@@ -153,34 +283,17 @@ async def general_infer(request: Request):
         text = payload.get("text")
         if not text:
             raise HTTPException(status_code=400, detail="Text is required in the request payload.")
-        
-        # List of model names to query
-        model_names = ["longformer", "finetuned", "watermark"]
+
+        trace = tracing.start_trace() if wants_trace(request, payload) else None
 
         # Run all model inferences concurrently
-        payloads = [{"model": model_name, "text": text} for model_name in model_names]
-        responses = []
-        async with httpx.AsyncClient() as client:
-            for model_name, payload in zip(model_names, payloads):
-                target_url = f"http://127.0.0.1:8000/{model_name}/infer"
-                response = await client.post(target_url, json=payload)
-                responses.append(response)
-                print(response.status_code)
-                if response.status_code == 200:
-                    print(response.json())
-                elif response.status_code == 307:
-                    print("The model is not available.")
-                else:
-                    print(response.text)
-
-        # Handle the responses from the models' endpoints
         # Example response should look like:
         # {
         #     "longformer": {
         #         "label": "machine-generated",
         #         "confidence": 0.89
         #     },
-        #     "bert": {
+        #     "finetuned": {
         #         "label": "human-written",
         #         "confidence": 0.92
         #     },
@@ -190,77 +303,26 @@ async def general_infer(request: Request):
         #         "text": "This is a watermarked sample text."
         #     }
         # }
-        response = {
-            model_name: r.json() if r.status_code == 200 else None
-            for model_name, r in zip(model_names, responses)
-        }
-        
-        base_weights = {
-            "longformer": 1.2,
-            "finetuned": 1.0,
-            "watermark": 0.8
-        }
+        response, errors = await run_engines(ENGINE_NAMES, DetectionRequest(text=text))
 
-        # Label <-> index mapping for a 2-class problem
-        label_to_index = {"machine-generated": 0, "human-written": 1}
-        index_to_label = {0: "machine-generated", 1: "human-written"}
-
-        # Initialize combined distribution
-        fused_scores = [0.0, 0.0]  # [machine, human]
-
-        # A helper to ensure numeric stability in case we need to softmax
-        # (Optional if your logprobs already sum to 1.0, but included for safety.)
-        def _safe_normalize(prob_list):
-            total = sum(prob_list)
-            return [p / total for p in prob_list] if total > 0 else prob_list
-
-        # A helper to extract [p_machine, p_human] from each model response
-        def get_distribution(model_name: str, data: dict) -> list[float]:
-            # If the model provides logprobs, we assume they're [p_machine, p_human]
-            # or near-probabilities that just need normalization.
-            if "logprobs" in data and isinstance(data["logprobs"], list):
-                probs = _safe_normalize(data["logprobs"])
-                return probs
-            
-            # Otherwise, fall back to label+confidence
-            # We'll interpret "confidence" as belonging to the reported label.
-            # For example, if label="machine-generated" and confidence=0.9,
-            # then p_machine=0.9, p_human=0.1.
-            if "label" in data and "confidence" in data:
-                label = data["label"]
-                conf = data["confidence"]
-                if label == "machine-generated":
-                    return [conf, 1 - conf]  # [p_machine, p_human]
-                else:
-                    return [1 - conf, conf]  # [p_machine, p_human]
-
-            # If nothing is valid, return a uniform guess
-            return [0.5, 0.5]
-
-        # For each model, pull out a probability distribution and multiply by its weight
-        for model_name in ["longformer", "finetuned", "watermark"]:
-            model_data = response.get(model_name, {})
-            w = base_weights.get(model_name, 1.0)
-            dist = get_distribution(model_name, model_data)
-            # Scale by the model's weight, then add to fused_scores
-            fused_scores[0] += dist[0] * w
-            fused_scores[1] += dist[1] * w
-
-        # Normalize the fused distribution
-        fused_scores = _safe_normalize(fused_scores)
-
-        # Pick the final label and confidence
-        final_index = 0 if fused_scores[0] > fused_scores[1] else 1
-        final_label = index_to_label[final_index]
-        final_confidence = fused_scores[final_index]
-
-        response["macdet"] = {
-            "label": final_label,
-            "confidence": final_confidence,
-            "logprobs": fused_scores
-        }
+        with metrics.time_stage("macdet", "fusion"):
+            response["macdet"] = fuse(response)
+        if errors:
+            response["errors"] = errors
+        if trace is not None:
+            response["trace"] = trace.summary()
         return response
+    except HTTPException as http_exc:
+        raise http_exc
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
-        
\ No newline at end of file
+
+@app.post("/inferAll/batch")
+async def general_infer_batch(request: Request):
+    """
+    Batch version of /inferAll over a JSON {"texts": [...]} body or an NDJSON body of {"text": ...} lines.
+    Results are streamed back as NDJSON, one line per text in input order.
+    """
+    texts = await parse_batch_texts(request)
+    return StreamingResponse(stream_fused_batch(ENGINE_NAMES, texts), media_type="application/x-ndjson")
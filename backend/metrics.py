@@ -0,0 +1,195 @@
+"""
+Process metrics in the Prometheus text exposition format, served on /metrics.
+
+Counters and histograms are updated by the engines and the gateway as requests go through them. Values that already
+live elsewhere (queue depths, cache statistics) are read at scrape time by collectors registered with
+`register_collector`.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from logging import getLogger
+from typing import Callable, Iterable
+
+from backend import tracing
+
+logger = getLogger(__name__)
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(ABC):
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", *self._samples()]
+
+    @abstractmethod
+    def _samples(self) -> list[str]:
+        """Exposition lines of every labelled series."""
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}" for labels, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, *labels, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=time.perf_counter() - start)
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = {labels: list(counts) for labels, counts in self._values.items()}
+        lines = []
+        for labels, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(counts[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {counts[-1]}")
+        return lines
+
+
+class Gauge:
+    """A sample read at scrape time, returned by collectors."""
+
+    def __init__(self, name: str, help: str, samples: Iterable[tuple[dict, float]]):
+        self.name = name
+        self.help = help
+        self.samples = list(samples)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for labels, value in self.samples:
+            if value is None:
+                continue
+            lines.append(f"{self.name}{_format_labels(tuple(labels), tuple(labels.values()))} {_format_value(value)}")
+        return lines
+
+
+_metrics = []
+_collectors = []
+
+
+def _register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+def register_collector(collector: Callable[[], Iterable[Gauge]]) -> None:
+    _collectors.append(collector)
+
+
+def render() -> str:
+    """All metrics in the Prometheus text format."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        try:
+            for gauge in collector():
+                lines.extend(gauge.render())
+        except Exception as e:
+            logger.warning(f"Metrics collector {getattr(collector, '__name__', collector)} failed: {str(e)}")
+    return "\n".join(lines) + "\n"
+
+
+# Time spent in each stage of an engine: preprocess, langid, tokenize, forward, ngram_scoring, fusion, ...
+stage_seconds = _register(Histogram(
+    "macdet_stage_seconds", "Time spent in one stage of an engine or of the gateway.", ("engine", "stage"),
+))
+# End-to-end time of a request to one engine as seen by the gateway, including queueing and cache lookups
+request_seconds = _register(Histogram(
+    "macdet_request_seconds", "Time to answer one request to an engine, as seen by the gateway.", ("engine",),
+))
+requests_total = _register(Counter(
+    "macdet_requests_total", "Texts answered by the gateway per engine and outcome.", ("engine", "outcome"),
+))
+batch_size = _register(Histogram(
+    "macdet_batch_size", "Number of inputs in one forward pass.", ("engine",), buckets=BATCH_SIZE_BUCKETS,
+))
+tokens_total = _register(Counter(
+    "macdet_tokens_total", "Tokens run through the model, rate() gives tokens/s.", ("engine",),
+))
+texts_total = _register(Counter(
+    "macdet_texts_total", "Texts scored by an engine, rate() gives texts/s.", ("engine",),
+))
+
+
+@contextmanager
+def time_stage(engine: str, stage: str):
+    """Time one stage of an engine, into the stage histogram and into the trace of the current request if any."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        stage_seconds.observe(engine, stage, value=seconds)
+        tracing.record(engine, stage, seconds)
@@ -1 +1,18 @@
-EngineHub = {}
\ No newline at end of file
+from __future__ import annotations
+
+from pydantic import BaseModel
+
+EngineHub = {}
+
+# Engine name -> EngineStatus, for every engine that is or was being loaded
+EngineStates = {}
+
+
+class BatchDetectionRequest(BaseModel):
+    texts: list[str]
+
+
+class EngineStatus(BaseModel):
+    state: str = "pending"  # pending, loading, ready or failed
+    load_seconds: float | None = None
+    error: str | None = None
@@ -0,0 +1,397 @@
+"""
+Text preprocessing shared by the engines.
+
+All substitution tables are compiled once at import, and the result of every pipeline is cached by text digest,
+so engines that see the same input do not clean it again.
+"""
+
+import re
+from itertools import chain
+from cleantext import clean
+from backend.caching import LRUCache, text_digest
+
+# Number of preprocessed texts kept per process
+PREPROCESS_CACHE_SIZE = 4096
+
+
+def _is_literal(pattern, substitution):
+    """Whether a regex substitution is a plain string replacement."""
+    return re.escape(pattern) == pattern and "\\" not in substitution
+
+
+def _compile_substitutions(substitutions):
+    """
+    Compile a table of (regexp, substitution) pairs. Consecutive pairs that replace a single character with a
+    plain string are merged into one str.translate table, as long as no replacement contains a character the
+    same table replaces, which gives the same result as applying them one by one with re.sub.
+    Other pairs without any regex syntax are applied with str.replace.
+    """
+    compiled = []
+    for pattern, substitution in substitutions:
+        if not _is_literal(pattern, substitution):
+            compiled.append((re.compile(pattern), substitution))
+        elif len(pattern) > 1:
+            compiled.append((pattern, substitution))
+        elif (
+            compiled
+            and isinstance(compiled[-1][0], dict)
+            and pattern not in compiled[-1][0]
+            and pattern not in "".join(compiled[-1][0].values())
+            and not any(character in substitution for character in compiled[-1][0])
+        ):
+            compiled[-1][0][pattern] = substitution
+        else:
+            compiled.append(({pattern: substitution}, None))
+    return [
+        (str.maketrans(pattern), None) if isinstance(pattern, dict) else (pattern, substitution)
+        for pattern, substitution in compiled
+    ]
+
+
+def _apply_substitutions(compiled_substitutions, text):
+    for pattern, substitution in compiled_substitutions:
+        if substitution is None:
+            text = text.translate(pattern)
+        elif isinstance(pattern, str):
+            text = text.replace(pattern, substitution)
+        else:
+            text = pattern.sub(substitution, text)
+    return text
+
+
+def _compile_replacements(stages):
+    """
+    Compile stages of plain string replacements into one alternation regex per stage. The replacements of a
+    stage do not feed into each other, so a single pass over the text gives the same result as chaining
+    str.replace over them in order.
+    """
+    return [
+        (re.compile("|".join(re.escape(old) for old in replacements)), replacements)
+        for replacements in stages
+    ]
+
+
+def _apply_replacements(compiled_stages, text):
+    for pattern, replacements in compiled_stages:
+        text = pattern.sub(lambda match: replacements[match.group()], text)
+    return text
+
+
+class MosesPunctNormalizer:
+    """
+    This is a Python port of the Moses punctuation normalizer from
+    https://github.com/moses-smt/mosesdecoder/blob/master/scripts/tokenizer/normalize-punctuation.perl
+    """
+
+    EXTRA_WHITESPACE = [  # lines 21 - 30
+        (r"\r", r""),
+        (r"\(", r" ("),
+        (r"\)", r") "),
+        (r" +", r" "),
+        (r"\) ([.!:?;,])", r")\g<1>"),
+        (r"\( ", r"("),
+        (r" \)", r")"),
+        (r"(\d) %", r"\g<1>%"),
+        (r" :", r":"),
+        (r" ;", r";"),
+    ]
+
+    NORMALIZE_UNICODE_IF_NOT_PENN = [(r"`", r"'"), (r"''", r' " ')]  # lines 33 - 34
+
+    NORMALIZE_UNICODE = [  # lines 37 - 50
+        ("„", r'"'),
+        ("“", r'"'),
+        ("”", r'"'),
+        ("–", r"-"),
+        ("—", r" - "),
+        (r" +", r" "),
+        ("´", r"'"),
+        ("([a-zA-Z])‘([a-zA-Z])", r"\g<1>'\g<2>"),
+        ("([a-zA-Z])’([a-zA-Z])", r"\g<1>'\g<2>"),
+        ("‘", r"'"),
+        ("‚", r"'"),
+        ("’", r"'"),
+        (r"''", r'"'),
+        ("´´", r'"'),
+        ("…", r"..."),
+    ]
+
+    FRENCH_QUOTES = [  # lines 52 - 57
+        ("\u00A0«\u00A0", r'"'),
+        ("«\u00A0", r'"'),
+        ("«", r'"'),
+        ("\u00A0»\u00A0", r'"'),
+        ("\u00A0»", r'"'),
+        ("»", r'"'),
+    ]
+
+    HANDLE_PSEUDO_SPACES = [  # lines 59 - 67
+        ("\u00A0%", r"%"),
+        ("nº\u00A0", "nº "),
+        ("\u00A0:", r":"),
+        ("\u00A0ºC", " ºC"),
+        ("\u00A0cm", r" cm"),
+        ("\u00A0\\?", "?"),
+        ("\u00A0\\!", "!"),
+        ("\u00A0;", r";"),
+        (",\u00A0", r", "),
+        (r" +", r" "),
+    ]
+
+    EN_QUOTATION_FOLLOWED_BY_COMMA = [(r'"([,.]+)', r'\g<1>"')]
+
+    DE_ES_FR_QUOTATION_FOLLOWED_BY_COMMA = [
+        (r',"', r'",'),
+        (r'(\.+)"(\s*[^<])', r'"\g<1>\g<2>'),  # don't fix period at end of sentence
+    ]
+
+    DE_ES_CZ_CS_FR = [
+        ("(\\d)\u00A0(\\d)", r"\g<1>,\g<2>"),
+    ]
+
+    OTHER = [
+        ("(\\d)\u00A0(\\d)", r"\g<1>.\g<2>"),
+    ]
+
+    # Regex substitutions from replace-unicode-punctuation.perl
+    # https://github.com/moses-smt/mosesdecoder/blob/master/scripts/tokenizer/replace-unicode-punctuation.perl
+    REPLACE_UNICODE_PUNCTUATION = [
+        ("，", ","),
+        (r"。\s*", ". "),
+        ("、", ","),
+        ("”", '"'),
+        ("“", '"'),
+        ("∶", ":"),
+        ("：", ":"),
+        ("？", "?"),
+        ("《", '"'),
+        ("》", '"'),
+        ("）", ")"),
+        ("！", "!"),
+        ("（", "("),
+        ("；", ";"),
+        ("」", '"'),
+        ("「", '"'),
+        ("０", "0"),
+        ("１", "1"),
+        ("２", "2"),
+        ("３", "3"),
+        ("４", "4"),
+        ("５", "5"),
+        ("６", "6"),
+        ("７", "7"),
+        ("８", "8"),
+        ("９", "9"),
+        (r"．\s*", ". "),
+        ("～", "~"),
+        ("’", "'"),
+        ("…", "..."),
+        ("━", "-"),
+        ("〈", "<"),
+        ("〉", ">"),
+        ("【", "["),
+        ("】", "]"),
+        ("％", "%"),
+    ]
+
+    def __init__(
+        self,
+        lang="en",
+        penn=True,
+        norm_quote_commas=True,
+        norm_numbers=True,
+        pre_replace_unicode_punct=False,
+        post_remove_control_chars=False,
+    ):
+        """
+        :param language: The two-letter language code.
+        :type lang: str
+        :param penn: Normalize Penn Treebank style quotations.
+        :type penn: bool
+        :param norm_quote_commas: Normalize quotations and commas
+        :type norm_quote_commas: bool
+        :param norm_numbers: Normalize numbers
+        :type norm_numbers: bool
+        """
+        self.substitutions = [
+            self.EXTRA_WHITESPACE,
+            self.NORMALIZE_UNICODE,
+            self.FRENCH_QUOTES,
+            self.HANDLE_PSEUDO_SPACES,
+        ]
+
+        if penn:  # Adds the penn substitutions after extra_whitespace regexes.
+            self.substitutions.insert(1, self.NORMALIZE_UNICODE_IF_NOT_PENN)
+
+        if norm_quote_commas:
+            if lang == "en":
+                self.substitutions.append(self.EN_QUOTATION_FOLLOWED_BY_COMMA)
+            elif lang in ["de", "es", "fr"]:
+                self.substitutions.append(self.DE_ES_FR_QUOTATION_FOLLOWED_BY_COMMA)
+
+        if norm_numbers:
+            if lang in ["de", "es", "cz", "cs", "fr"]:
+                self.substitutions.append(self.DE_ES_CZ_CS_FR)
+            else:
+                self.substitutions.append(self.OTHER)
+
+        self.substitutions = _compile_substitutions(chain(*self.substitutions))
+        self.unicode_punct_substitutions = _compile_substitutions(self.REPLACE_UNICODE_PUNCTUATION)
+
+        self.pre_replace_unicode_punct = pre_replace_unicode_punct
+        self.post_remove_control_chars = post_remove_control_chars
+
+    def normalize(self, text):
+        """
+        Returns a string with normalized punctuation.
+        """
+        # Optionally, replace unicode puncts BEFORE normalization.
+        if self.pre_replace_unicode_punct:
+            text = self.replace_unicode_punct(text)
+
+        # Actual normalization.
+        text = _apply_substitutions(self.substitutions, str(text))
+
+        # Optionally, replace unicode puncts BEFORE normalization.
+        if self.post_remove_control_chars:
+            text = self.remove_control_chars(text)
+
+        return text.strip()
+
+    def replace_unicode_punct(self, text):
+        return _apply_substitutions(self.unicode_punct_substitutions, str(text))
+
+    def remove_control_chars(self, text):
+        return re.sub(r"\p{C}", "", text)
+
+# MAGE detokenization, in the order the replacements were chained with str.replace. Each stage groups the
+# replacements that cannot create or break a match of another one in the same stage.
+_TOKENIZATION_NORM = _compile_replacements([
+    {' ,': ',', ' .': '.', ' ?': '?', ' !': '!', ' ;': ';', ' \'': '\''},
+    {' ’ ': '\'', ' :': ':', '<newline>': '\n'},
+    {'`` ': '"', ' \'\'': '"', '\'\'': '"'},
+    {'.. ': '... '},
+    {' )': ')', '( ': '(', ' n\'t': 'n\'t'},
+    {' i ': ' I '},
+    {' i\'': ' I\'', '\\\'': '\''},
+    {'\n ': '\n'},
+])
+
+
+def _tokenization_norm(text):
+    return _apply_replacements(_TOKENIZATION_NORM, text).strip()
+
+
+_PLM_SPECIAL_TOKENS = re.compile(r'(\<pad\>)|(\<s\>)|(\<\/s\>)|(\<unk\>)|(\<\|endoftext\|\>)')
+# keep common puncts only
+_PUNCT_PATTERN = re.compile(r'[^ A-Za-z0-9.?!,:;\-\[\]\{\}\(\)\'\"]')
+# remove specific patterns
+_SPE_PATTERN = re.compile(r'[-\[\]\{\}\(\)\'\"]{2,}')
+_REPEATED_LINE_BREAKS = re.compile(r'(?:\\n)*\\n')
+_SHORT_FIRST_LINE = re.compile(r'^.{0,3}\\n')
+
+_moses_normalizer = MosesPunctNormalizer()
+
+
+def _clear_text(text):
+    # remove PLM special tokens
+    text = _PLM_SPECIAL_TOKENS.sub("", text)
+
+    # normalize puncuations
+    text = _moses_normalizer.normalize(text)
+    
+    # normalize tokenization
+    text = _tokenization_norm(text)
+    
+    # remove specific text patterns, e.g,, url, email and phone number
+    text = clean(text,
+        fix_unicode=True,               # fix various unicode errors
+        to_ascii=True,                  # transliterate to closest ASCII representation
+        lower=False,                     # lowercase text
+        no_line_breaks=True,           # fully strip line breaks as opposed to only normalizing them
+        no_urls=True,                  # replace all URLs with a special token
+        no_emails=True,                # replace all email addresses with a special token
+        no_phone_numbers=True,         # replace all phone numbers with a special token
+        no_numbers=False,               # replace all numbers with a special token
+        no_digits=False,                # replace all digits with a special token
+        no_currency_symbols=False,      # replace all currency symbols with a special token
+        no_punct=False,                 # remove punctuations
+        replace_with_punct="",          # instead of removing punctuations you may replace them
+        replace_with_url="",
+        replace_with_email="",
+        replace_with_phone_number="",
+        replace_with_number="<NUMBER>",
+        replace_with_digit="<DIGIT>",
+        replace_with_currency_symbol="<CUR>",
+        lang="en"                       # set to 'de' for German special handling
+    )
+
+    
+    # keep common puncts only
+    text = _PUNCT_PATTERN.sub('', text)
+    # remove specific patterns
+    text = _SPE_PATTERN.sub('', text)
+    # remove redundate spaces
+    text = " ".join(text.split())
+    return text
+
+def _rm_line_break(text):
+    text = text.replace("\n","\\n")
+    text = _REPEATED_LINE_BREAKS.sub(r'\\n', text)
+    text = _SHORT_FIRST_LINE.sub('', text)
+    text = text.replace("\\n"," ")
+    return text
+
+
+def _clean_basic(text):
+    """
+    Preprocess input text: removes unnecessary line breaks, normalizes punctuation, and cleans text.
+    """
+    # Normalize line breaks
+    text = text.replace("\n", " ").replace("\\n", " ").strip()
+
+    # Normalize text using cleantext library
+    text = clean(
+        text,
+        fix_unicode=True,
+        to_ascii=True,
+        lower=False,
+        no_line_breaks=True,
+        no_urls=True,
+        no_emails=True,
+        no_phone_numbers=True,
+        no_numbers=False,
+        no_digits=False,
+        no_currency_symbols=False,
+        no_punct=False,
+        lang="en"
+    )
+    return text
+
+
+def _clean_longformer(text):
+    text = _rm_line_break(text)
+    text = _clear_text(text)
+    return text
+
+
+# Pipeline name -> preprocessing function
+PIPELINES = {
+    # MAGE preprocessing used by the Longformer engine
+    "longformer": _clean_longformer,
+    # cleantext-only preprocessing shared by the finetuned and watermark engines, so a text is cleaned once for both
+    "basic": _clean_basic,
+}
+
+_cache = LRUCache(max_entries=PREPROCESS_CACHE_SIZE)
+
+
+def preprocess(text, pipeline):
+    """
+    Run `text` through the named pipeline, reusing the result if the same text was preprocessed before.
+    """
+    return _cache.get_or_compute((pipeline, text_digest(text)), lambda: PIPELINES[pipeline](text))
+
+
+def cache_stats():
+    return _cache.stats()
@@ -0,0 +1,123 @@
+"""
+Dynamic int8 quantization of the engines' models for CPU inference.
+
+The weights of all linear layers are stored in int8 and activations are quantized on the fly, which makes CPU
+inference faster and the models smaller at the cost of some accuracy. The mode is opt-in per engine through the
+'quantize' config key. Its effect is measured with the verification command, which scores the MAGE testbeds with
+the fp32 and the int8 engine and reports how often they agree and how much faster the int8 engine is:
+
+    python -m backend.quantization --engine longformer --limit 100 --output quantization.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import time
+from logging import getLogger
+
+import torch
+
+logger = getLogger(__name__)
+
+
+def quantize_dynamic_int8(model, device: str = "cpu"):
+    """Quantize the linear layers of `model` to int8. Only supported on CPU, other devices keep the fp32 model."""
+    if device != "cpu":
+        logger.warning(f"Dynamic int8 quantization is only supported on CPU, keeping the fp32 model on {device}.")
+        return model
+    model.eval()
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def serialized_size(model) -> int:
+    """Size of the model's state dict in bytes, which also counts the packed weights of quantized layers."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def _engine_models(engine) -> list:
+    if hasattr(engine, "model"):
+        return [engine.model]
+    return engine.registry.loaded_models()
+
+
+def _make_engine(engine_name: str, quantize: bool):
+    from backend.evaluation import ENGINES, load_engine
+
+    return load_engine(*ENGINES[engine_name], quantize=quantize)
+
+
+def verify(engine_name: str, testbeds_dir: str, batch_size: int = 8, limit: int | None = None) -> dict:
+    """Score the testbeds with the fp32 and the int8 engine and compare their decisions, confidences and speed."""
+    from backend.evaluation import LABEL2DECISIONS, iter_batches
+    from backend.longformer.models import DetectionRequest
+
+    engines = {"fp32": _make_engine(engine_name, quantize=False), "int8": _make_engine(engine_name, quantize=True)}
+    seconds = {precision: 0.0 for precision in engines}
+    correct = {precision: 0 for precision in engines}
+    agreements = total = 0
+    confidence_deltas = []
+    for file_path, texts, labels in iter_batches(testbeds_dir, batch_size, limit):
+        detection_requests = [DetectionRequest(text=text) for text in texts]
+        responses = {}
+        for precision, engine in engines.items():
+            start = time.perf_counter()
+            responses[precision] = engine.predict_batch(detection_requests)
+            seconds[precision] += time.perf_counter() - start
+        for label, fp32, int8 in zip(labels, responses["fp32"], responses["int8"]):
+            total += 1
+            agreements += fp32.label == int8.label
+            # compare the probability of the same class, so disagreements show up as large deltas
+            confidence_deltas.append(abs(fp32.logprobs[0] - int8.logprobs[0]))
+            correct["fp32"] += fp32.label == LABEL2DECISIONS.get(label)
+            correct["int8"] += int8.label == LABEL2DECISIONS.get(label)
+        logger.info(f"{file_path}: {agreements}/{total} agreeing decisions so far.")
+
+    sizes = {precision: sum(serialized_size(model) for model in _engine_models(engine)) for precision, engine in engines.items()}
+    for engine in engines.values():
+        if hasattr(engine, "close"):
+            engine.close()
+    confidence_deltas.sort()
+    return {
+        "engine": engine_name,
+        "texts": total,
+        "agreement_rate": agreements / total if total else None,
+        "confidence_delta": {
+            "mean": sum(confidence_deltas) / total if total else None,
+            "p99": confidence_deltas[min(int(0.99 * total), total - 1)] if total else None,
+            "max": confidence_deltas[-1] if total else None,
+        },
+        "accuracy": {precision: correct[precision] / total if total else None for precision in engines},
+        "seconds": seconds,
+        "speedup": seconds["fp32"] / seconds["int8"] if seconds["int8"] else None,
+        "model_bytes": sizes,
+        "size_reduction": sizes["fp32"] / sizes["int8"] if sizes["int8"] else None,
+    }
+
+
+def parse_args(argv=None):
+    from backend.data.view import TESTBEDS_DIR
+
+    parser = argparse.ArgumentParser(description="Compare the int8 quantized and the fp32 engine on the MAGE testbeds.")
+    parser.add_argument("--engine", choices=["longformer", "finetuned"], default="longformer")
+    parser.add_argument("--testbeds-dir", default=TESTBEDS_DIR)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of records per testbed file.")
+    parser.add_argument("--output", default=None, help="Write the report as JSON to this file.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = verify(args.engine, args.testbeds_dir, args.batch_size, args.limit)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Cache of detection results in front of the engines in EngineHub.
+
+A result is keyed by the digest of the text as the engine's model sees it (after the engine's own preprocessing, so
+texts that only differ in what preprocessing strips share an entry), the engine name and a fingerprint of the
+engine's config and model files, taken when the engine is loaded. Changing an engine's config or replacing its model
+files changes the fingerprint of the engine loaded next, so old results are never served for the new model. Fused
+/inferAll results are derived from the cached engine results, so they follow the same invalidation.
+
+* "memory" keeps results in an LRU cache per process.
+* "sqlite" keeps them in a SQLite database that all worker processes on a host share.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from logging import getLogger
+
+from backend.caching import LRUCache, text_digest
+
+logger = getLogger(__name__)
+
+config = {
+    # "memory", "sqlite" or None to disable the cache
+    'backend': 'memory',
+    'max_entries': 100_000,
+    # Results expire this long after they were computed (None to keep them until evicted)
+    'ttl_seconds': 24 * 3600,
+    # Database of the "sqlite" backend
+    'sqlite_path': './result_cache.sqlite3',
+}
+
+
+def _path_mtimes(value, mtimes: dict) -> None:
+    """Collect the mtimes of the existing paths among the config values, so replaced model files change the fingerprint."""
+    if isinstance(value, dict):
+        for item in value.values():
+            _path_mtimes(item, mtimes)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _path_mtimes(item, mtimes)
+    elif isinstance(value, str) and os.path.exists(value):
+        mtimes[value] = os.stat(value).st_mtime_ns
+
+
+def compute_engine_fingerprint(engine) -> str:
+    """Digest of an engine's class, its module's config and the mtimes of the model files the config points at."""
+    engine_config = getattr(sys.modules[type(engine).__module__], "config", {})
+    mtimes = {}
+    _path_mtimes(engine_config, mtimes)
+    fingerprint = json.dumps(
+        [type(engine).__module__, type(engine).__qualname__, engine_config, mtimes], sort_keys=True, default=str
+    )
+    return hashlib.blake2b(fingerprint.encode(), digest_size=8).hexdigest()
+
+
+def engine_fingerprint(engine) -> str:
+    """
+    The fingerprint of an engine, computed once and kept on the engine. Engines are fingerprinted when they are
+    loaded, a reloaded engine is a new instance and gets a fresh fingerprint.
+    """
+    fingerprint = getattr(engine, "result_fingerprint", None)
+    if fingerprint is None:
+        fingerprint = engine.result_fingerprint = compute_engine_fingerprint(engine)
+    return fingerprint
+
+
+def result_key(engine_name: str, engine, text: str) -> str:
+    normalize = getattr(engine, "normalize_text", None)
+    if normalize is not None:
+        text = normalize(text)
+    return f"{engine_name}:{engine_fingerprint(engine)}:{text_digest(text).hex()}"
+
+
+class MemoryResultCache:
+    def __init__(self, max_entries: int, ttl_seconds: float | None):
+        self._cache = LRUCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+
+    def get(self, key: str) -> dict | None:
+        return self._cache.get(key)
+
+    def put(self, key: str, result: dict) -> None:
+        self._cache.put(key, result)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        return {"backend": "memory", **self._cache.stats()}
+
+
+class SQLiteResultCache:
+    """
+    Results shared by the worker processes through a SQLite database in WAL mode. Entries store their last use, and
+    the least recently used ones are deleted whenever the table grows past `max_entries` by a tenth.
+    """
+
+    def __init__(self, path: str, max_entries: int, ttl_seconds: float | None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._puts_since_trim = 0
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT, expires_at REAL, used_at REAL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS results_used_at ON results (used_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections cannot be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> dict | None:
+        now = time.time()
+        connection = self._connection()
+        row = connection.execute("SELECT result, expires_at FROM results WHERE key = ?", (key,)).fetchone()
+        if row is not None and row[1] is not None and row[1] <= now:
+            connection.execute("DELETE FROM results WHERE key = ?", (key,))
+            with self._lock:
+                self.expirations += 1
+            row = None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        connection.execute("UPDATE results SET used_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def put(self, key: str, result: dict) -> None:
+        now = time.time()
+        expires_at = now + self.ttl_seconds if self.ttl_seconds is not None else None
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO results (key, result, expires_at, used_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(result), expires_at, now),
+        )
+        with self._lock:
+            self._puts_since_trim += 1
+            trim = self._puts_since_trim >= max(1, self.max_entries // 10)
+            if trim:
+                self._puts_since_trim = 0
+        if trim:
+            self._trim(connection)
+
+    def _trim(self, connection: sqlite3.Connection) -> None:
+        connection.execute("DELETE FROM results WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+        size = connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if size > self.max_entries:
+            connection.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used_at LIMIT ?)",
+                (size - self.max_entries,),
+            )
+
+    def clear(self) -> None:
+        self._connection().execute("DELETE FROM results")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": "sqlite",
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "expirations": self.expirations,
+            "size": self._connection().execute("SELECT COUNT(*) FROM results").fetchone()[0],
+            "capacity": self.max_entries,
+        }
+
+
+def make_result_cache(backend: str | None, max_entries: int, ttl_seconds: float | None, sqlite_path: str):
+    if backend is None:
+        return None
+    if backend == "memory":
+        return MemoryResultCache(max_entries, ttl_seconds)
+    if backend == "sqlite":
+        return SQLiteResultCache(sqlite_path, max_entries, ttl_seconds)
+    raise ValueError(f"Unknown result cache backend '{backend}'. Try 'memory' or 'sqlite'.")
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """The process-wide result cache configured by `config`, created on first use (None when disabled)."""
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None and config['backend'] is not None:
+            _result_cache = make_result_cache(
+                config['backend'], config['max_entries'], config['ttl_seconds'], config['sqlite_path']
+            )
+        return _result_cache
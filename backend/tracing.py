@@ -0,0 +1,179 @@
+"""
+Per-request tracing and on-demand profiler capture.
+
+A trace collects the duration of every stage a request goes through. It lives in a context variable, so it follows
+the request into the worker threads started with asyncio.to_thread. Batches formed by a MicroBatcher record their
+stages into the traces of all the requests in the batch, together with the time each request waited in the queue.
+
+Profiler capture is armed per engine for the next N requests. Those requests run under torch.profiler or cProfile,
+for batched engines the batches their inputs end up in do instead, and the traces are written to
+`config['profile_dir']`. Only one capture per profiler runs at a time, overlapping ones are skipped.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import cProfile
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+config = {
+    # Directory profiler traces are written to
+    'profile_dir': './profiles',
+}
+
+PROFILERS = ("torch", "cprofile")
+
+
+class Trace:
+    """Stage timings of one request, safe to record into from several threads."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def record(self, engine: str, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.spans.append({"engine": engine, "stage": stage, "seconds": seconds})
+
+    def summary(self) -> dict:
+        with self._lock:
+            spans = list(self.spans)
+        return {"total_seconds": time.perf_counter() - self.start, "spans": spans}
+
+
+# The trace (or traces, for a batch) stages are currently recorded into
+_current = contextvars.ContextVar("macdet_trace", default=())
+# The profiler and trace file name of the capture the current request runs under
+_profile = contextvars.ContextVar("macdet_profile", default=None)
+
+
+def start_trace() -> Trace:
+    """Start tracing the current request, everything it runs afterwards records into the returned trace."""
+    trace = Trace()
+    _current.set((trace,))
+    return trace
+
+
+def current() -> Trace | None:
+    traces = _current.get()
+    return traces[0] if len(traces) == 1 else None
+
+
+def record(engine: str, stage: str, seconds: float) -> None:
+    for trace in _current.get():
+        trace.record(engine, stage, seconds)
+
+
+@contextmanager
+def use_traces(traces):
+    """Record into all of `traces` inside the block, used by the batcher for the requests of a batch."""
+    token = _current.set(tuple(trace for trace in traces if trace is not None))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+class ProfileCaptures:
+    """Remaining number of requests to profile, per engine."""
+
+    def __init__(self):
+        self._armed = {}  # engine -> [profiler, remaining]
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def arm(self, engine: str, requests: int, profiler: str = "torch") -> None:
+        if profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler '{profiler}'. Try one of {', '.join(PROFILERS)}.")
+        with self._lock:
+            self._armed[engine] = [profiler, requests]
+
+    def disarm(self, engine: str) -> None:
+        with self._lock:
+            self._armed.pop(engine, None)
+
+    def claim(self, engine: str) -> tuple[str, str] | None:
+        """Take one capture of the engine, returns the profiler and a unique name for its trace files."""
+        with self._lock:
+            armed = self._armed.get(engine)
+            if armed is None:
+                return None
+            armed[1] -= 1
+            if armed[1] <= 0:
+                del self._armed[engine]
+            return armed[0], f"{engine}-{time.strftime('%Y%m%d-%H%M%S')}-{next(self._counter)}"
+
+    def status(self) -> dict:
+        with self._lock:
+            return {engine: {"profiler": profiler, "remaining": remaining} for engine, (profiler, remaining) in self._armed.items()}
+
+
+captures = ProfileCaptures()
+
+# Profiler sessions cannot overlap, neither for torch.profiler nor for cProfile (one profiling tool at a time)
+_profiler_locks = {profiler: threading.Lock() for profiler in PROFILERS}
+
+
+def current_profile() -> tuple[str, str] | None:
+    return _profile.get()
+
+
+@contextmanager
+def profiling(capture: tuple[str, str] | None, batched: bool = False):
+    """
+    Run the block under the claimed capture, batches formed from the inputs it submits are profiled as well.
+    Neither profiler can run twice at once, so for `batched` engines it only runs around the batches, where the
+    model is called.
+    """
+    if capture is None:
+        yield
+        return
+    token = _profile.set(capture)
+    try:
+        with nullcontext() if batched else profiled(*capture):
+            yield
+    finally:
+        _profile.reset(token)
+
+
+@contextmanager
+def profiled(profiler: str | None, name: str | None):
+    """Run the block under the given profiler and write its trace to the profile directory as `name`."""
+    if profiler is None:
+        yield
+        return
+    lock = _profiler_locks[profiler]
+    if not lock.acquire(blocking=False):
+        logger.warning(f"Skipped profile {name}, {profiler} is already running.")
+        yield
+        return
+    try:
+        os.makedirs(config['profile_dir'], exist_ok=True)
+        path = os.path.join(config['profile_dir'], name)
+        if profiler == "torch":
+            import torch
+
+            prof = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], record_shapes=True)
+            with prof:
+                yield
+            prof.export_chrome_trace(f"{path}.json")
+            logger.info(f"Wrote torch profiler trace {path}.json")
+        else:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                profile.dump_stats(f"{path}.prof")
+                logger.info(f"Wrote cProfile stats {path}.prof")
+    finally:
+        lock.release()
@@ -20,9 +20,15 @@ extended_watermark_processor.py
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import torch
-from itertools import combinations
+import os
+import threading
 from functools import cache
+from itertools import combinations
+from logging import getLogger
+
+import torch
+
+logger = getLogger(__name__)
 
 # Key properties of a hashing scheme
 props = {
@@ -144,16 +150,144 @@ prf_lookup = {
     "position_prf": position_prf,
 }
 
-# Generate a global permute table once at startup
-rng = torch.Generator(device=torch.device("cpu"))
-rng.manual_seed(2971215073)  # fib47 is prime
+# Batched variants of the PRFs above. They take an [N, context_width] tensor of contexts and return the N seeds the
+# scalar PRF gives on each row, as Python ints. Arithmetic done on tensors by the scalar version wraps around in int64
+# here as well, arithmetic it does on the Python int returned by `.item()` is done on Python ints here too, so the
+# seeds are identical, overflow included.
+
+
+def multiplicative_prf_batched(contexts: torch.LongTensor, salt_key: int) -> list[int]:
+    return [salt_key * value for value in contexts.prod(dim=1).tolist()]
+
+
+def additive_prf_batched(contexts: torch.LongTensor, salt_key: int) -> list[int]:
+    return [salt_key * value for value in contexts.sum(dim=1).tolist()]
+
+
+def minfunc_prf_batched(contexts: torch.LongTensor, salt_key: int) -> list[int]:
+    return [salt_key * value for value in contexts.min(dim=1).values.tolist()]
+
+
+def simple_skip_prf_batched(contexts: torch.LongTensor, salt_key: int, k=2) -> list[int]:
+    return hashint(salt_key * contexts[:, ::k]).prod(dim=1).tolist()
+
+
+def skipgram_prf_batched(contexts: torch.LongTensor, salt_key: int) -> list[int]:
+    return hashint(salt_key * contexts[:, 0]).tolist()
+
+
+def anchored_skipgram_prf_batched(contexts: torch.LongTensor, salt_key: int, anchor: int = -1) -> list[int]:
+    return (hashint(salt_key * contexts[:, 0]) * hashint(salt_key * contexts[:, anchor])).tolist()
+
+
+def minhash_prf_batched(contexts: torch.LongTensor, salt_key: int) -> list[int]:
+    return hashint(salt_key * contexts).min(dim=1).values.tolist()
+
+
+def anchored_minhash_prf_batched(contexts: torch.LongTensor, salt_key: int, anchor: int = -1) -> list[int]:
+    return (salt_key * hashint(contexts) * hashint(contexts[:, anchor, None])).min(dim=1).values.tolist()
+
+
+def minskipgram_prf_batched(contexts: torch.LongTensor, salt_key: int, k: int = 2) -> list[int]:
+    hashes = hashint(salt_key * contexts)
+    first, second = torch.combinations(torch.arange(contexts.shape[1]), 2).unbind(dim=1)
+    return (hashes[:, first] * hashes[:, second]).min(dim=1).values.tolist()
+
+
+def noncomm_prf_batched(contexts: torch.LongTensor, salt_key: int, k: int = 2) -> list[int]:
+    # the loop runs over the context width, not over the contexts
+    contexts = contexts.cpu()
+    keys = torch.full((contexts.shape[0],), salt_key, dtype=torch.long)
+    for entries in contexts.unbind(dim=1):
+        keys = keys * hashint(keys * entries)
+        keys %= 2**32
+    return keys.tolist()
+
+
+def position_prf_batched(contexts: torch.LongTensor, salt_key: int, k: int = 2) -> list[int]:
+    positions = torch.arange(1, contexts.shape[1] + 1, device=contexts.device)
+    return (salt_key * contexts * positions).sum(dim=1).tolist()
+
+
+prf_lookup_batched = {
+    "multiplicative_prf": multiplicative_prf_batched,
+    "additive_prf": additive_prf_batched,
+    "minfunc_prf": minfunc_prf_batched,
+    "simple_skip_prf": simple_skip_prf_batched,
+    "skipgram_prf": skipgram_prf_batched,
+    "anchored_skipgram_prf": anchored_skipgram_prf_batched,
+    "minhash_prf": minhash_prf_batched,
+    "anchored_minhash_prf": anchored_minhash_prf_batched,
+    "minskipgram_prf": minskipgram_prf_batched,
+    "noncomm_prf": noncomm_prf_batched,
+    "position_prf": position_prf_batched,
+}
+
+# Global permute table. It is generated once per host, written to a file named after everything that determines its
+# content, and memory-mapped by every process, so workers share one copy and none of them pays for it at import time.
+table_seed = 2971215073  # fib47 is prime
 table_size = 1_000_003
-fixed_table = torch.randperm(1_000_003, device=torch.device("cpu"), generator=rng)  # actually faster than I thought
+table_version = 1
+table_dir = os.environ.get("MACDET_PRF_TABLE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".prf_table"))
+
+_fixed_table = None
+_fixed_table_lock = threading.Lock()
+
+
+def build_fixed_table() -> torch.LongTensor:
+    rng = torch.Generator(device=torch.device("cpu"))
+    rng.manual_seed(table_seed)
+    return torch.randperm(table_size, device=torch.device("cpu"), generator=rng)  # actually faster than I thought
+
+
+def fixed_table_path(directory: str = None) -> str:
+    return os.path.join(directory or table_dir, f"prf-table-v{table_version}-{table_seed}-{table_size}.int64")
+
+
+def materialize_fixed_table(path: str) -> None:
+    """Write the table to `path`. It is written to a temporary file first, so no process ever maps a partial table."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    build_fixed_table().numpy().tofile(temporary_path)
+    os.replace(temporary_path, path)
+
+
+def load_fixed_table(path: str = None) -> torch.LongTensor:
+    """Memory-map the table file, materializing it first if needed. Falls back to an in-memory table when the
+    directory is not writable."""
+    path = path or fixed_table_path()
+    if not os.path.exists(path) or os.path.getsize(path) != table_size * 8:
+        try:
+            materialize_fixed_table(path)
+        except OSError as e:
+            logger.warning(f"Could not write the PRF table to {path}, keeping it in memory: {str(e)}")
+            return build_fixed_table()
+    try:
+        return torch.from_file(path, shared=True, size=table_size, dtype=torch.long)
+    except RuntimeError:
+        # a read-only file can still be mapped privately
+        return torch.from_file(path, shared=False, size=table_size, dtype=torch.long)
+
+
+def get_fixed_table() -> torch.LongTensor:
+    global _fixed_table
+    if _fixed_table is None:
+        with _fixed_table_lock:
+            if _fixed_table is None:
+                _fixed_table = load_fixed_table()
+    return _fixed_table
+
+
+def __getattr__(name: str):
+    # `fixed_table` is loaded on first access
+    if name == "fixed_table":
+        return get_fixed_table()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def hashint(integer_tensor: torch.LongTensor) -> torch.LongTensor:
     """Sane version, in the end we only need a small permutation table."""
-    return fixed_table[integer_tensor.cpu() % table_size] + 1  # minor cheat here, this function always return CPU values
+    return get_fixed_table()[integer_tensor.cpu() % table_size] + 1  # minor cheat here, this function always return CPU values
 
 
 def _hashint_avalanche_tensor(integer_tensor: torch.LongTensor):
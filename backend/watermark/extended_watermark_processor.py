@@ -16,17 +16,20 @@
 
 from __future__ import annotations
 import collections
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from math import sqrt
 from itertools import chain, tee
-from functools import lru_cache
 
-import scipy.stats
 import torch
 from tokenizers import Tokenizer
 from transformers import LogitsProcessor
 
 from backend.watermark.normalizers import normalization_strategy_lookup
-from backend.watermark.alternative_prf_schemes import prf_lookup, seeding_scheme_lookup
+from backend.watermark.alternative_prf_schemes import prf_lookup, prf_lookup_batched, seeding_scheme_lookup
+from backend.watermark.greenlist_bitmap import GreenlistBitmap
+from backend.watermark.greenlist_cache import GreenlistCache, LRUGreenlistCache, cache_namespace, ngram_cache_key
 
 
 class WatermarkBase:
@@ -58,15 +61,26 @@ class WatermarkBase:
         """Initialize all internal settings of the seeding strategy from a colloquial, "public" name for the scheme."""
         self.prf_type, self.context_width, self.self_salt, self.hash_key = seeding_scheme_lookup(seeding_scheme)
 
-    def _seed_rng(self, input_ids: torch.LongTensor) -> None:
-        """Seed RNG from local context. Not batched, because the generators we use (like cuda.random) are not batched."""
+    def _get_prf_seed(self, input_ids: torch.LongTensor) -> int:
+        """Compute the RNG seed induced by the local context."""
         # Need to have enough context for seed generation
         if input_ids.shape[-1] < self.context_width:
             raise ValueError(f"seeding_scheme requires at least a {self.context_width} token prefix to seed the RNG.")
 
         prf_key = prf_lookup[self.prf_type](input_ids[-self.context_width :], salt_key=self.hash_key)
         # enable for long, interesting streams of pseudorandom numbers: print(prf_key)
-        self.rng.manual_seed(prf_key % (2**64 - 1))  # safeguard against overflow from long
+        return prf_key % (2**64 - 1)  # safeguard against overflow from long
+
+    def _get_prf_seeds(self, contexts: torch.LongTensor) -> list[int]:
+        """Batched _get_prf_seed, the seeds induced by every row of an [N, context_width] tensor of contexts."""
+        if contexts.shape[-1] < self.context_width:
+            raise ValueError(f"seeding_scheme requires at least a {self.context_width} token prefix to seed the RNG.")
+        prf_keys = prf_lookup_batched[self.prf_type](contexts[:, -self.context_width :], salt_key=self.hash_key)
+        return [prf_key % (2**64 - 1) for prf_key in prf_keys]
+
+    def _seed_rng(self, input_ids: torch.LongTensor) -> None:
+        """Seed RNG from local context. Not batched, because the generators we use (like cuda.random) are not batched."""
+        self.rng.manual_seed(self._get_prf_seed(input_ids))
 
     def _get_greenlist_ids(self, input_ids: torch.LongTensor) -> torch.LongTensor:
         """Seed rng based on local context width and use this information to generate ids on the green list."""
@@ -197,6 +211,10 @@ class WatermarkLogitsProcessor(WatermarkBase, LogitsProcessor):
         return scores
 
 
+# Number of (window size, start) pairs scored at once by the windowed scan, bounds its memory use
+WINDOW_SCAN_CHUNK = 2**22
+
+
 class WatermarkDetector(WatermarkBase):
     """This is the detector for all watermarks imprinted with WatermarkLogitsProcessor.
 
@@ -209,6 +227,9 @@ class WatermarkDetector(WatermarkBase):
     * normalizers ["unicode", "homoglyphs", "truecase"] -> These can mitigate modifications to generated text that could trip the watermark
     * ignore_repeated_ngrams -> This option changes the detection rules to count every unique ngram only once.
     * z_threshold -> Changing this threshold will change the sensitivity of the detector.
+    * greenlist_cache -> Where greenlist lookups are cached, see greenlist_cache.py. Defaults to a bounded in-process LRU.
+    * greenlist_bitmap -> Precomputed greenlists of a context width 1 scheme, see greenlist_bitmap.py. Replaces
+                          the cache for every ngram it covers.
     """
 
     def __init__(
@@ -219,6 +240,9 @@ class WatermarkDetector(WatermarkBase):
         z_threshold: float = 4.0,
         normalizers: list[str] = ["unicode"],  # or also: ["unicode", "homoglyphs", "truecase"]
         ignore_repeated_ngrams: bool = True,
+        greenlist_workers: int = None,
+        greenlist_cache: GreenlistCache = None,
+        greenlist_bitmap: GreenlistBitmap = None,
         **kwargs,
     ):
         super().__init__(*args, **kwargs)
@@ -236,6 +260,42 @@ class WatermarkDetector(WatermarkBase):
             self.normalizers.append(normalization_strategy_lookup(normalization_strategy))
         self.ignore_repeated_ngrams = ignore_repeated_ngrams
 
+        # Batched greenlist generation: one generator per worker thread, created lazily
+        self.greenlist_workers = greenlist_workers if greenlist_workers is not None else (os.cpu_count() or 1)
+        self._greenlist_pool = None
+        self._greenlist_pool_lock = threading.Lock()
+        self._thread_rng = threading.local()
+
+        # Greenlist lookups are cached under all settings the greenlist depends on
+        self.greenlist_cache = greenlist_cache if greenlist_cache is not None else LRUGreenlistCache()
+        self._cache_namespace = cache_namespace(
+            self.prf_type,
+            self.context_width,
+            self.self_salt,
+            self.hash_key,
+            self.gamma,
+            self.vocab_size,
+            self.select_green_tokens,
+            torch.device(self.device).type,
+        )
+        if greenlist_bitmap is not None:
+            greenlist_bitmap.check(self)
+        self.greenlist_bitmap = greenlist_bitmap
+
+    def close(self) -> None:
+        """Stop the greenlist worker threads, waiting for the lookups they are running."""
+        with self._greenlist_pool_lock:
+            pool, self._greenlist_pool = self._greenlist_pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def _get_greenlist_pool(self) -> ThreadPoolExecutor:
+        # concurrent first detections must not each start a pool
+        with self._greenlist_pool_lock:
+            if self._greenlist_pool is None:
+                self._greenlist_pool = ThreadPoolExecutor(self.greenlist_workers, thread_name_prefix="greenlist")
+            return self._greenlist_pool
+
     def dummy_detect(
         self,
         return_prediction: bool = True,
@@ -292,18 +352,99 @@ class WatermarkDetector(WatermarkBase):
         return z
 
     def _compute_p_value(self, z):
+        # scipy is only imported once a p-value is needed, it is slow to import
+        import scipy.stats
+
         p_value = scipy.stats.norm.sf(z)
         return p_value
 
-    @lru_cache(maxsize=2**32)
-    def _get_ngram_score_cached(self, prefix: tuple[int], target: int):
-        """Expensive re-seeding and sampling is cached."""
-        # Handle with care, should ideally reset on __getattribute__ access to self.prf_type, self.context_width, self.self_salt, self.hash_key
-        greenlist_ids = self._get_greenlist_ids(torch.as_tensor(prefix, device=self.device))
-        return True if target in greenlist_ids else False
+    def _ngram_cache_key(self, ngram_example: tuple[int]) -> int:
+        prefix = ngram_example if self.self_salt else ngram_example[:-1]
+        return ngram_cache_key(self._cache_namespace, prefix, ngram_example[-1])
+
+    def _get_thread_rng(self) -> torch.Generator:
+        """Generator private to the calling thread, so that batched scoring can run concurrently."""
+        rng = getattr(self._thread_rng, "rng", None)
+        if rng is None:
+            rng = self._thread_rng.rng = torch.Generator(device=self.device)
+        return rng
+
+    def _greenlist_membership(self, seed_to_targets: list[tuple[int, list[int]]]) -> list[list[bool]]:
+        """For every (seed, targets) pair, draw the greenlist of the seed once and test all its targets against it.
+        Draws exactly the same permutation as _get_greenlist_ids for the same seed."""
+        rng = self._get_thread_rng()
+        greenlist_size = int(self.vocab_size * self.gamma)
+        green_mask = torch.zeros(self.vocab_size, dtype=torch.bool, device=self.device)
+        memberships = []
+        for seed, targets in seed_to_targets:
+            rng.manual_seed(seed)
+            vocab_permutation = torch.randperm(self.vocab_size, device=self.device, generator=rng)
+            if self.select_green_tokens:  # directly
+                greenlist_ids = vocab_permutation[:greenlist_size]
+            else:  # select green via red
+                greenlist_ids = vocab_permutation[(self.vocab_size - greenlist_size) :]
+            green_mask.zero_()
+            green_mask[greenlist_ids] = True
+            # targets outside of the vocabulary can never be on the greenlist
+            memberships.append([0 <= target < self.vocab_size and bool(green_mask[target]) for target in targets])
+        return memberships
+
+    def _score_ngrams(self, ngram_examples: list[tuple[int]]) -> dict[tuple[int], bool]:
+        """Look up the watermark outcome of many ngrams in the greenlist bitmap or cache, and compute the missing ones in bulk."""
+        ngram_to_watermark_lookup = {}
+        if self.greenlist_bitmap is not None:
+            ngram_to_watermark_lookup = self.greenlist_bitmap.get_many(ngram_examples)
+            if len(ngram_to_watermark_lookup) == len(ngram_examples):
+                return ngram_to_watermark_lookup
+            ngram_examples = [ngram_example for ngram_example in ngram_examples if ngram_example not in ngram_to_watermark_lookup]
+        keys = [self._ngram_cache_key(ngram_example) for ngram_example in ngram_examples]
+        cached = self.greenlist_cache.get_many(keys)
+        missing = []
+        for ngram_example, key in zip(ngram_examples, keys):
+            if key in cached:
+                ngram_to_watermark_lookup[ngram_example] = cached[key]
+            else:
+                missing.append((ngram_example, key))
+        if missing:
+            computed = self._compute_ngram_scores([ngram_example for ngram_example, _ in missing])
+            self.greenlist_cache.put_many({key: computed[ngram_example] for ngram_example, key in missing})
+            ngram_to_watermark_lookup.update(computed)
+        return ngram_to_watermark_lookup
+
+    def _compute_ngram_scores(self, ngram_examples: list[tuple[int]]) -> dict[tuple[int], bool]:
+        """Compute the watermark outcome of many ngrams in bulk.
+
+        The seeds of all prefixes are computed in one call of the batched PRF, ngrams are grouped by seed, every
+        distinct seed draws its greenlist once, and the seeds are spread over a pool of worker threads.
+        Gives the same outcomes as _get_greenlist_ids.
+        """
+        if not ngram_examples:
+            return {}
+        prefixes = torch.as_tensor([ngram_example if self.self_salt else ngram_example[:-1] for ngram_example in ngram_examples])
+        seed_to_ngrams = collections.defaultdict(list)
+        for ngram_example, seed in zip(ngram_examples, self._get_prf_seeds(prefixes)):
+            seed_to_ngrams[seed].append(ngram_example)
+        seed_to_targets = [(seed, [ngram[-1] for ngram in group]) for seed, group in seed_to_ngrams.items()]
+
+        num_workers = min(self.greenlist_workers, len(seed_to_targets))
+        if num_workers <= 1:
+            memberships = self._greenlist_membership(seed_to_targets)
+        else:
+            shards = [seed_to_targets[i::num_workers] for i in range(num_workers)]
+            shard_memberships = list(self._get_greenlist_pool().map(self._greenlist_membership, shards))
+            # undo the round-robin sharding
+            memberships = [None] * len(seed_to_targets)
+            for i, shard in enumerate(shard_memberships):
+                memberships[i::num_workers] = shard
+
+        ngram_to_watermark_lookup = {}
+        for group, outcomes in zip(seed_to_ngrams.values(), memberships):
+            ngram_to_watermark_lookup.update(zip(group, outcomes))
+        return ngram_to_watermark_lookup
 
-    def _score_ngrams_in_passage(self, input_ids: torch.Tensor):
-        """Core function to gather all ngrams in the input and compute their watermark."""
+    def _score_ngrams_in_passage(self, input_ids: torch.Tensor, ngram_scores: dict = None):
+        """Core function to gather all ngrams in the input and compute their watermark.
+        Outcomes already present in ngram_scores are reused instead of recomputed."""
         if len(input_ids) - self.context_width < 1:
             raise ValueError(
                 f"Must have at least {1} token to score after "
@@ -313,11 +454,13 @@ class WatermarkDetector(WatermarkBase):
         # Compute scores for all ngrams contexts in the passage:
         token_ngram_generator = ngrams(input_ids.cpu().tolist(), self.context_width + 1 - self.self_salt)
         frequencies_table = collections.Counter(token_ngram_generator)
-        ngram_to_watermark_lookup = {}
-        for idx, ngram_example in enumerate(frequencies_table.keys()):
-            prefix = ngram_example if self.self_salt else ngram_example[:-1]
-            target = ngram_example[-1]
-            ngram_to_watermark_lookup[ngram_example] = self._get_ngram_score_cached(prefix, target)
+        ngram_scores = ngram_scores or {}
+        missing = [ngram_example for ngram_example in frequencies_table if ngram_example not in ngram_scores]
+        new_scores = self._score_ngrams(missing) if missing else {}
+        ngram_to_watermark_lookup = {
+            ngram_example: ngram_scores[ngram_example] if ngram_example in ngram_scores else new_scores[ngram_example]
+            for ngram_example in frequencies_table
+        }
 
         return ngram_to_watermark_lookup, frequencies_table
 
@@ -360,8 +503,9 @@ class WatermarkDetector(WatermarkBase):
         return_z_score: bool = True,
         return_z_at_T: bool = True,
         return_p_value: bool = True,
+        ngram_scores: dict = None,
     ):
-        ngram_to_watermark_lookup, frequencies_table = self._score_ngrams_in_passage(input_ids)
+        ngram_to_watermark_lookup, frequencies_table = self._score_ngrams_in_passage(input_ids, ngram_scores)
         green_token_mask, green_unique, offsets = self._get_green_at_T_booleans(input_ids, ngram_to_watermark_lookup)
 
         # Count up scores over all ngrams
@@ -409,11 +553,121 @@ class WatermarkDetector(WatermarkBase):
 
         return score_dict
 
+    def _window_sizes(self, window_size: str, length: int) -> list[int]:
+        if window_size == "max":
+            # could start later, small window sizes cannot generate enough power
+            # more principled: solve (T * Spike_Entropy - g * T) / sqrt(T * g * (1 - g)) = z_thresh for T
+            return list(range(1, length + 1))
+        try:
+            sizes = [int(x) for x in window_size.split(",") if len(x) > 0]
+        except ValueError:
+            sizes = []
+        if not sizes or min(sizes) < 1:
+            raise ValueError(f"Window sizes must be 'max' or comma separated positive integers, got '{window_size}'.")
+        return sizes
+
+    def _scan_windows(self, green_ids: torch.Tensor, sizes: list[int], stride: int, by_start: bool = False, by_end: bool = False) -> dict:
+        """Score every window of every size in `sizes` starting at each multiple of `stride`, all at once.
+
+        Window hits are differences of the prefix sums of the green vector, so the hits of a whole block of window
+        sizes are computed as one (sizes x starts) tensor, blocks are bounded by WINDOW_SCAN_CHUNK entries. For a fixed
+        size the z-score only grows with the hits, so the best z-score per size comes from the integer hits alone.
+        Optionally also returns the best window starting at every start (`by_start`) and the best z-score of the
+        windows ending at or before every position, clipped at 0 (`by_end`), which need the z-score of every window.
+        """
+        length = len(green_ids)
+        all_sizes = torch.as_tensor(sizes, dtype=torch.long)
+        # windows running past the end read this from the padding and get negative hits, whose z-scores are below
+        # those of every window that fits. Hits are kept in int16 when they fit, which halves the memory traffic.
+        padding = -2 * (length + 1)
+        dtype = torch.int16 if 3 * (length + 1) < 2**15 else torch.int32
+        prefix = torch.full((length + 1 + max(sizes),), padding, dtype=dtype)
+        prefix[0] = 0
+        prefix[1 : length + 1] = torch.cumsum(green_ids, dim=0)
+        starts = torch.arange(0, length, stride)
+        prefix_at_starts = prefix[starts]
+        # "max" and other runs of consecutive sizes are read as a strided view of the prefix sums, without a gather
+        consecutive = bool((all_sizes[1:] - all_sizes[:-1] == 1).all())
+
+        max_hits_per_size = torch.empty(len(sizes), dtype=torch.int32)
+        best_z_by_start = torch.full((len(starts),), float("-inf"), dtype=torch.float32) if by_start else None
+        best_size_by_start = torch.zeros(len(starts), dtype=torch.long) if by_start else None
+        best_z_by_end = torch.zeros(length, dtype=torch.float64) if by_end else None
+        sizes_per_chunk = max(1, WINDOW_SCAN_CHUNK // len(starts))
+        for first in range(0, len(sizes), sizes_per_chunk):
+            block = all_sizes[first : first + sizes_per_chunk]
+            # starts from which even the smallest window of the block runs past the end are left out
+            num_starts = max(1, int((starts + block.min() <= length).sum()))
+            if consecutive:
+                prefix_at_ends = prefix.as_strided((len(block), num_starts), (1, stride), int(block[0]))
+            else:
+                prefix_at_ends = prefix[starts[None, :num_starts] + block[:, None]]
+            hits = prefix_at_ends - prefix_at_starts[None, :num_starts]
+            max_hits_per_size[first : first + len(block)] = hits.max(dim=1).values
+            if not (by_start or by_end):
+                continue
+
+            if by_start:
+                # float32 is enough to rank the windows, the z-scores of the reported spans are recomputed exactly
+                sizes_float = block.to(torch.float32)[:, None]
+                z = (hits - self.gamma * sizes_float) / torch.sqrt(sizes_float * self.gamma * (1 - self.gamma))
+                block_best, block_best_index = z.max(dim=0)
+                improved = block_best > best_z_by_start[:num_starts]
+                best_z_by_start[:num_starts] = torch.where(improved, block_best, best_z_by_start[:num_starts])
+                best_size_by_start[:num_starts] = torch.where(improved, block[block_best_index], best_size_by_start[:num_starts])
+            if by_end:
+                sizes_float = block.to(torch.float64)[:, None]
+                z = (hits - self.gamma * sizes_float) / torch.sqrt(sizes_float * self.gamma * (1 - self.gamma))
+                last = (starts[None, :num_starts] + block[:, None] - 1).clamp(max=length - 1)
+                best_z_by_end.scatter_reduce_(0, last.flatten(), z.flatten(), reduce="amax")
+
+        sizes_float = all_sizes.to(torch.float64)
+        z_max_per_size = (max_hits_per_size - self.gamma * sizes_float) / torch.sqrt(sizes_float * self.gamma * (1 - self.gamma))
+        z_max_per_size = z_max_per_size.masked_fill(max_hits_per_size < 0, float("-inf"))
+        return dict(
+            z_max_per_size=z_max_per_size,
+            starts=starts,
+            best_z_by_start=best_z_by_start,
+            best_size_by_start=best_size_by_start,
+            z_at_T=torch.cummax(best_z_by_end, dim=0).values if by_end else None,
+        )
+
+    def _localize_spans(self, green_ids: torch.Tensor, offsets: torch.Tensor, scan: dict, max_spans: int, z_threshold: float) -> list[dict]:
+        """Greedily pick the non-overlapping windows with the highest z-scores above `z_threshold`.
+        Spans are reported in token positions of the scored input, [start_token, end_token)."""
+        ngram_size = self.context_width + 1 - self.self_salt
+        taken = torch.zeros(len(green_ids), dtype=torch.bool)
+        spans = []
+        for index in torch.argsort(scan["best_z_by_start"], descending=True).tolist():
+            if len(spans) >= max_spans or not scan["best_z_by_start"][index].item() > z_threshold:
+                break
+            start = scan["starts"][index].item()
+            end = start + scan["best_size_by_start"][index].item()
+            if taken[start:end].any():
+                continue
+            taken[start:end] = True
+            num_green_tokens = int(green_ids[start:end].sum())
+            # map the window over (unique) scored ngrams back to the positions of the ngrams and their last tokens
+            first_ngram = int(torch.searchsorted(offsets, start))
+            end_ngram = int(torch.searchsorted(offsets, end))
+            spans.append(dict(
+                start_token=first_ngram + ngram_size - 1,
+                end_token=end_ngram + ngram_size - 1,
+                num_tokens_scored=end - start,
+                num_green_tokens=num_green_tokens,
+                z_score=self._compute_z_score(num_green_tokens, end - start),
+            ))
+        return spans
+
     def _score_windows_impl_batched(
         self,
         input_ids: torch.Tensor,
         window_size: str,
         window_stride: int = 1,
+        ngram_scores: dict = None,
+        max_spans: int = 0,
+        z_threshold: float = None,
+        return_z_at_T: bool = True,
     ):
         # Implementation details:
         # 1) --ignore_repeated_ngrams is applied globally, and windowing is then applied over the reduced binary vector
@@ -423,61 +677,32 @@ class WatermarkDetector(WatermarkBase):
         #    ROC chart that calibrates to a chosen FPR. Due, to windowing, the multiple hypotheses will increase scores across the board#
         #    naive_count_correction=True is a partial remedy to this
 
-        ngram_to_watermark_lookup, frequencies_table = self._score_ngrams_in_passage(input_ids)
+        ngram_to_watermark_lookup, frequencies_table = self._score_ngrams_in_passage(input_ids, ngram_scores)
         green_mask, green_ids, offsets = self._get_green_at_T_booleans(input_ids, ngram_to_watermark_lookup)
         len_full_context = len(green_ids)
 
-        partial_sum_id_table = torch.cumsum(green_ids, dim=0)
-
-        if window_size == "max":
-            # could start later, small window sizes cannot generate enough power
-            # more principled: solve (T * Spike_Entropy - g * T) / sqrt(T * g * (1 - g)) = z_thresh for T
-            sizes = range(1, len_full_context)
-        else:
-            sizes = [int(x) for x in window_size.split(",") if len(x) > 0]
-
-        z_score_max_per_window = torch.zeros(len(sizes))
-        cumulative_eff_z_score = torch.zeros(len_full_context)
-        s = window_stride
-
-        window_fits = False
-        for idx, size in enumerate(sizes):
-            if size <= len_full_context:
-                # Compute hits within window for all positions in parallel:
-                window_score = torch.zeros(len_full_context - size + 1, dtype=torch.long)
-                # Include 0-th window
-                window_score[0] = partial_sum_id_table[size - 1]
-                # All other windows from the 1st:
-                window_score[1:] = partial_sum_id_table[size::s] - partial_sum_id_table[:-size:s]
-
-                # Now compute batched z_scores
-                batched_z_score_enum = window_score - self.gamma * size
-                z_score_denom = sqrt(size * self.gamma * (1 - self.gamma))
-                batched_z_score = batched_z_score_enum / z_score_denom
-
-                # And find the maximal hit
-                maximal_z_score = batched_z_score.max()
-                z_score_max_per_window[idx] = maximal_z_score
-
-                z_score_at_effective_T = torch.cummax(batched_z_score, dim=0)[0]
-                cumulative_eff_z_score[size::s] = torch.maximum(cumulative_eff_z_score[size::s], z_score_at_effective_T[:-1])
-                window_fits = True  # successful computation for any window in sizes
-
-        if not window_fits:
+        sizes = self._window_sizes(window_size, len_full_context)
+        if not any(size <= len_full_context for size in sizes):
             raise ValueError(
                 f"Could not find a fitting window with window sizes {window_size} for (effective) context length {len_full_context}."
             )
+        scan = self._scan_windows(green_ids, sizes, window_stride or 1, by_start=max_spans > 0, by_end=return_z_at_T)
 
         # Compute optimal window size and z-score
-        cumulative_z_score = cumulative_eff_z_score[offsets]
-        optimal_z, optimal_window_size_idx = z_score_max_per_window.max(dim=0)
+        cumulative_z_score = scan["z_at_T"][offsets] if return_z_at_T else None
+        optimal_z, optimal_window_size_idx = scan["z_max_per_size"].max(dim=0)
         optimal_window_size = sizes[optimal_window_size_idx]
+        spans = []
+        if max_spans > 0:
+            threshold = z_threshold if z_threshold is not None else self.z_threshold
+            spans = self._localize_spans(green_ids, offsets, scan, max_spans, threshold)
         return (
-            optimal_z,
+            optimal_z.item(),
             optimal_window_size,
-            z_score_max_per_window,
+            scan["z_max_per_size"],
             cumulative_z_score,
             green_mask,
+            spans,
         )
 
     def _score_sequence_window(
@@ -492,6 +717,9 @@ class WatermarkDetector(WatermarkBase):
         return_p_value: bool = True,
         window_size: str = None,
         window_stride: int = 1,
+        ngram_scores: dict = None,
+        max_spans: int = 0,
+        z_threshold: float = None,
     ):
         (
             optimal_z,
@@ -499,7 +727,10 @@ class WatermarkDetector(WatermarkBase):
             _,
             z_score_at_T,
             green_mask,
-        ) = self._score_windows_impl_batched(input_ids, window_size, window_stride)
+            spans,
+        ) = self._score_windows_impl_batched(
+            input_ids, window_size, window_stride, ngram_scores, max_spans, z_threshold, return_z_at_T
+        )
 
         # HF-style output dictionary
         score_dict = dict()
@@ -507,7 +738,7 @@ class WatermarkDetector(WatermarkBase):
             score_dict.update(dict(num_tokens_scored=optimal_window_size))
 
         denom = sqrt(optimal_window_size * self.gamma * (1 - self.gamma))
-        green_token_count = int(optimal_z * denom + self.gamma * optimal_window_size)
+        green_token_count = round(optimal_z * denom + self.gamma * optimal_window_size)
         green_fraction = green_token_count / optimal_window_size
         if return_num_green_tokens:
             score_dict.update(dict(num_green_tokens=green_token_count))
@@ -520,6 +751,13 @@ class WatermarkDetector(WatermarkBase):
         if return_p_value:
             z_score = score_dict.get("z_score", optimal_z)
             score_dict.update(dict(p_value=self._compute_p_value(z_score)))
+        score_dict.update(dict(window_size=optimal_window_size))
+        if max_spans > 0:
+            for span in spans:
+                span["p_value"] = float(self._compute_p_value(span["z_score"]))
+                if self.tokenizer is not None:
+                    span["text"] = self.tokenizer.decode(input_ids[span["start_token"] : span["end_token"]])
+            score_dict.update(dict(spans=spans))
 
         # Return per-token results for mask. This is still the same, just scored by windows
         # todo would be to mark the actually counted tokens differently
@@ -528,6 +766,40 @@ class WatermarkDetector(WatermarkBase):
 
         return score_dict
 
+    def _prepare_tokenized_text(self, text: str = None, tokenized_text: list[int] = None) -> torch.Tensor:
+        """Normalize and tokenize the raw text if needed, and remove the bos_tok at the beginning."""
+        # run optional normalizers on text
+        if text is not None:
+            for normalizer in self.normalizers:
+                text = normalizer(text)
+            if len(self.normalizers) > 0:
+                print(f"Text after normalization:\n\n{text}\n")
+
+        if tokenized_text is None:
+            assert self.tokenizer is not None, (
+                "Watermark detection on raw string ",
+                "requires an instance of the tokenizer ",
+                "that was used at generation time.",
+            )
+            tokenized_text = self.tokenizer(text, return_tensors="pt", add_special_tokens=False)["input_ids"][0].to(self.device)
+            if tokenized_text[0] == self.tokenizer.bos_token_id:
+                tokenized_text = tokenized_text[1:]
+        else:
+            # try to remove the bos_tok at beginning if it's there
+            if (self.tokenizer is not None) and (tokenized_text[0] == self.tokenizer.bos_token_id):
+                tokenized_text = tokenized_text[1:]
+        return tokenized_text
+
+    def detect_many(self, texts: list[str], **kwargs) -> list[dict]:
+        """Scores many strings of text. The greenlists of all distinct ngrams across the texts are computed in one bulk pass."""
+        tokenized_texts = [self._prepare_tokenized_text(text=text) for text in texts]
+        all_ngrams = set()
+        for tokenized_text in tokenized_texts:
+            all_ngrams.update(ngrams(tokenized_text.cpu().tolist(), self.context_width + 1 - self.self_salt))
+        ngram_scores = self._score_ngrams(list(all_ngrams))
+        # normalizers already ran above, the texts are passed on tokenized
+        return [self.detect(tokenized_text=tokenized_text, ngram_scores=ngram_scores, **kwargs) for tokenized_text in tokenized_texts]
+
     def detect(
         self,
         text: str = None,
@@ -546,25 +818,7 @@ class WatermarkDetector(WatermarkBase):
         if return_prediction:
             kwargs["return_p_value"] = True  # to return the "confidence":=1-p of positive detections
 
-        # run optional normalizers on text
-        for normalizer in self.normalizers:
-            text = normalizer(text)
-        if len(self.normalizers) > 0:
-            print(f"Text after normalization:\n\n{text}\n")
-
-        if tokenized_text is None:
-            assert self.tokenizer is not None, (
-                "Watermark detection on raw string ",
-                "requires an instance of the tokenizer ",
-                "that was used at generation time.",
-            )
-            tokenized_text = self.tokenizer(text, return_tensors="pt", add_special_tokens=False)["input_ids"][0].to(self.device)
-            if tokenized_text[0] == self.tokenizer.bos_token_id:
-                tokenized_text = tokenized_text[1:]
-        else:
-            # try to remove the bos_tok at beginning if it's there
-            if (self.tokenizer is not None) and (tokenized_text[0] == self.tokenizer.bos_token_id):
-                tokenized_text = tokenized_text[1:]
+        tokenized_text = self._prepare_tokenized_text(text, tokenized_text)
 
         # call score method
         output_dict = {}
@@ -575,6 +829,7 @@ class WatermarkDetector(WatermarkBase):
                 tokenized_text,
                 window_size=window_size,
                 window_stride=window_stride,
+                z_threshold=z_threshold,
                 **kwargs,
             )
             output_dict.update(score_dict)
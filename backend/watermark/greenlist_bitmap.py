@@ -0,0 +1,177 @@
+"""Precomputed greenlists of the seeding schemes that only hash the previous token.
+
+With a context width of 1 and no self-salting (simple_1/lefthash), the greenlist of a position only depends on the
+token before it, so there are at most `vocab_size` distinct greenlists. GreenlistBitmap stores all of them as a packed
+bit matrix on disk, one row per previous token and one bit per target token, built once offline:
+
+    python -m backend.watermark.greenlist_bitmap --tokenizer facebook/opt-125m --seeding-scheme lefthash --output lefthash.bitmap
+
+The detector memory-maps the file and looks green membership up as a single bit, without drawing any permutation at
+request time. The mapping is read-only, so all worker processes on a host share the pages through the page cache.
+The header records a digest of every setting the greenlists depend on (the cache namespace of the detector), and a
+detector refuses a bitmap built for other settings.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+import torch
+
+logger = getLogger(__name__)
+
+BITMAP_MAGIC = b"MACDETBM"
+BITMAP_VERSION = 1
+# magic, then version, rows, vocab_size, row_bytes and the 16 byte settings digest, padded so rows start aligned
+HEADER_FORMAT = "<IQQQ16s"
+HEADER_SIZE = 64
+# Rows computed between two progress messages of the builder
+PROGRESS_ROWS = 4096
+
+
+def supports(detector) -> bool:
+    """Whether the greenlists of the detector's seeding scheme only depend on the previous token."""
+    return detector.context_width == 1 and not detector.self_salt
+
+
+def _pack_header(rows: int, vocab_size: int, row_bytes: int, namespace: bytes) -> bytes:
+    header = BITMAP_MAGIC + struct.pack(HEADER_FORMAT, BITMAP_VERSION, rows, vocab_size, row_bytes, namespace)
+    return header.ljust(HEADER_SIZE, b"\0")
+
+
+def _read_header(path: str) -> tuple[int, int, int, bytes]:
+    with open(path, "rb") as file:
+        header = file.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE or not header.startswith(BITMAP_MAGIC):
+        raise ValueError(f"{path} is not a greenlist bitmap.")
+    version, rows, vocab_size, row_bytes, namespace = struct.unpack_from(HEADER_FORMAT, header, len(BITMAP_MAGIC))
+    if version != BITMAP_VERSION:
+        raise ValueError(f"Unsupported greenlist bitmap version {version} in {path}.")
+    return rows, vocab_size, row_bytes, namespace
+
+
+def build_greenlist_bitmap(detector, path: str, workers: int = None) -> int:
+    """
+    Compute the greenlist of every previous token with the detector's settings and write them to `path`.
+    Rows are filled through a shared mapping of a temporary file, which replaces `path` once complete.
+    Returns the number of rows written.
+    """
+    if not supports(detector):
+        raise ValueError("A greenlist bitmap needs a seeding scheme with a context width of 1 and no self-salting, like lefthash.")
+    rows = vocab_size = detector.vocab_size
+    row_bytes = (vocab_size + 7) // 8
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(_pack_header(rows, vocab_size, row_bytes, detector._cache_namespace))
+        file.truncate(HEADER_SIZE + rows * row_bytes)
+    try:
+        mapped = torch.from_file(tmp_path, shared=True, size=HEADER_SIZE + rows * row_bytes, dtype=torch.uint8)
+        bitmap = mapped[HEADER_SIZE:].view(rows, row_bytes)
+        seeds = detector._get_prf_seeds(torch.arange(rows).unsqueeze(1))
+        weights = torch.tensor([1 << bit for bit in range(8)], dtype=torch.uint8)
+        greenlist_size = int(vocab_size * detector.gamma)
+
+        def fill(shard: range) -> None:
+            rng = detector._get_thread_rng()
+            mask = torch.zeros(row_bytes * 8, dtype=torch.bool)
+            for row in shard:
+                # the same greenlist as _greenlist_membership draws for this seed
+                rng.manual_seed(seeds[row])
+                vocab_permutation = torch.randperm(vocab_size, device=detector.device, generator=rng).cpu()
+                if detector.select_green_tokens:
+                    greenlist_ids = vocab_permutation[:greenlist_size]
+                else:
+                    greenlist_ids = vocab_permutation[(vocab_size - greenlist_size) :]
+                mask.zero_()
+                mask[greenlist_ids] = True
+                # bit `target % 8` of byte `target // 8` is set when target is green
+                bitmap[row] = (mask.view(row_bytes, 8).to(torch.uint8) * weights).sum(dim=1, dtype=torch.uint8)
+
+        workers = workers or os.cpu_count() or 1
+        shards = [range(start, min(start + PROGRESS_ROWS, rows)) for start in range(0, rows, PROGRESS_ROWS)]
+        with ThreadPoolExecutor(workers, thread_name_prefix="greenlist-bitmap") as pool:
+            for done, _ in enumerate(pool.map(fill, shards), start=1):
+                logger.info(f"Computed {min(done * PROGRESS_ROWS, rows)} of {rows} greenlists.")
+        del bitmap, mapped
+        os.replace(tmp_path, path)  # readers never see a half-written bitmap
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return rows
+
+
+class GreenlistBitmap:
+    """Read-only memory mapping of a bitmap written by build_greenlist_bitmap."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.rows, self.vocab_size, self.row_bytes, self.namespace = _read_header(path)
+        size = HEADER_SIZE + self.rows * self.row_bytes
+        if os.path.getsize(path) != size:
+            raise ValueError(f"Greenlist bitmap {path} is truncated.")
+        # a private mapping that is never written to shares its pages with every other process mapping the file
+        self._bitmap = torch.from_file(path, shared=False, size=size, dtype=torch.uint8)[HEADER_SIZE:].view(self.rows, self.row_bytes)
+
+    def check(self, detector) -> None:
+        """Raise a ValueError unless the bitmap was built with the settings of `detector`."""
+        if not supports(detector):
+            raise ValueError("Greenlist bitmaps only apply to seeding schemes with a context width of 1 and no self-salting.")
+        if self.namespace != detector._cache_namespace:
+            raise ValueError(
+                f"Greenlist bitmap {self.path} was built for other detector settings "
+                "(seeding scheme, gamma, vocabulary or device type)."
+            )
+
+    def get_many(self, ngram_examples: list[tuple[int]]) -> dict[tuple[int], bool]:
+        """Outcome of the (previous token, target) bigrams whose previous token has a row, the others are left out."""
+        covered = [ngram_example for ngram_example in ngram_examples if 0 <= ngram_example[0] < self.rows]
+        if not covered:
+            return {}
+        prefixes, targets = torch.as_tensor(covered).unbind(dim=1)
+        # targets outside of the vocabulary can never be on the greenlist
+        in_vocab = (targets >= 0) & (targets < self.vocab_size)
+        targets = targets.clamp(0, self.vocab_size - 1)
+        bits = (self._bitmap[prefixes, targets >> 3] >> (targets & 7).to(torch.uint8)) & 1
+        return dict(zip(covered, (bits.bool() & in_vocab).tolist()))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Precompute the greenlists of a context width 1 seeding scheme.")
+    parser.add_argument("--tokenizer", required=True, help="Tokenizer name or directory, it defines the vocabulary.")
+    parser.add_argument("--seeding-scheme", default="lefthash", help="simple_1/lefthash or an ff-<prf>-1-False[-hash_key] scheme.")
+    parser.add_argument("--gamma", type=float, default=0.25, help="Fraction of the vocabulary on each greenlist.")
+    parser.add_argument("--device", default="cpu", help="Device type detection runs on, it changes the drawn greenlists.")
+    parser.add_argument("--workers", type=int, default=None, help="Threads drawing greenlists, defaults to all cores.")
+    parser.add_argument("--output", required=True, help="Bitmap file to write.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    import logging
+
+    from transformers import AutoTokenizer
+
+    from backend.watermark.extended_watermark_processor import WatermarkDetector
+
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args(argv)
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    detector = WatermarkDetector(
+        vocab=list(tokenizer.get_vocab().values()),
+        gamma=args.gamma,
+        seeding_scheme=args.seeding_scheme,
+        device=args.device,
+        tokenizer=tokenizer,
+        normalizers=[],
+        greenlist_workers=1,
+    )
+    rows = build_greenlist_bitmap(detector, args.output, args.workers)
+    logger.info(f"Wrote {rows} greenlists of {detector.vocab_size} tokens to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""Caches for greenlist membership lookups of the WatermarkDetector.
+
+An entry records whether `target` is on the greenlist seeded by `prefix`. Entries are keyed by a 64 bit digest of the
+detector settings and the (prefix, target) pair, so a single cache can serve detectors with different settings.
+Every entry is packed into one unsigned 64 bit word, `(digest >> 1) << 1 | is_green`, which is also the layout of
+the on-disk snapshots, so snapshots can be exchanged between the cache backends.
+
+* LRUGreenlistCache keeps entries in process memory and evicts the least recently used ones.
+* SharedMemoryGreenlistCache keeps entries in a fixed-size hash table in shared memory, so that all worker processes
+  on a host read and fill the same table. Colliding entries overwrite each other.
+"""
+
+from __future__ import annotations
+
+import collections
+import hashlib
+import os
+import struct
+import threading
+from abc import ABC, abstractmethod
+from array import array
+from logging import getLogger
+from multiprocessing import resource_tracker, shared_memory
+
+logger = getLogger(__name__)
+
+SNAPSHOT_MAGIC = b"MACDETGL"
+SNAPSHOT_VERSION = 1
+# Words before the slots of a shared table, and the tag in its first word that identifies the layout
+SHARED_HEADER_WORDS = 4
+SHARED_LAYOUT_TAG = int.from_bytes(b"MACDETG1", "little")
+
+
+def cache_namespace(*settings) -> bytes:
+    """Digest of the detector settings a greenlist depends on, used to keep entries of different settings apart."""
+    return hashlib.blake2b("-".join(str(setting) for setting in settings).encode(), digest_size=16).digest()
+
+
+def ngram_cache_key(namespace: bytes, prefix: tuple[int], target: int) -> int:
+    """64 bit key of a (prefix, target) lookup, never 0 after packing."""
+    digest = hashlib.blake2b(struct.pack(f"<{len(prefix) + 1}q", *prefix, target), digest_size=8, key=namespace).digest()
+    return int.from_bytes(digest, "little") | 2  # keep (key >> 1) non-zero so packed entries are never 0
+
+
+def pack_entry(key: int, is_green: bool) -> int:
+    return (key >> 1) << 1 | int(is_green)
+
+
+class GreenlistCache(ABC):
+    """Base class with the hit/miss bookkeeping and snapshot handling shared by all backends."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._stats_lock = threading.Lock()
+
+    def get_many(self, keys: list[int]) -> dict[int, bool]:
+        """Return the cached outcome of the keys that are present."""
+        found = self._get_many(keys)
+        with self._stats_lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, outcomes: dict[int, bool]) -> None:
+        self._put_entries([pack_entry(key, is_green) for key, is_green in outcomes.items()])
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "size": len(self),
+            "capacity": self.capacity,
+        }
+
+    def save(self, path: str) -> int:
+        """Write all entries to `path`, returns the number of entries written."""
+        entries = array("Q", self._entries())
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(SNAPSHOT_MAGIC + struct.pack("<IQ", SNAPSHOT_VERSION, len(entries)))
+            entries.tofile(file)
+        os.replace(tmp_path, path)  # readers never see a half-written snapshot
+        return len(entries)
+
+    def load(self, path: str) -> int:
+        """Warm the cache from a snapshot written by `save`, returns the number of entries read."""
+        with open(path, "rb") as file:
+            header = file.read(len(SNAPSHOT_MAGIC) + struct.calcsize("<IQ"))
+            if not header.startswith(SNAPSHOT_MAGIC):
+                raise ValueError(f"{path} is not a greenlist cache snapshot.")
+            version, count = struct.unpack("<IQ", header[len(SNAPSHOT_MAGIC) :])
+            if version != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported greenlist cache snapshot version {version} in {path}.")
+            entries = array("Q")
+            entries.fromfile(file, count)
+        self._put_entries(entries)
+        return count
+
+    def close(self) -> None:
+        pass
+
+    # Backend interface
+    capacity: int = 0
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Number of cached entries."""
+
+    @abstractmethod
+    def _get_many(self, keys: list[int]) -> dict[int, bool]:
+        """Outcomes of the keys that are present, without touching the statistics."""
+
+    @abstractmethod
+    def _put_entries(self, entries) -> None:
+        """Store packed (tag, outcome) entries, counting the evictions."""
+
+    @abstractmethod
+    def _entries(self):
+        """Iterate over the packed entries, for snapshots."""
+
+
+class LRUGreenlistCache(GreenlistCache):
+    """Process-local cache holding at most `max_entries` entries, evicting the least recently used one first."""
+
+    def __init__(self, max_entries: int = 2**20):
+        super().__init__()
+        self.capacity = max_entries
+        self._entries_by_tag = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries_by_tag)
+
+    def _get_many(self, keys: list[int]) -> dict[int, bool]:
+        found = {}
+        with self._lock:
+            for key in keys:
+                tag = key >> 1
+                is_green = self._entries_by_tag.get(tag)
+                if is_green is not None:
+                    self._entries_by_tag.move_to_end(tag)
+                    found[key] = is_green
+        return found
+
+    def _put_entries(self, entries) -> None:
+        with self._lock:
+            for entry in entries:
+                self._entries_by_tag[entry >> 1] = bool(entry & 1)
+                self._entries_by_tag.move_to_end(entry >> 1)
+            evicted = max(len(self._entries_by_tag) - self.capacity, 0)
+            for _ in range(evicted):
+                self._entries_by_tag.popitem(last=False)
+        if evicted:
+            with self._stats_lock:
+                self.evictions += evicted
+
+    def _entries(self):
+        with self._lock:
+            return [tag << 1 | int(is_green) for tag, is_green in self._entries_by_tag.items()]
+
+
+class SharedMemoryGreenlistCache(GreenlistCache):
+    """Open-addressing hash table of packed entries in a named shared memory segment.
+
+    The first process to open `name` creates the segment, later processes attach to it, and it outlives them all until
+    `unlink` is called (or the host restarts). A segment left behind with another layout or capacity, e.g. by a
+    previous deployment with a different `max_entries`, is replaced by a new one.
+
+    The segment starts with a header of SHARED_HEADER_WORDS words (layout tag, capacity, occupied slots) followed by
+    the slots. Each slot is one aligned 64 bit word, so a slot is always read and written as a whole. Concurrent
+    writers can at worst overwrite each other's entries, which only costs a recompute. The occupied slot count is
+    updated without a lock across processes, so it is approximate.
+    """
+
+    probe_length = 8
+
+    def __init__(self, name: str = "macdet-greenlist", max_entries: int = 2**22):
+        super().__init__()
+        # round up to a power of two so slots can be found with a mask
+        self.capacity = 1 << max(max_entries - 1, 1).bit_length()
+        self._mask = self.capacity - 1
+        size = (SHARED_HEADER_WORDS + self.capacity) * 8
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            logger.info(f"Created shared greenlist cache '{name}' with {self.capacity} slots.")
+        except FileExistsError:
+            self._shm = shared_memory.SharedMemory(name=name)
+            if not self._matches(size):
+                logger.warning(f"Replacing shared greenlist cache '{name}', it has another layout or capacity than {self.capacity} slots.")
+                self._shm.close()
+                stale = shared_memory.SharedMemory(name=name)
+                stale.unlink()  # processes still attached keep their mapping until they close it
+                stale.close()
+                self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        # The segment is shared by all workers, so no single process should remove it when it exits
+        if os.name == "posix":
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+        words = self._shm.buf[:size].cast("Q")
+        self._header = words[:SHARED_HEADER_WORDS]
+        self._slots = words[SHARED_HEADER_WORDS:]
+        words.release()
+        # a fresh segment is all zeros, which is a valid empty table, so writing the header again is harmless
+        self._header[0] = SHARED_LAYOUT_TAG
+        self._header[1] = self.capacity
+
+    def _matches(self, size: int) -> bool:
+        """Whether the attached segment holds a table of the expected layout and capacity."""
+        if self._shm.size < size:
+            return False
+        tag, capacity = struct.unpack_from("QQ", self._shm.buf)
+        # a zero header is a segment another process has just created and not written the header of yet
+        return (tag, capacity) in ((0, 0), (SHARED_LAYOUT_TAG, self.capacity))
+
+    def __len__(self) -> int:
+        return min(self._header[2], self.capacity)
+
+    def _get_many(self, keys: list[int]) -> dict[int, bool]:
+        slots, mask = self._slots, self._mask
+        found = {}
+        for key in keys:
+            tag = key >> 1
+            home = tag & mask
+            for i in range(self.probe_length):
+                entry = slots[(home + i) & mask]
+                if entry == 0:
+                    break
+                if entry >> 1 == tag:
+                    found[key] = bool(entry & 1)
+                    break
+        return found
+
+    def _put_entries(self, entries) -> None:
+        slots, mask = self._slots, self._mask
+        filled = evicted = 0
+        for entry in entries:
+            tag = entry >> 1
+            home = tag & mask
+            for i in range(self.probe_length):
+                slot = (home + i) & mask
+                current = slots[slot]
+                if current == 0 or current >> 1 == tag:
+                    slots[slot] = entry
+                    filled += current == 0
+                    break
+            else:
+                # all candidate slots are taken, evict the entry in the home slot
+                slots[home] = entry
+                evicted += 1
+        with self._stats_lock:
+            self._header[2] += filled
+            self.evictions += evicted
+
+    def _entries(self):
+        return [entry for entry in self._slots.tolist() if entry != 0]
+
+    def close(self) -> None:
+        self._header.release()
+        self._slots.release()
+        self._shm.close()
+
+    def unlink(self) -> None:
+        """Remove the shared memory segment from the host."""
+        if os.name == "posix":
+            resource_tracker.register(self._shm._name, "shared_memory")  # unlink unregisters it again
+        self._shm.unlink()
+
+
+def make_greenlist_cache(backend: str | None, max_entries: int, name: str = "macdet-greenlist") -> GreenlistCache | None:
+    if backend is None:
+        return None
+    if backend == "lru":
+        return LRUGreenlistCache(max_entries=max_entries)
+    if backend == "shared":
+        return SharedMemoryGreenlistCache(name=name, max_entries=max_entries)
+    raise ValueError(f"Unknown greenlist cache backend '{backend}'. Try 'lru' or 'shared'.")
@@ -1,7 +1,23 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 class DetectionRequest(BaseModel):
     text: str
+    # Windowed detection: comma separated window sizes, or "max" for every size. None scores the text as a whole.
+    window_size: str | None = Field(default=None, pattern=r"^(max|[1-9]\d*(,[1-9]\d*)*)$")
+    window_stride: int = Field(default=1, ge=1)
+    # Report the spans with the highest z-scores, scanning every window size when no window_size is given
+    localize: bool = False
+    max_spans: int = Field(default=5, ge=1)
+
+
+class WatermarkSpan(BaseModel):
+    start_token: int
+    end_token: int
+    num_tokens_scored: int
+    num_green_tokens: int
+    z_score: float
+    p_value: float
+    text: str | None = None
 
 # {
 #     "label": "machine-generated",
@@ -23,6 +39,9 @@ class WatermarkDetectionResponse(BaseModel):
     z_score: float | None = None
     p_value: float | None = None
     detection_threshold: float | None = None
+    # Only set by windowed detection
+    window_size: int | None = None
+    spans: list[WatermarkSpan] | None = None
 
 
 class Error(BaseModel):
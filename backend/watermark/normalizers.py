@@ -11,7 +11,6 @@ from functools import cache
 
 import re
 import unicodedata
-import backend.watermark.homoglyphs as hg
 
 
 def normalization_strategy_lookup(strategy_name: str) -> object:
@@ -39,6 +38,8 @@ class HomoglyphCanonizer:
         return self._sanitize_text(target_category, homoglyph_table, homoglyphed_str)
 
     def _categorize_text(self, text: str) -> dict:
+        import backend.watermark.homoglyphs as hg
+
         iso_categories = defaultdict(int)
         # self.iso_languages = defaultdict(int)
 
@@ -54,6 +55,8 @@ class HomoglyphCanonizer:
     def _select_canon_category_and_load(
         self, target_category: str, all_categories: tuple[str]
     ) -> dict:
+        import backend.watermark.homoglyphs as hg
+
         homoglyph_table = hg.Homoglyphs(
             categories=(target_category, "COMMON")
         )  # alphabet loaded here from file
@@ -67,6 +70,8 @@ class HomoglyphCanonizer:
     def _sanitize_text(
         self, target_category: str, homoglyph_table: dict, homoglyphed_str: str
     ) -> str:
+        import backend.watermark.homoglyphs as hg
+
         sanitized_text = ""
         for char in homoglyphed_str:
             # langs = hg.Languages.detect(char)
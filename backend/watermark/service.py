@@ -1,10 +1,15 @@
 from argparse import Namespace
-from backend.watermark.utils import preprocess, detect, watermarkedtext
+from backend.watermark.utils import preprocess, detect, detection_outputs, watermarkedtext
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
 from backend.watermark.models import DetectionRequest, WatermarkDetectionResponse, Error
-from langdetect import detect as lang_detect, DetectorFactory, LangDetectException
 from backend.watermark.extended_watermark_processor import WatermarkDetector
 from backend.watermark.helpers import load_model
+from backend.watermark.greenlist_bitmap import GreenlistBitmap
+from backend.watermark.greenlist_cache import make_greenlist_cache
+from backend.watermark.streaming import StreamingDetection
+from backend import metrics
+from logging import getLogger
+import os
 # Conditionally import torch if available in the environment
 try:
     import torch
@@ -34,8 +39,37 @@ config = {
     'load_fp16': False,
     'low_cpu_mem_usage': False,
     'max_shard_size': '200MB',
+    # Greenlist lookup cache: 'shared' (one table for all workers on the host), 'lru' (per process) or None
+    'greenlist_cache': 'shared',
+    'greenlist_cache_max_entries': 2**22,  # 8 bytes per entry for the shared table
+    'greenlist_cache_name': 'macdet-greenlist',
+    # Optional snapshot file, read at startup to warm the cache and written at shutdown
+    'greenlist_cache_snapshot': None,
+    # Seeding scheme texts are detected with, must match the one they were generated with
+    'detection_seeding_scheme': 'selfhash',
+    # Optional greenlist bitmap built by greenlist_bitmap.py, only for context width 1 schemes like lefthash
+    'greenlist_bitmap': None,
+    # Longest text a /watermark/stream connection may send, the stream's state grows with it
+    'stream_max_chars': 100_000,
 }
 
+logger = getLogger(__name__)
+
+
+def window_kwargs(detection_request) -> dict:
+    """Arguments of WatermarkDetector.detect for the windowed detection a request asks for, if any."""
+    window_size = getattr(detection_request, "window_size", None)
+    localize = getattr(detection_request, "localize", False)
+    if window_size is None and not localize:
+        return {}
+    return {
+        "window_size": window_size or "max",
+        "window_stride": detection_request.window_stride,
+        "max_spans": detection_request.max_spans if localize else 0,
+        "return_z_at_T": False,
+    }
+
+
 class InferenceEngine:
     def __init__(self):
         
@@ -47,26 +81,93 @@ class InferenceEngine:
         self.model = model
         self.tokenizer = tokenizer
         self.device = device
+        self.greenlist_cache = make_greenlist_cache(
+            args.greenlist_cache,
+            max_entries=args.greenlist_cache_max_entries,
+            name=args.greenlist_cache_name,
+        )
+        self.greenlist_cache_snapshot = args.greenlist_cache_snapshot
+        if self.greenlist_cache is not None and self.greenlist_cache_snapshot and os.path.exists(self.greenlist_cache_snapshot):
+            try:
+                count = self.greenlist_cache.load(self.greenlist_cache_snapshot)
+                logger.info(f"Warmed the greenlist cache with {count} entries from {self.greenlist_cache_snapshot}.")
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not warm the greenlist cache: {str(e)}")
         self.watermark_detector = WatermarkDetector(vocab=list(tokenizer.get_vocab().values()),
                                             gamma=0.25, # should match original setting
-                                            seeding_scheme="selfhash", # should match original setting
+                                            seeding_scheme=args.detection_seeding_scheme, # should match original setting
                                             device=model.device, # must match the original rng device type
                                             tokenizer=tokenizer,
                                             z_threshold=1.5,
                                             normalizers=[],
-                                            ignore_repeated_ngrams=True)
+                                            ignore_repeated_ngrams=True,
+                                            greenlist_cache=self.greenlist_cache)
+        if args.greenlist_bitmap:
+            try:
+                greenlist_bitmap = GreenlistBitmap(args.greenlist_bitmap)
+                greenlist_bitmap.check(self.watermark_detector)
+                self.watermark_detector.greenlist_bitmap = greenlist_bitmap
+                logger.info(f"Mapped {greenlist_bitmap.rows} precomputed greenlists from {args.greenlist_bitmap}.")
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not use the greenlist bitmap: {str(e)}")
 
 
+    def normalize_text(self, text: str) -> str:
+        """The text as the model sees it, used to key cached results."""
+        return preprocess(text)
+
     def predict(self, detection_request: DetectionRequest) -> WatermarkDetectionResponse:
         """
         Run inference on the input text and return a DetectionResponse.
         """
         if not torch_available:
             raise ImportError("torch is not available in the environment.")
-        inputs = preprocess(detection_request.text)
-        outputs = detect(inputs, self.watermark_detector, self.device)
+        with metrics.time_stage("watermark", "preprocess"):
+            inputs = preprocess(detection_request.text)
+        with metrics.time_stage("watermark", "ngram_scoring"):
+            outputs = detect(inputs, self.watermark_detector, self.device, **window_kwargs(detection_request))
+        metrics.texts_total.inc("watermark")
+        metrics.tokens_total.inc("watermark", amount=outputs.get("num_tokens_scored") or 0)
         watermarked_output = '' #watermarkedtext(inputs, self.tokenizer, self.model, self.device)
         return WatermarkDetectionResponse(
             text=watermarked_output,
             **outputs
-        )
\ No newline at end of file
+        )
+
+    def predict_batch(self, detection_requests: list[DetectionRequest]) -> list[WatermarkDetectionResponse]:
+        """
+        Run inference on several texts. The greenlists of all their ngrams are computed in one bulk pass.
+        """
+        if not torch_available:
+            raise ImportError("torch is not available in the environment.")
+        with metrics.time_stage("watermark", "preprocess"):
+            inputs = [preprocess(detection_request.text) for detection_request in detection_requests]
+        with metrics.time_stage("watermark", "ngram_scoring"):
+            score_dicts = self.watermark_detector.detect_many(inputs)
+        metrics.batch_size.observe("watermark", value=len(inputs))
+        metrics.texts_total.inc("watermark", amount=len(inputs))
+        metrics.tokens_total.inc("watermark", amount=sum(score_dict.get("num_tokens_scored") or 0 for score_dict in score_dicts))
+        return [
+            WatermarkDetectionResponse(text='', **detection_outputs(score_dict))
+            for score_dict in score_dicts
+        ]
+
+    def open_stream(self) -> StreamingDetection:
+        """
+        Start the incremental detection of a text that arrives in pieces, see streaming.py.
+        """
+        return StreamingDetection(self.watermark_detector, max_chars=config['stream_max_chars'])
+
+    def close(self):
+        """Stop the greenlist workers, write the greenlist cache snapshot, if configured, and detach from the cache."""
+        # the workers read and fill the cache, so they are stopped before it is released
+        self.watermark_detector.close()
+        if self.greenlist_cache is None:
+            return
+        if self.greenlist_cache_snapshot:
+            try:
+                count = self.greenlist_cache.save(self.greenlist_cache_snapshot)
+                logger.info(f"Saved {count} greenlist cache entries to {self.greenlist_cache_snapshot}.")
+            except OSError as e:
+                logger.warning(f"Could not save the greenlist cache: {str(e)}")
+        self.greenlist_cache.close()
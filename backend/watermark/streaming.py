@@ -0,0 +1,128 @@
+"""
+Incremental watermark detection of a text that arrives in pieces, e.g. tokens streamed from an LLM.
+
+A StreamingDetection keeps the tokens of the text received so far together with the counts the z-score is computed
+from, so an increment only costs tokenizing the tail of the text and scoring the n-grams it adds. The tail is
+re-tokenized from a few tokens back, since an increment can merge with the end of the previous one (" wat" + "ermark").
+Tokens the re-tokenization changes are retracted together with their n-grams before the new ones are counted.
+
+Streamed text is scored as sent, without the engine's preprocessing, which is not stable under appending text.
+The state grows with the text, so a stream is capped at `max_chars` characters.
+"""
+
+from __future__ import annotations
+
+import collections
+
+from backend.watermark.extended_watermark_processor import WatermarkDetector
+
+# Number of trailing tokens re-tokenized together with every increment
+RETOKENIZE_TOKENS = 8
+
+
+class StreamingDetection:
+    """Detection state of one stream, updated by `push` with every increment of the text."""
+
+    def __init__(self, detector: WatermarkDetector, retokenize_tokens: int = RETOKENIZE_TOKENS, max_chars: int | None = None):
+        if not getattr(detector.tokenizer, "is_fast", False):
+            raise ValueError("Streaming detection needs a fast tokenizer, which reports token offsets.")
+        self.detector = detector
+        self.retokenize_tokens = retokenize_tokens
+        self.max_chars = max_chars
+        self.ngram_size = detector.context_width + 1 - detector.self_salt
+        self.text = ""
+        self.tokens = []
+        # character offset in `text` where each token ends
+        self.token_ends = []
+        self.frequencies = collections.Counter()
+        # watermark outcome of every n-gram seen in the stream
+        self.outcomes = {}
+        self.green_positions = 0
+        self.green_unique = 0
+
+    def push(self, increment: str) -> dict:
+        """Append `increment` to the text and return the updated scores. Raises ValueError past `max_chars`."""
+        if self.max_chars is not None and len(self.text) + len(increment) > self.max_chars:
+            raise ValueError(f"The stream is longer than the limit of {self.max_chars} characters.")
+        self.text += increment
+        keep = max(0, len(self.tokens) - self.retokenize_tokens)
+        start = self.token_ends[keep - 1] if keep else 0
+        encoding = self.detector.tokenizer(self.text[start:], add_special_tokens=False, return_offsets_mapping=True)
+        tail = encoding["input_ids"]
+        tail_ends = [start + end for _, end in encoding["offset_mapping"]]
+
+        # tokens the re-tokenization left unchanged stay counted
+        unchanged = 0
+        while keep + unchanged < len(self.tokens) and unchanged < len(tail) and self.tokens[keep + unchanged] == tail[unchanged]:
+            unchanged += 1
+        retracted = self._truncate(keep + unchanged)
+        added = self._extend(tail[unchanged:], tail_ends[unchanged:])
+        return {**self.scores(), "tokens_added": added, "tokens_retracted": retracted}
+
+    def _ngram_at(self, position: int) -> tuple[int]:
+        """The n-gram ending with the token at `position`."""
+        return tuple(self.tokens[position - self.ngram_size + 1 : position + 1])
+
+    def _truncate(self, length: int) -> int:
+        removed = len(self.tokens) - length
+        for position in range(max(length, self.ngram_size - 1), len(self.tokens)):
+            ngram = self._ngram_at(position)
+            is_green = self.outcomes[ngram]
+            self.green_positions -= is_green
+            self.frequencies[ngram] -= 1
+            if self.frequencies[ngram] == 0:
+                del self.frequencies[ngram]
+                self.green_unique -= is_green
+        del self.tokens[length:]
+        del self.token_ends[length:]
+        return removed
+
+    def _extend(self, tokens: list[int], token_ends: list[int]) -> int:
+        first = len(self.tokens)
+        self.tokens.extend(tokens)
+        self.token_ends.extend(token_ends)
+        new_ngrams = [self._ngram_at(position) for position in range(max(first, self.ngram_size - 1), len(self.tokens))]
+        missing = list({ngram for ngram in new_ngrams if ngram not in self.outcomes})
+        if missing:
+            self.outcomes.update(self.detector._score_ngrams(missing))
+        for ngram in new_ngrams:
+            is_green = self.outcomes[ngram]
+            self.green_positions += is_green
+            self.frequencies[ngram] += 1
+            if self.frequencies[ngram] == 1:
+                self.green_unique += is_green
+        return len(tokens)
+
+    def scores(self) -> dict:
+        """Scores of the text received so far, the same as WatermarkDetector.detect gives on its tokens."""
+        detector = self.detector
+        if detector.ignore_repeated_ngrams:
+            num_tokens_scored, num_green_tokens = len(self.frequencies), self.green_unique
+        else:
+            num_tokens_scored, num_green_tokens = sum(self.frequencies.values()), self.green_positions
+        if num_tokens_scored == 0:
+            # not enough tokens for a full context yet
+            return {
+                "num_tokens": len(self.tokens),
+                "num_tokens_scored": 0,
+                "num_green_tokens": 0,
+                "green_fraction": None,
+                "z_score": None,
+                "p_value": None,
+                "label": "human-written",
+                "confidence": None,
+                "detection_threshold": detector.z_threshold,
+            }
+        z_score = detector._compute_z_score(num_green_tokens, num_tokens_scored)
+        p_value = float(detector._compute_p_value(z_score))
+        return {
+            "num_tokens": len(self.tokens),
+            "num_tokens_scored": num_tokens_scored,
+            "num_green_tokens": num_green_tokens,
+            "green_fraction": num_green_tokens / num_tokens_scored,
+            "z_score": z_score,
+            "p_value": p_value,
+            "label": "machine-generated" if z_score > detector.z_threshold else "human-written",
+            "confidence": 1 - p_value,
+            "detection_threshold": detector.z_threshold,
+        }
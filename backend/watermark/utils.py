@@ -1,5 +1,5 @@
 import torch
-from cleantext import clean
+from backend.preprocessing import preprocess as shared_preprocess
 from transformers import AutoTokenizer, AutoModelForSequenceClassification,LogitsProcessorList
 from backend.watermark.extended_watermark_processor import WatermarkLogitsProcessor
 
@@ -7,34 +7,22 @@ def preprocess(text):
     """
     Preprocess input text: removes unnecessary line breaks, normalizes punctuation, and cleans text.
     """
-    # Normalize line breaks
-    text = text.replace("\n", " ").replace("\\n", " ").strip()
-    
-    # Normalize text using cleantext library
-    text = clean(
-        text,
-        fix_unicode=True,
-        to_ascii=True,
-        lower=False,
-        no_line_breaks=True,
-        no_urls=True,
-        no_emails=True,
-        no_phone_numbers=True,
-        no_numbers=False,
-        no_digits=False,
-        no_currency_symbols=False,
-        no_punct=False,
-        lang="en"
-    )
-    return text
+    return shared_preprocess(text, "basic")
 
-def detect(input_text, watermark_detector, device="cpu"):
+def detect(input_text, watermark_detector, device="cpu", **window_kwargs):
     """
     Perform inference using the provided model and tokenizer.
+    `window_kwargs` (window_size, window_stride, max_spans) switch to windowed detection.
     """
     
-    score_dict = watermark_detector.detect(input_text) 
+    score_dict = watermark_detector.detect(input_text, **window_kwargs)
+
+    return detection_outputs(score_dict)
 
+def detection_outputs(score_dict):
+    """
+    Turn the score dictionary of the watermark detector into the response fields.
+    """
     return {
         "label": "machine-generated" if score_dict['prediction'] else "human-written",
         "confidence": round(1 - score_dict['p_value'], 4),  # Rounded for better readability
@@ -44,6 +32,8 @@ def detect(input_text, watermark_detector, device="cpu"):
         "z_score": round(score_dict.get('z_score', 0), 4),
         "p_value": round(score_dict.get('p_value', 0), 8),  # Rounded for precision in display
         "detection_threshold": 2.0,  # The z_threshold used in the detection logic
+        "window_size": score_dict.get('window_size', None),
+        "spans": score_dict.get('spans', None),
     }
     
     
@@ -1,10 +1,81 @@
 from backend.watermark import router
 from backend.watermark.models import DetectionRequest, WatermarkDetectionResponse, Error
 from backend.models import EngineHub
+from backend.gateway import parse_batch_texts, stream_engine_batch, unavailable
+from backend import metrics
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.requests import Request
+from fastapi.responses import StreamingResponse
+import asyncio
+import json
 
 @router.post("/infer")
 async def infer(request: DetectionRequest) -> WatermarkDetectionResponse | Error:
     engine = EngineHub.get("watermark", None)
     if engine is None:
-        return Error(message="Engine not found.")
-    return engine.predict(request)
+        return Error(message=str(unavailable("watermark")))
+    # the windowed scan is CPU bound, it runs in a worker thread to keep the event loop free
+    try:
+        return await asyncio.to_thread(engine.predict, request)
+    except ValueError as e:
+        # texts too short to score, or without a window that fits
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/infer/batch")
+async def infer_batch(request: Request):
+    """
+    Batch inference over a JSON {"texts": [...]} body or an NDJSON body of {"text": ...} lines.
+    Results are streamed back as NDJSON, one line per text in input order.
+    """
+    engine = EngineHub.get("watermark", None)
+    if engine is None:
+        return Error(message=str(unavailable("watermark")))
+    texts = await parse_batch_texts(request)
+    return StreamingResponse(stream_engine_batch("watermark", texts), media_type="application/x-ndjson")
+
+@router.websocket("/stream")
+async def stream(websocket: WebSocket):
+    """
+    Incremental detection of a text sent in pieces. Every message is a text increment, either as raw text or as
+    {"text": ...}, and is answered with the scores of the whole text received so far. A stream longer than
+    config['stream_max_chars'] is answered with an error and closed with code 1009.
+    """
+    await websocket.accept()
+    engine = EngineHub.get("watermark", None)
+    if engine is None:
+        await websocket.send_json(Error(message=str(unavailable("watermark"))).model_dump())
+        await websocket.close(code=1013)
+        return
+    detection = engine.open_stream()
+    try:
+        while True:
+            message = await websocket.receive_text()
+            try:
+                payload = json.loads(message)
+            except ValueError:
+                payload = None
+            increment = payload["text"] if isinstance(payload, dict) and isinstance(payload.get("text"), str) else message
+            try:
+                with metrics.time_stage("watermark", "stream_update"):
+                    scores = await asyncio.to_thread(detection.push, increment)
+            except ValueError as e:
+                # the stream is over its length limit
+                await websocket.send_json(Error(message=str(e)).model_dump())
+                await websocket.close(code=1009)
+                return
+            metrics.tokens_total.inc("watermark", amount=scores["tokens_added"])
+            await websocket.send_json(scores)
+    except WebSocketDisconnect:
+        pass
+
+@router.get("/cache")
+async def cache_stats():
+    """
+    Hit/miss/size statistics of the greenlist lookup cache.
+    """
+    engine = EngineHub.get("watermark", None)
+    if engine is None:
+        return Error(message=str(unavailable("watermark")))
+    if engine.greenlist_cache is None:
+        return Error(message="Greenlist cache is disabled.")
+    return engine.greenlist_cache.stats()
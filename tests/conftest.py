@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from backend.watermark.extended_watermark_processor import WatermarkDetector
+from backend.watermark.greenlist_cache import LRUGreenlistCache
+
+
+class DigitTokenizer:
+    """Tokenizes a text of space separated token ids."""
+
+    bos_token_id = None
+
+    def __call__(self, text, return_tensors=None, add_special_tokens=False):
+        return {"input_ids": torch.tensor([[int(token) for token in text.split()]])}
+
+    def decode(self, token_ids):
+        return " ".join(str(int(token_id)) for token_id in token_ids)
+
+
+@pytest.fixture
+def make_detector():
+    """
+    Factory of watermark detectors over a vocabulary of 1000 token ids, with a private greenlist cache. Unless given
+    otherwise, they use a gamma of 0.25 and tokenize texts of digits. The detectors are closed when the test ends.
+    """
+    detectors = []
+
+    def make(seeding_scheme="selfhash", ignore_repeated_ngrams=True, greenlist_workers=1, **kwargs):
+        detector = WatermarkDetector(
+            vocab=list(range(1000)),
+            gamma=kwargs.pop("gamma", 0.25),
+            seeding_scheme=seeding_scheme,
+            device="cpu",
+            tokenizer=kwargs.pop("tokenizer", DigitTokenizer()),
+            z_threshold=4.0,
+            normalizers=[],
+            ignore_repeated_ngrams=ignore_repeated_ngrams,
+            greenlist_workers=greenlist_workers,
+            greenlist_cache=kwargs.pop("greenlist_cache", LRUGreenlistCache()),
+            **kwargs,
+        )
+        detectors.append(detector)
+        return detector
+
+    yield make
+    for detector in detectors:
+        detector.close()
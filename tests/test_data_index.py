@@ -0,0 +1,38 @@
+import csv
+
+from backend.data.index import RecordIndex, get_index, index_path_for, parse_record
+from backend.evaluation import iter_records
+
+# Longer than the default csv field limit of 131072 characters
+LONG_TEXT = "word " * 40000
+
+
+def write_testbed(path) -> None:
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["text", "label"])
+        writer.writerow(["a short text", 1])
+        writer.writerow([LONG_TEXT, 0])
+        writer.writerow(["a quoted text,\nover two lines", 1])
+
+
+def test_parse_record_of_a_long_text():
+    assert parse_record(f'"{LONG_TEXT}",0\n'.encode()) == (LONG_TEXT, 0)
+    assert parse_record(b"text,label\n") is None
+
+
+def test_index_of_a_testbed_with_long_texts(tmp_path):
+    path = str(tmp_path / "testbed.csv")
+    write_testbed(path)
+    index_dir = str(tmp_path / ".index")
+    index = get_index(path, index_dir)
+    assert len(index) == 3
+    assert index.read(1) == (LONG_TEXT, 0)
+    assert index.read(2) == ("a quoted text,\nover two lines", 1)
+    assert list(RecordIndex.load(path, index_path_for(path, index_dir)).labels) == [1, 0, 1]
+
+
+def test_evaluation_reads_long_texts(tmp_path):
+    path = str(tmp_path / "testbed.csv")
+    write_testbed(path)
+    assert [label for _, label in iter_records(path)] == [1, 0, 1]
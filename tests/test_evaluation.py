@@ -0,0 +1,40 @@
+import pytest
+
+from backend.evaluation import EngineReport, percentile
+
+
+def batch(seconds: float, predictions: list, labels: list[int], file_path: str = "testbed.csv") -> dict:
+    return {
+        "file_path": file_path,
+        "labels": labels,
+        "num_tokens": [10] * len(labels),
+        "predictions": {"engine": predictions},
+        "seconds": {"engine": seconds},
+    }
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([3.0, 1.0, 2.0], 50) == 2.0
+    assert percentile([1.0, 2.0, 3.0], 99) == 3.0
+
+
+def test_latency_is_reported_per_batch():
+    report = EngineReport()
+    report.add(batch(0.1, ["machine-generated"] * 4, [0] * 4), "engine")
+    report.add(batch(0.1, ["human-written"] * 4, [1] * 4), "engine")
+    report.add(batch(1.0, ["human-written"] * 2, [0] * 2), "engine")
+    summary = report.summary()
+    # the slow batch is the tail, it is not averaged out over the texts of the other batches
+    assert summary["batch_latency_ms"]["p50"] == pytest.approx(100)
+    assert summary["batch_latency_ms"]["p99"] == pytest.approx(1000)
+    assert summary["throughput"]["texts_per_s"] == pytest.approx(10 / 1.2)
+    assert summary["accuracy"] == pytest.approx(8 / 10)
+
+
+def test_failed_predictions_are_counted_apart():
+    report = EngineReport()
+    report.add(batch(0.5, [None, "machine-generated"], [0, 0]), "engine")
+    summary = report.summary()
+    assert summary["failed"] == 1
+    assert summary["count"] == 1 and summary["accuracy"] == 1.0
@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from backend.execution import EagerBackend, TracedBackend, make_backend
+
+# torch warns that TorchScript tracing is deprecated
+pytestmark = pytest.mark.filterwarnings("ignore::FutureWarning")
+
+
+class Classifier(torch.nn.Module):
+    """A sequence classifier with the HuggingFace call signature, recording the lengths it runs on."""
+
+    def __init__(self, with_parameters: bool = True):
+        super().__init__()
+        self.embeddings = torch.nn.Embedding(10, 2) if with_parameters else None
+        self.lengths = []
+
+    def forward(self, input_ids, attention_mask, return_dict=True):
+        self.lengths.append(input_ids.shape[1])
+        hidden = self.embeddings(input_ids) if self.embeddings is not None else torch.zeros(*input_ids.shape, 2)
+        logits = (hidden * attention_mask.unsqueeze(-1)).sum(dim=1)
+        return SimpleNamespace(logits=logits) if return_dict else (logits,)
+
+
+def test_eager_warmup_runs_the_shortest_length_only():
+    model = Classifier()
+    make_backend("eager", model).warmup([4096, 512, 1024], token_id=1)
+    assert model.lengths == [512]
+
+
+def test_eager_warmup_without_lengths_or_parameters():
+    model = Classifier(with_parameters=False)
+    backend = EagerBackend(model)
+    backend.warmup([], token_id=1)
+    assert model.lengths == []
+    backend.warmup([8, 4], token_id=1)
+    assert model.lengths == [4]
+
+
+def test_trace_warmup_traces_every_length():
+    model = Classifier()
+    backend = TracedBackend(model)
+    backend.warmup([16, 8], token_id=1)
+    assert backend.lengths == [8, 16]
+    assert set(backend._traces) == {(1, 8), (1, 16)}
+
+
+@pytest.mark.parametrize("name", ["eager", "trace"])
+def test_backends_agree_after_warmup(name):
+    model = Classifier()
+    backend = make_backend(name, model)
+    backend.warmup([8, 16], token_id=1)
+    input_ids = torch.randint(0, 10, (2, 5))
+    attention_mask = torch.ones_like(input_ids)
+    expected = model(input_ids, attention_mask).logits
+    assert torch.allclose(backend(input_ids, attention_mask), expected)
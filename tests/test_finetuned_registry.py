@@ -0,0 +1,56 @@
+import warnings
+
+import pytest
+import torch
+
+from backend.finetuned.registry import ModelRegistry, model_size
+from backend.quantization import quantize_dynamic_int8
+
+
+class StubTokenizer:
+    pad_token_id = 0
+    unk_token_id = 1
+
+
+def make_model(quantize: bool) -> torch.nn.Module:
+    # like the classifiers, the embeddings stay in fp32 when the linear layers are quantized
+    model = torch.nn.Sequential(torch.nn.Embedding(100, 256), torch.nn.Linear(256, 256), torch.nn.ReLU(), torch.nn.Linear(256, 2))
+    if quantize:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            model = quantize_dynamic_int8(model)
+    return model
+
+
+def test_model_size_of_fp32_model():
+    model = make_model(quantize=False)
+    assert model_size(model) == sum(parameter.numel() * 4 for parameter in model.parameters())
+
+
+def test_model_size_counts_int8_weights():
+    embeddings, weights = 100 * 256 * 4, 256 * 256 + 256 * 2
+    size = model_size(make_model(quantize=True))
+    # the int8 weights take one byte each, next to the fp32 biases and the quantization parameters
+    assert embeddings + weights <= size < embeddings + weights + 4096
+
+
+def test_model_size_counts_tied_weights_once():
+    model = torch.nn.Sequential(torch.nn.Embedding(100, 16), torch.nn.Linear(16, 100, bias=False))
+    model[1].weight = model[0].weight
+    assert model_size(model) == 100 * 16 * 4
+
+
+@pytest.mark.parametrize("quantize", [False, True])
+def test_memory_budget_evicts_least_recently_used(quantize):
+    size = model_size(make_model(quantize))
+    registry = ModelRegistry(
+        {"en": "model-en", "de": "model-de", "fr": "model-fr"},
+        memory_budget_mb=1.5 * size / 2**20,
+        load_model=lambda model_dir: (make_model(quantize), StubTokenizer()),
+    )
+    registry.get("en")
+    registry.get("de")
+    assert set(registry.stats()["loaded"]) == {"model-de"}
+    registry.get("fr")
+    assert set(registry.stats()["loaded"]) == {"model-fr"}
+    assert registry.evictions == 2 and registry.memory == size
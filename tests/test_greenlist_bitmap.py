@@ -0,0 +1,58 @@
+import pytest
+import torch
+
+from backend.watermark.extended_watermark_processor import ngrams
+from backend.watermark.greenlist_bitmap import GreenlistBitmap, build_greenlist_bitmap
+
+
+@pytest.fixture
+def bitmap_path(make_detector, tmp_path):
+    path = str(tmp_path / "lefthash.bitmap")
+    assert build_greenlist_bitmap(make_detector("lefthash"), path, workers=2) == 1000
+    return path
+
+
+def test_get_many_matches_drawn_greenlists(make_detector, bitmap_path):
+    detector = make_detector("lefthash")
+    bitmap = GreenlistBitmap(bitmap_path)
+    bitmap.check(detector)
+    # previous tokens and targets run past the vocabulary of 1000 tokens
+    ids = torch.randint(0, 1030, (3000,), generator=torch.Generator().manual_seed(0)).tolist()
+    ngram_examples = list(set(ngrams(ids, 2)))
+    outcomes = bitmap.get_many(ngram_examples)
+    assert set(outcomes) == {ngram for ngram in ngram_examples if ngram[0] < 1000}
+    assert outcomes == {ngram: detector._score_ngrams([ngram])[ngram] for ngram in outcomes}
+    assert any(outcomes.values()) and not all(outcomes.values())
+
+
+def test_detect_with_and_without_bitmap(make_detector, bitmap_path):
+    with_bitmap = make_detector("lefthash", greenlist_bitmap=GreenlistBitmap(bitmap_path))
+    without_bitmap = make_detector("lefthash")
+    for seed in range(3):
+        input_ids = torch.randint(0, 1000, (300,), generator=torch.Generator().manual_seed(seed))
+        expected = without_bitmap.detect(tokenized_text=input_ids)
+        result = with_bitmap.detect(tokenized_text=input_ids)
+        assert result["num_green_tokens"] == expected["num_green_tokens"]
+        assert result["z_score"] == expected["z_score"]
+    # the bitmap answers every lookup, nothing is drawn or cached
+    assert len(with_bitmap.greenlist_cache) == 0
+
+
+@pytest.mark.parametrize("seeding_scheme, kwargs", [
+    ("lefthash", {"gamma": 0.5}),
+    ("ff-additive_prf-1-False-42", {}),  # another hash key
+    ("selfhash", {}),  # not a context width 1 scheme
+])
+def test_check_rejects_other_settings(make_detector, bitmap_path, seeding_scheme, kwargs):
+    bitmap = GreenlistBitmap(bitmap_path)
+    with pytest.raises(ValueError):
+        bitmap.check(make_detector(seeding_scheme, **kwargs))
+    with pytest.raises(ValueError):
+        make_detector(seeding_scheme, greenlist_bitmap=bitmap, **kwargs)
+
+
+def test_truncated_bitmap(bitmap_path):
+    with open(bitmap_path, "r+b") as file:
+        file.truncate(1000)
+    with pytest.raises(ValueError):
+        GreenlistBitmap(bitmap_path)
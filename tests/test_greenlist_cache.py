@@ -0,0 +1,167 @@
+import threading
+import uuid
+from multiprocessing import shared_memory
+
+import pytest
+
+from backend.watermark.greenlist_cache import (
+    GreenlistCache,
+    LRUGreenlistCache,
+    SharedMemoryGreenlistCache,
+    cache_namespace,
+    make_greenlist_cache,
+    ngram_cache_key,
+)
+
+NAMESPACE = cache_namespace("additive_prf", 1, False, 15485863, 0.25, 1000, True, "cpu")
+
+
+def keys(count: int, start: int = 0) -> list[int]:
+    return [ngram_cache_key(NAMESPACE, (prefix,), prefix + 1) for prefix in range(start, start + count)]
+
+
+@pytest.fixture
+def shared_name():
+    name = f"macdet-test-{uuid.uuid4().hex[:12]}"
+    yield name
+    try:
+        segment = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    segment.unlink()
+    segment.close()
+
+
+@pytest.fixture
+def shared_cache(shared_name):
+    cache = SharedMemoryGreenlistCache(name=shared_name, max_entries=1024)
+    yield cache
+    cache.close()
+
+
+def test_keys_differ_between_namespaces():
+    other = cache_namespace("additive_prf", 1, False, 15485863, 0.5, 1000, True, "cpu")
+    assert ngram_cache_key(NAMESPACE, (1,), 2) != ngram_cache_key(other, (1,), 2)
+    assert ngram_cache_key(NAMESPACE, (1,), 2) != ngram_cache_key(NAMESPACE, (2,), 1)
+
+
+@pytest.mark.parametrize(
+    "make_cache",
+    [lambda name: LRUGreenlistCache(max_entries=4096), lambda name: SharedMemoryGreenlistCache(name=name, max_entries=4096)],
+    ids=["lru", "shared"],
+)
+def test_put_and_get(make_cache, shared_name):
+    cache = make_cache(shared_name)
+    try:
+        outcomes = {key: index % 3 == 0 for index, key in enumerate(keys(500))}
+        cache.put_many(outcomes)
+        assert cache.get_many(list(outcomes)) == outcomes
+        assert cache.get_many(keys(10, start=10_000)) == {}
+        assert cache.hits == 500 and cache.misses == 10
+    finally:
+        cache.close()
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUGreenlistCache(max_entries=3)
+    first, second, third, fourth = keys(4)
+    cache.put_many({first: True, second: False, third: True})
+    cache.get_many([first])
+    cache.put_many({fourth: False})
+    assert set(cache.get_many([first, second, third, fourth])) == {first, third, fourth}
+    assert cache.evictions == 1 and len(cache) == 3
+
+
+def test_shared_probing_keeps_colliding_keys(shared_cache):
+    # keys with the same home slot are placed in the following slots of the probe sequence
+    mask = shared_cache.capacity - 1
+    colliding = [((index << 12 | 5) << 1) | 2 for index in range(shared_cache.probe_length)]
+    assert len({(key >> 1) & mask for key in colliding}) == 1
+    shared_cache.put_many({key: True for key in colliding})
+    assert shared_cache.get_many(colliding) == {key: True for key in colliding}
+    assert shared_cache.evictions == 0
+
+    # one more colliding key evicts the entry in the home slot
+    extra = ((shared_cache.probe_length << 12 | 5) << 1) | 2
+    shared_cache.put_many({extra: False})
+    assert shared_cache.evictions == 1
+    assert shared_cache.get_many([extra]) == {extra: False}
+    assert colliding[0] not in shared_cache.get_many(colliding)
+
+
+def test_shared_table_is_seen_by_other_instances(shared_cache, shared_name):
+    other = SharedMemoryGreenlistCache(name=shared_name, max_entries=1024)
+    try:
+        shared_cache.put_many({key: True for key in keys(20)})
+        assert other.get_many(keys(20)) == {key: True for key in keys(20)}
+    finally:
+        other.close()
+
+
+def test_shared_table_with_other_capacity_is_replaced(shared_cache, shared_name):
+    shared_cache.put_many({key: True for key in keys(20)})
+    larger = SharedMemoryGreenlistCache(name=shared_name, max_entries=4096)
+    try:
+        assert larger.capacity == 4096
+        assert larger.get_many(keys(20)) == {}
+        # the old mapping keeps working for the processes still attached to it
+        assert len(shared_cache.get_many(keys(20))) == 20
+    finally:
+        larger.close()
+
+
+def test_shared_evictions_are_counted_under_concurrency(shared_name):
+    cache = SharedMemoryGreenlistCache(name=shared_name, max_entries=16)
+    try:
+        batches = [keys(200, start=thread * 1000) for thread in range(8)]
+        threads = [threading.Thread(target=cache.put_many, args=({key: True for key in batch},)) for batch in batches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = cache.stats()
+        assert stats["capacity"] == 16 and stats["size"] == 16
+        # every entry beyond the first fill of the table evicted one
+        assert stats["evictions"] >= 8 * 200 - 16 * cache.probe_length
+    finally:
+        cache.close()
+
+
+def test_snapshot_round_trip(tmp_path, shared_cache):
+    outcomes = {key: index % 2 == 0 for index, key in enumerate(keys(100))}
+    lru = LRUGreenlistCache()
+    lru.put_many(outcomes)
+    path = str(tmp_path / "greenlist.snapshot")
+    assert lru.save(path) == 100
+    assert shared_cache.load(path) == 100
+    assert shared_cache.get_many(list(outcomes)) == outcomes
+
+
+def test_make_greenlist_cache_rejects_unknown_backends():
+    assert make_greenlist_cache(None, max_entries=10) is None
+    with pytest.raises(ValueError):
+        make_greenlist_cache("redis", max_entries=10)
+
+
+def test_shared_size_counts_occupied_slots(shared_cache, shared_name):
+    shared_cache.put_many({key: True for key in keys(100)})
+    # rewriting entries does not change the count
+    shared_cache.put_many({key: False for key in keys(50)})
+    assert len(shared_cache) == 100 == sum(1 for entry in shared_cache._entries())
+    other = SharedMemoryGreenlistCache(name=shared_name, max_entries=1024)
+    try:
+        assert len(other) == 100
+    finally:
+        other.close()
+
+
+def test_incomplete_backend_fails_when_constructed():
+    class DictCache(GreenlistCache):
+        def __len__(self):
+            return 0
+
+        def _get_many(self, keys):
+            return {}
+
+    with pytest.raises(TypeError):
+        DictCache()
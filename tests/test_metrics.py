@@ -0,0 +1,25 @@
+import pytest
+
+from backend.metrics import Counter, Histogram, Metric
+
+
+def test_incomplete_metric_fails_when_constructed():
+    class Summary(Metric):
+        type = "summary"
+
+    with pytest.raises(TypeError):
+        Summary("summary", "A metric without samples.")
+
+
+def test_render():
+    counter = Counter("requests_total", "Requests.", ("engine",))
+    counter.inc("watermark")
+    counter.inc("watermark", amount=2)
+    assert counter.render() == [
+        "# HELP requests_total Requests.",
+        "# TYPE requests_total counter",
+        'requests_total{engine="watermark"} 3',
+    ]
+    histogram = Histogram("seconds", "Latency.", buckets=(0.1, 1.0))
+    histogram.observe(value=0.5)
+    assert "seconds_count 1" in histogram.render()
@@ -0,0 +1,85 @@
+import random
+import re
+from itertools import chain
+
+import pytest
+
+from backend.preprocessing import MosesPunctNormalizer, _tokenization_norm, preprocess
+
+# The MAGE detokenization as a chain of str.replace calls, in order
+TOKENIZATION_NORM_CHAIN = [
+    (' ,', ','), (' .', '.'), (' ?', '?'), (' !', '!'), (' ;', ';'), (' \'', '\''), (' ’ ', '\''), (' :', ':'),
+    ('<newline>', '\n'), ('`` ', '"'), (' \'\'', '"'), ('\'\'', '"'), ('.. ', '... '), (' )', ')'), ('( ', '('),
+    (' n\'t', 'n\'t'), (' i ', ' I '), (' i\'', ' I\''), ('\\\'', '\''), ('\n ', '\n'),
+]
+
+PIECES = list(" ,.?!;'’:`()nti\\\nx\"„“”–—´‘‚…«» %ºC0123456789，。、∶：？《》）！（；」「０１２３４５６７８９．～━〈〉【】％\r ") + [
+    "<newline>", "''", "´´", "nº", "cm", " i ", " n't",
+]
+
+
+def random_texts(count: int, seed: int = 0) -> list[str]:
+    generator = random.Random(seed)
+    return ["".join(generator.choice(PIECES) for _ in range(generator.randint(0, 20))) for _ in range(count)]
+
+
+def chained_tokenization_norm(text: str) -> str:
+    for old, new in TOKENIZATION_NORM_CHAIN:
+        text = text.replace(old, new)
+    return text.strip()
+
+
+def sequential_normalize(normalizer: MosesPunctNormalizer, substitutions, text: str) -> str:
+    """The Moses normalization with every substitution applied by re.sub, one after the other."""
+    if normalizer.pre_replace_unicode_punct:
+        text = sequential_replace_unicode_punct(text)
+    for pattern, substitution in substitutions:
+        text = re.sub(pattern, substitution, text)
+    return text.strip()
+
+
+def sequential_replace_unicode_punct(text: str) -> str:
+    for pattern, substitution in MosesPunctNormalizer.REPLACE_UNICODE_PUNCTUATION:
+        text = re.sub(pattern, substitution, text)
+    return text
+
+
+def test_tokenization_norm_matches_the_replace_chain():
+    for text in random_texts(20000):
+        assert _tokenization_norm(text) == chained_tokenization_norm(text), repr(text)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("He said , `` hi '' .", 'He said, "hi".'),
+    ("i don 't know ( really ) .. maybe", "i don't know (really)... maybe"),
+    ("so i 'm here<newline> and i think", "so I'm here\nand I think"),
+    ("it\\'s fine", "it's fine"),
+])
+def test_tokenization_norm_examples(text, expected):
+    assert _tokenization_norm(text) == expected
+
+
+@pytest.mark.parametrize("kwargs, tables", [
+    ({}, ["EXTRA_WHITESPACE", "NORMALIZE_UNICODE_IF_NOT_PENN", "NORMALIZE_UNICODE", "FRENCH_QUOTES",
+          "HANDLE_PSEUDO_SPACES", "EN_QUOTATION_FOLLOWED_BY_COMMA", "OTHER"]),
+    ({"lang": "de", "penn": False}, ["EXTRA_WHITESPACE", "NORMALIZE_UNICODE", "FRENCH_QUOTES",
+                                     "HANDLE_PSEUDO_SPACES", "DE_ES_FR_QUOTATION_FOLLOWED_BY_COMMA", "DE_ES_CZ_CS_FR"]),
+    ({"pre_replace_unicode_punct": True}, ["EXTRA_WHITESPACE", "NORMALIZE_UNICODE_IF_NOT_PENN", "NORMALIZE_UNICODE",
+                                           "FRENCH_QUOTES", "HANDLE_PSEUDO_SPACES", "EN_QUOTATION_FOLLOWED_BY_COMMA",
+                                           "OTHER"]),
+])
+def test_moses_normalizer_matches_sequential_substitutions(kwargs, tables):
+    normalizer = MosesPunctNormalizer(**kwargs)
+    substitutions = list(chain(*(getattr(MosesPunctNormalizer, table) for table in tables)))
+    # the single character replacements are merged into fewer passes
+    assert len(normalizer.substitutions) < len(substitutions)
+    for text in random_texts(20000, seed=len(tables)):
+        assert normalizer.normalize(text) == sequential_normalize(normalizer, substitutions, text), repr(text)
+        assert normalizer.replace_unicode_punct(text) == sequential_replace_unicode_punct(text), repr(text)
+
+
+def test_preprocess_reuses_results():
+    text = "A text  with\nline breaks <pad> and “quotes” ."
+    for pipeline in ["basic", "longformer"]:
+        assert preprocess(text, pipeline) == preprocess(text, pipeline)
+    assert preprocess(text, "longformer") == 'A text with line breaks and "quotes".'
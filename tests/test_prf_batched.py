@@ -0,0 +1,67 @@
+import pytest
+import torch
+
+from backend.watermark.alternative_prf_schemes import prf_lookup, prf_lookup_batched, seeding_scheme_lookup
+from backend.watermark.extended_watermark_processor import WatermarkBase
+
+HASH_KEY = 15485863
+VOCAB_SIZE = 50272
+# Named schemes accepted by seeding_scheme_lookup, besides the freeform "ff-..." ones built from prf_lookup
+SEEDING_SCHEMES = ["simple_1", "lefthash", "algorithm-3", "selfhash", "minhash", "skipgram"] + [
+    f"ff-{prf_name}-{width}-{self_salt}"
+    for prf_name in prf_lookup
+    for width, self_salt in [(1, False), (4, True)]
+    # pairs of tokens need a context of two
+    if not (prf_name == "minskipgram_prf" and width == 1)
+]
+
+
+def edge_contexts(width: int) -> torch.LongTensor:
+    """Random contexts plus the edge cases: repeated tokens, zeros, ids at the end of the vocabulary and huge ids."""
+    generator = torch.Generator().manual_seed(width)
+    rows = [
+        torch.randint(0, VOCAB_SIZE, (200, width), generator=generator),
+        torch.randint(0, 2**40, (200, width), generator=generator),
+        torch.zeros(1, width, dtype=torch.long),
+        torch.full((1, width), 7),
+        torch.full((1, width), VOCAB_SIZE - 1),
+        torch.randint(VOCAB_SIZE - 3, VOCAB_SIZE, (20, width), generator=generator),
+    ]
+    return torch.cat(rows)
+
+
+def scalar_seeds(prf, contexts: torch.LongTensor) -> list[int]:
+    return [prf(context, salt_key=HASH_KEY) for context in contexts]
+
+
+def test_every_prf_has_a_batched_variant():
+    assert set(prf_lookup_batched) == set(prf_lookup)
+
+
+@pytest.mark.parametrize("width", [1, 2, 4, 5])
+@pytest.mark.parametrize("prf_name", list(prf_lookup))
+def test_batched_prf_matches_scalar(prf_name, width):
+    if prf_name == "minskipgram_prf" and width == 1:
+        pytest.skip("minskipgram_prf needs at least two tokens to form a pair")
+    contexts = edge_contexts(width)
+    assert prf_lookup_batched[prf_name](contexts, salt_key=HASH_KEY) == scalar_seeds(prf_lookup[prf_name], contexts)
+
+
+@pytest.mark.parametrize("prf_name", list(prf_lookup))
+def test_batched_prf_of_no_contexts(prf_name):
+    assert prf_lookup_batched[prf_name](torch.zeros(0, 4, dtype=torch.long), salt_key=HASH_KEY) == []
+
+
+@pytest.mark.parametrize("seeding_scheme", SEEDING_SCHEMES)
+def test_batched_seeds_match_scalar_seeds(seeding_scheme):
+    seeding_scheme_lookup(seeding_scheme)  # the scheme must be valid
+    watermark = WatermarkBase(vocab=list(range(VOCAB_SIZE)), seeding_scheme=seeding_scheme)
+    # one token more than needed, the seeds only depend on the last context_width tokens
+    contexts = edge_contexts(watermark.context_width + 1)
+    assert watermark._get_prf_seeds(contexts) == [watermark._get_prf_seed(context) for context in contexts]
+
+
+def test_batched_seeds_need_a_full_context():
+    watermark = WatermarkBase(vocab=list(range(VOCAB_SIZE)), seeding_scheme="selfhash")
+    with pytest.raises(ValueError):
+        watermark._get_prf_seeds(torch.zeros(3, watermark.context_width - 1, dtype=torch.long))
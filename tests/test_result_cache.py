@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+from backend import result_cache
+from backend.result_cache import MemoryResultCache, SQLiteResultCache, engine_fingerprint, make_result_cache, result_key
+
+# Read by the result cache as the config of FakeEngine's module
+config = {"model_path": None, "threshold": 0.5}
+
+
+class FakeEngine:
+    def normalize_text(self, text: str) -> str:
+        return " ".join(text.split()).lower()
+
+
+@pytest.fixture
+def model_file(tmp_path, monkeypatch):
+    path = tmp_path / "model.bin"
+    path.write_bytes(b"weights")
+    monkeypatch.setitem(config, "model_path", str(path))
+    return path
+
+
+def test_key_uses_the_normalized_text(model_file):
+    engine = FakeEngine()
+    assert result_key("fake", engine, "Some  TEXT") == result_key("fake", engine, "some text")
+    assert result_key("fake", engine, "some text") != result_key("fake", engine, "other text")
+    assert result_key("fake", engine, "some text") != result_key("other", engine, "some text")
+
+
+def test_fingerprint_is_computed_once_per_engine(model_file, monkeypatch):
+    engine = FakeEngine()
+    fingerprint = engine_fingerprint(engine)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the fingerprint must not touch the filesystem on lookups")
+
+    monkeypatch.setattr(result_cache.os, "stat", fail)
+    monkeypatch.setattr(result_cache.os.path, "exists", fail)
+    assert result_key("fake", engine, "text").split(":")[1] == fingerprint == engine.result_fingerprint
+
+
+def test_fingerprint_follows_config_and_model_files(model_file, monkeypatch):
+    fingerprint = engine_fingerprint(FakeEngine())
+    assert engine_fingerprint(FakeEngine()) == fingerprint
+
+    monkeypatch.setitem(config, "threshold", 0.6)
+    changed_config = engine_fingerprint(FakeEngine())
+    assert changed_config != fingerprint
+
+    # a replaced model file changes the fingerprint of the engine loaded next
+    stat = model_file.stat()
+    os.utime(model_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert engine_fingerprint(FakeEngine()) != changed_config
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def cache(request, tmp_path):
+    return make_result_cache(request.param, max_entries=10, ttl_seconds=None, sqlite_path=str(tmp_path / "results.sqlite3"))
+
+
+def test_put_and_get(cache):
+    cache.put("a", {"label": "human-written", "score": 0.1})
+    assert cache.get("a") == {"label": "human-written", "score": 0.1}
+    assert cache.get("b") is None
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1 and stats["size"] == 1
+
+
+@pytest.mark.parametrize("make_cache", [
+    lambda path: MemoryResultCache(10, ttl_seconds=-1),
+    lambda path: SQLiteResultCache(path, 10, ttl_seconds=-1),
+], ids=["memory", "sqlite"])
+def test_expired_results_are_not_served(make_cache, tmp_path):
+    cache = make_cache(str(tmp_path / "results.sqlite3"))
+    cache.put("a", {"score": 1})
+    assert cache.get("a") is None
+
+
+def test_sqlite_keeps_the_most_recently_used(tmp_path):
+    cache = SQLiteResultCache(str(tmp_path / "results.sqlite3"), max_entries=10, ttl_seconds=None)
+    for index in range(25):
+        cache.put(f"key-{index}", {"index": index})
+    assert cache.stats()["size"] <= 10 + 1
+    assert cache.get("key-24") == {"index": 24}
+    assert cache.get("key-0") is None
+
+
+def test_unknown_backend():
+    assert make_result_cache(None, 10, None, "") is None
+    with pytest.raises(ValueError):
+        make_result_cache("redis", 10, None, "")
@@ -0,0 +1,69 @@
+import random
+
+import pytest
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast
+
+from backend.watermark.streaming import StreamingDetection
+
+WORDS = ["water", "mark", "watermark", "stream", "token", "the", "a", "of", "detect", "ion", "ing", "green", "list"]
+
+
+def random_text(generator: random.Random, words: int) -> str:
+    return " ".join(generator.choice(WORDS) + generator.choice(["", "", ",", ".", "s"]) for _ in range(words))
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    """A small byte-level BPE tokenizer, fast so that it reports token offsets."""
+    generator = random.Random(0)
+    bpe = Tokenizer(models.BPE())
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=400, initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    bpe.train_from_iterator([random_text(generator, 50) for _ in range(200)], trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=bpe)
+
+
+def cut(text: str, generator: random.Random) -> list[str]:
+    """Split the text at random points, into increments of up to a few words."""
+    points = sorted(generator.sample(range(1, len(text)), k=len(text) // 12))
+    return [text[start:end] for start, end in zip([0] + points, points + [len(text)])]
+
+
+@pytest.mark.parametrize("seeding_scheme", ["simple_1", "selfhash"])
+@pytest.mark.parametrize("ignore_repeated_ngrams", [True, False])
+def test_push_matches_detect_on_every_prefix(make_detector, tokenizer, seeding_scheme, ignore_repeated_ngrams):
+    detector = make_detector(seeding_scheme, ignore_repeated_ngrams, tokenizer=tokenizer)
+    generator = random.Random(seeding_scheme)
+    text = random_text(generator, 120)
+    stream = StreamingDetection(detector)
+    received, retracted = "", 0
+    for increment in cut(text, generator):
+        received += increment
+        scores = stream.push(increment)
+        retracted += scores["tokens_retracted"]
+        assert stream.tokens == tokenizer(received, add_special_tokens=False)["input_ids"]
+        if len(stream.tokens) <= detector.context_width:
+            continue  # detect needs a token past the first full context
+        expected = detector.detect(text=received, return_z_at_T=False)
+        assert scores["num_tokens_scored"] == expected["num_tokens_scored"]
+        assert scores["num_green_tokens"] == expected["num_green_tokens"]
+        assert scores["z_score"] == pytest.approx(expected["z_score"])
+    assert stream.text == text
+    # increments cut words in two, so some tokens were re-tokenized
+    assert retracted > 0
+
+
+def test_push_past_the_length_limit(make_detector, tokenizer):
+    stream = StreamingDetection(make_detector(tokenizer=tokenizer), max_chars=20)
+    stream.push("watermark " * 2)
+    with pytest.raises(ValueError):
+        stream.push("stream")
+    # the refused increment is not kept
+    assert stream.text == "watermark " * 2
+
+
+def test_streaming_needs_a_fast_tokenizer(make_detector):
+    with pytest.raises(ValueError):
+        StreamingDetection(make_detector())
@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+
+from backend import tracing
+from backend.batching import MicroBatcher
+
+
+@pytest.fixture(autouse=True)
+def profile_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(tracing.config, "profile_dir", str(tmp_path))
+    return tmp_path
+
+
+def test_overlapping_cprofile_captures_are_skipped(profile_dir):
+    inside = threading.Event()
+    release = threading.Event()
+
+    def first():
+        with tracing.profiled("cprofile", "first"):
+            inside.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=first)
+    thread.start()
+    inside.wait(5)
+    try:
+        # a second capture must not fail the request it runs around
+        with tracing.profiled("cprofile", "second"):
+            pass
+    finally:
+        release.set()
+        thread.join()
+    assert [path.name for path in profile_dir.iterdir()] == ["first.prof"]
+
+
+def test_cprofile_capture_of_batched_engine_keeps_batch_results(profile_dir):
+    batcher = MicroBatcher(lambda items: [item * 2 for item in items], max_batch_size=4, max_wait_ms=50)
+    try:
+        others = batcher.submit_many([1, 2])
+        with tracing.profiling(("cprofile", "capture"), batched=True):
+            profiled = batcher.submit(3)
+        assert [future.result(5) for future in others] + [profiled.result(5)] == [2, 4, 6]
+    finally:
+        batcher.close()
+    assert (profile_dir / "capture-batch.prof").exists()
+
+
+def test_profiling_without_capture_runs_block():
+    with tracing.profiling(None):
+        assert tracing.current_profile() is None
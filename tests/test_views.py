@@ -0,0 +1,104 @@
+import asyncio
+import threading
+
+import httpx
+import pytest
+from fastapi import FastAPI, WebSocketDisconnect
+from fastapi.testclient import TestClient
+
+from backend.finetuned import router as finetuned_router
+from backend.longformer import router as longformer_router
+from backend.models import EngineHub
+from backend.watermark import router as watermark_router
+from backend.watermark.models import WatermarkDetectionResponse
+from backend.watermark.service import window_kwargs
+from backend.watermark.utils import detect
+import backend.finetuned.view  # noqa: F401 registers the routes
+import backend.longformer.view  # noqa: F401
+import backend.watermark.view  # noqa: F401
+
+
+class MeetingEngine:
+    """An engine whose predict only returns once two requests are in flight, like two texts joining a batch."""
+
+    def __init__(self):
+        self.barrier = threading.Barrier(2, timeout=5)
+
+    def predict(self, request):
+        self.barrier.wait()
+        return {"label": "human-written", "confidence": 1.0, "logprobs": [0.0, 0.0]}
+
+
+@pytest.fixture
+def app():
+    app = FastAPI()
+    app.include_router(longformer_router)
+    app.include_router(finetuned_router)
+    app.include_router(watermark_router)
+    return app
+
+
+@pytest.mark.parametrize("engine_name", ["longformer", "finetuned"])
+def test_concurrent_requests_do_not_block_each_other(app, engine_name, monkeypatch):
+    monkeypatch.setitem(EngineHub, engine_name, MeetingEngine())
+
+    async def post_twice():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await asyncio.gather(*(client.post(f"/{engine_name}/infer", json={"text": "a text"}) for _ in range(2)))
+
+    # a predict that ran on the event loop would keep the second request from starting, and break the barrier
+    responses = asyncio.run(post_twice())
+    assert [response.status_code for response in responses] == [200, 200]
+    assert all(response.json()["label"] == "human-written" for response in responses)
+
+
+class WatermarkEngine:
+    """The watermark engine's predict over a detector of digit tokens, without the text preprocessing."""
+
+    def __init__(self, detector):
+        self.detector = detector
+
+    def predict(self, request):
+        return WatermarkDetectionResponse(text="", **detect(request.text, self.detector, **window_kwargs(request)))
+
+
+@pytest.mark.parametrize("window_size, status_code", [
+    ("20,50", 200),
+    ("max", 200),
+    ("500", 400),  # longer than the text
+    ("0", 422),
+    ("5,0", 422),
+    ("-3", 422),
+    ("abc", 422),
+    ("5,", 422),
+])
+def test_watermark_window_sizes(app, make_detector, monkeypatch, window_size, status_code):
+    monkeypatch.setitem(EngineHub, "watermark", WatermarkEngine(make_detector()))
+    text = " ".join(str(token) for token in range(100, 200))
+    with TestClient(app) as client:
+        response = client.post("/watermark/infer", json={"text": text, "window_size": window_size})
+    assert response.status_code == status_code, response.text
+    if status_code == 200:
+        assert response.json()["window_size"] <= 100
+
+
+class StreamingEngine:
+    def __init__(self, detection):
+        self.detection = detection
+
+    def open_stream(self):
+        return self.detection
+
+
+def test_stream_is_closed_past_its_length_limit(app, monkeypatch):
+    class Detection:
+        def push(self, increment):
+            raise ValueError("The stream is longer than the limit of 10 characters.")
+
+    monkeypatch.setitem(EngineHub, "watermark", StreamingEngine(Detection()))
+    with TestClient(app) as client, client.websocket_connect("/watermark/stream") as websocket:
+        websocket.send_text("a long increment")
+        assert "limit" in websocket.receive_json()["message"]
+        with pytest.raises(WebSocketDisconnect) as closed:
+            websocket.receive_text()
+    assert closed.value.code == 1009
@@ -0,0 +1,95 @@
+import math
+import threading
+
+import pytest
+import torch
+
+from backend.watermark.extended_watermark_processor import ngrams
+
+# Vocabulary size of the detectors built by the make_detector fixture
+VOCAB_SIZE = 1000
+
+
+def scalar_outcome(detector, ngram) -> bool:
+    """Watermark outcome of one ngram from the unbatched greenlist of its prefix."""
+    prefix = ngram if detector.self_salt else ngram[:-1]
+    return ngram[-1] in detector._get_greenlist_ids(torch.as_tensor(prefix)).tolist()
+
+
+def token_ids(length: int, seed: int = 0, vocab: int = VOCAB_SIZE) -> torch.Tensor:
+    return torch.randint(0, vocab, (length,), generator=torch.Generator().manual_seed(seed))
+
+
+def reference_scores(detector, input_ids: torch.Tensor) -> dict:
+    """Counts and z-scores computed one ngram at a time from the scalar greenlists."""
+    gamma = detector.gamma
+    z = lambda green, total: (green - gamma * total) / math.sqrt(total * gamma * (1 - gamma))
+    seen, green, total, z_at_T = set(), 0, 0, []
+    for ngram in ngrams(input_ids.tolist(), detector.context_width + 1 - detector.self_salt):
+        if not (detector.ignore_repeated_ngrams and ngram in seen):
+            seen.add(ngram)
+            total += 1
+            green += scalar_outcome(detector, ngram)
+        z_at_T.append(z(green, total))
+    return {"num_tokens_scored": total, "num_green_tokens": green, "z_score": z(green, total), "z_score_at_T": z_at_T}
+
+
+@pytest.mark.parametrize("seeding_scheme", ["simple_1", "selfhash"])
+@pytest.mark.parametrize("greenlist_workers", [1, 4])
+def test_bulk_scores_match_scalar_greenlists(make_detector, seeding_scheme, greenlist_workers):
+    detector = make_detector(seeding_scheme, greenlist_workers=greenlist_workers)
+    ids = token_ids(300, vocab=VOCAB_SIZE + 20).tolist()  # some targets are outside of the vocabulary
+    ngram_examples = list(set(ngrams(ids, detector.context_width + 1 - detector.self_salt)))
+    scores = detector._compute_ngram_scores(ngram_examples)
+    assert scores == {ngram: scalar_outcome(detector, ngram) for ngram in ngram_examples}
+
+
+@pytest.mark.parametrize("seeding_scheme", ["simple_1", "selfhash"])
+@pytest.mark.parametrize("ignore_repeated_ngrams", [True, False])
+def test_detect_matches_reference(make_detector, seeding_scheme, ignore_repeated_ngrams):
+    detector = make_detector(seeding_scheme, ignore_repeated_ngrams)
+    # a small vocabulary slice repeats ngrams, so both counting rules are exercised
+    input_ids = token_ids(400, vocab=30)
+    expected = reference_scores(detector, input_ids)
+    result = detector.detect(tokenized_text=input_ids)
+    assert result["num_tokens_scored"] == expected["num_tokens_scored"]
+    assert result["num_green_tokens"] == expected["num_green_tokens"]
+    assert result["z_score"] == pytest.approx(expected["z_score"])
+    assert result["z_score_at_T"].tolist() == pytest.approx(expected["z_score_at_T"], abs=1e-5)
+    # served from the greenlist cache the second time, with the same result
+    assert detector.detect(tokenized_text=input_ids)["z_score"] == result["z_score"]
+    assert detector.greenlist_cache.hits > 0
+
+
+def test_detect_many_matches_detect(make_detector):
+    detector = make_detector()
+    texts = [" ".join(str(token) for token in token_ids(length, seed=length).tolist()) for length in (20, 80, 200)]
+    for many, text in zip(detector.detect_many(texts), texts):
+        single = detector.detect(text=text)
+        assert many["z_score"] == single["z_score"]
+        assert many["num_green_tokens"] == single["num_green_tokens"]
+
+
+def test_detect_needs_a_scored_token(make_detector):
+    detector = make_detector("selfhash")
+    with pytest.raises(ValueError):
+        detector.detect(tokenized_text=token_ids(detector.context_width))
+
+
+def test_concurrent_first_detections_start_one_pool(make_detector):
+    detector = make_detector(greenlist_workers=4)
+    barrier = threading.Barrier(8)
+    pools = []
+
+    def first_use():
+        barrier.wait()
+        pools.append(detector._get_greenlist_pool())
+
+    threads = [threading.Thread(target=first_use) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(pool) for pool in pools}) == 1
+    detector.close()
+    assert detector._greenlist_pool is None
@@ -0,0 +1,82 @@
+import math
+
+import pytest
+import torch
+
+# Gamma of the detectors built by the make_detector fixture
+GAMMA = 0.25
+
+
+@pytest.fixture
+def detector(make_detector):
+    return make_detector("selfhash")
+
+
+def z(hits: int, size: int) -> float:
+    return (hits - GAMMA * size) / math.sqrt(size * GAMMA * (1 - GAMMA))
+
+
+def brute_force(green: list[bool], sizes: list[int], stride: int) -> dict:
+    length = len(green)
+    window_z = lambda start, size: z(sum(green[start : start + size]), size)
+    starts = range(0, length, stride)
+    return {
+        "z_max_per_size": [max([window_z(start, size) for start in starts if start + size <= length], default=-math.inf) for size in sizes],
+        "best_z_by_start": [max([window_z(start, size) for size in sizes if start + size <= length], default=-math.inf) for start in starts],
+        "z_at_T": [
+            max([0.0] + [window_z(start, size) for size in sizes for start in starts if start + size <= end + 1])
+            for end in range(length)
+        ],
+    }
+
+
+@pytest.mark.parametrize("sizes, stride", [
+    ([3, 7, 30], 1),
+    ([3, 7, 30], 4),
+    (list(range(1, 121)), 1),
+    (list(range(1, 121)), 3),
+    ([5, 1000], 2),  # a size longer than the sequence
+])
+def test_scan_matches_brute_force(detector, sizes, stride):
+    green = (torch.rand(120, generator=torch.Generator().manual_seed(stride)) < 0.35)
+    scan = detector._scan_windows(green, sizes, stride, by_start=True, by_end=True)
+    expected = brute_force(green.tolist(), sizes, stride)
+    for name, tolerance in [("z_max_per_size", 1e-9), ("best_z_by_start", 1e-5), ("z_at_T", 1e-9)]:
+        actual = scan[name].tolist()
+        assert len(actual) >= len(expected[name])
+        for a, e in zip(actual, expected[name]):
+            assert a == e or a == pytest.approx(e, abs=tolerance), name
+
+
+def test_max_window_finds_the_watermarked_span(make_detector):
+    detector = make_detector("lefthash")
+    generator = torch.Generator().manual_seed(0)
+    human = torch.randint(0, 1000, (200,), generator=generator).tolist()
+    # tokens drawn from the greenlist of the previous token form a watermarked span
+    watermarked = human[:100]
+    for _ in range(80):
+        greenlist = detector._get_greenlist_ids(torch.tensor(watermarked[-1:]))
+        watermarked.append(int(greenlist[len(watermarked) % len(greenlist)]))
+    input_ids = torch.tensor(watermarked + human[100:])
+
+    result = detector.detect(tokenized_text=input_ids, window_size="max", max_spans=3, return_z_at_T=False)
+    assert result["z_score"] > detector.z_threshold
+    assert result["window_size"] >= 60
+    span = result["spans"][0]
+    assert span["z_score"] > detector.z_threshold
+    assert 90 <= span["start_token"] and span["end_token"] <= 190
+    assert span["text"] == detector.tokenizer.decode(input_ids[span["start_token"] : span["end_token"]])
+    # spans do not overlap
+    ranges = sorted((span["start_token"], span["end_token"]) for span in result["spans"])
+    assert all(end <= next_start for (_, end), (next_start, _) in zip(ranges, ranges[1:]))
+
+
+def test_window_detection_without_fitting_window(detector):
+    with pytest.raises(ValueError):
+        detector.detect(tokenized_text=torch.arange(10), window_size="50,60")
+
+
+@pytest.mark.parametrize("window_size", ["0", "5,0", "-3", "abc", "", ","])
+def test_invalid_window_sizes(detector, window_size):
+    with pytest.raises(ValueError, match="Window sizes"):
+        detector.detect(tokenized_text=torch.arange(100), window_size=window_size)